@@ -7,6 +7,7 @@ const API_ENDPOINT = 'https://YOUR_API_ID.execute-api.us-east-1.amazonaws.com/pr
 let lastPreloadedURL = null;  // Track last preloaded page to avoid duplicates
 let preloadedPageContent = null;  // Store preloaded content to reuse for queries
 let contentReady = false;  // Flag to indicate content extraction is complete
+const readyContentHashes = new Set();  // Content hashes the backend has a ready index for
 
 // Initialize side panel on first load
 if (!window.sidePanelInitialized) {
@@ -473,6 +474,17 @@ async function deleteSession(sessionId) {
   }
 }
 
+// SHA-256 of the page text, matching the backend's content hash
+async function hashPageContent(pageContent) {
+  const text = (pageContent && pageContent.text) || '';
+  const digest = await crypto.subtle.digest('SHA-256', new TextEncoder().encode(text));
+  return Array.from(new Uint8Array(digest)).map(b => b.toString(16).padStart(2, '0')).join('');
+}
+
+function parseLambdaBody(data) {
+  return typeof data.body === 'string' ? JSON.parse(data.body) : data.body || data;
+}
+
 function generateUUID() {
   return 'xxxxxxxx-xxxx-4xxx-yxxx-xxxxxxxxxxxx'.replace(/[xy]/g, function(c) {
     const r = Math.random() * 16 | 0;
@@ -525,23 +537,36 @@ function initializeContent() {
   });
 }
 
-// Preload embeddings in background to make first query instant
+// Preload embeddings in background to make first query instant.
+// Only the content hash is sent first; the page text is uploaded on a cache miss.
 async function preloadEmbeddings(pageContent, pageURL) {
   try {
-    // Execute request without explicit timeout handling
-    const response = await fetch(API_ENDPOINT, {
-      method: 'POST',
-      headers: { 'Content-Type': 'application/json' },
-      body: JSON.stringify({
-        action: 'preloadEmbeddings',
-        pageContent: pageContent,
-        pageURL: pageURL,
-        authToken: authToken
-      })
-    });
+    const contentHash = await hashPageContent(pageContent);
+    if (readyContentHashes.has(contentHash)) {
+      return;
+    }
     
-    const data = await response.json();
-    const body = typeof data.body === 'string' ? JSON.parse(data.body) : data.body || data;
+    const postPreload = async (payload) => {
+      const response = await fetch(API_ENDPOINT, {
+        method: 'POST',
+        headers: { 'Content-Type': 'application/json' },
+        body: JSON.stringify({
+          action: 'preloadEmbeddings',
+          pageURL: pageURL,
+          authToken: authToken,
+          ...payload
+        })
+      });
+      return parseLambdaBody(await response.json());
+    };
+    
+    let body = await postPreload({ contentHash: contentHash });
+    if (body.status === 'needContent') {
+      body = await postPreload({ pageContent: pageContent });
+    }
+    if (body.status === 'cached' || (body.status === 'success' && body.coverage === 1)) {
+      readyContentHashes.add(contentHash);
+    }
   } catch (error) {
     console.error('Preload failed:', error);
   }
@@ -876,24 +901,46 @@ async function sendQueryToLambda(pageURL, pageContent, question, queryStartTime)
   const prompt = `${question}`;
   
   const apiEndpoint = API_ENDPOINT;
-
-  fetch(apiEndpoint, {
+  
+  // Send only the content hash when the backend already has this page indexed
+  const contentHash = await hashPageContent(pageContent);
+  const postAsk = (pagePayload) => fetch(apiEndpoint, {
     method: 'POST',
     headers: {
       'Content-Type': 'application/json',
     },
     body: JSON.stringify({
       session_id: currentSessionId, 
-      pageContent, 
+      ...pagePayload, 
       prompt, 
       imageContext, 
       pageURL, 
       action: 'ask',
       authToken: authToken
     }),
-  })
-    .then(response => response.json())
+  }).then(response => response.json());
+
+  const askRequest = readyContentHashes.has(contentHash)
+    ? postAsk({ contentHash }).then(data => {
+        // Backend lost the index (e.g. cache expired); upload the page text
+        if (parseLambdaBody(data).status === 'needContent') {
+          readyContentHashes.delete(contentHash);
+          return postAsk({ pageContent });
+        }
+        return data;
+      })
+    : postAsk({ pageContent });
+
+  askRequest
     .then(data => {
+      // The backend indexes uploaded content while answering. A long page
+      // may only be partly indexed; keep sending its text until it is
+      // complete so the backend can resume a stalled build.
+      const askBody = parseLambdaBody(data);
+      if (data.statusCode !== 401 && askBody.response !== undefined && askBody.coverage === 1) {
+        readyContentHashes.add(contentHash);
+      }
+
       removeTypingIndicator();
       isWaitingForResponse = false;
       
@@ -963,7 +1010,9 @@ async function sendQueryToLambda(pageURL, pageContent, question, queryStartTime)
 // Function to extract content from the webpage
 function extractContent() {
   return {
-    text: document.body.innerText || ''
+    text: document.body.innerText || '',
+    // Where the user is on the page; long pages embed this section first
+    scrollRatio: window.scrollY / Math.max(1, document.documentElement.scrollHeight)
   };
 }
 
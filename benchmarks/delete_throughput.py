@@ -0,0 +1,100 @@
+"""Benchmark session deletion throughput against a simulated DynamoDB.
+
+Deletes a session of synthetic chat items through
+lambda_function.batch_delete_keys, with BatchWriteItem replaced by a
+stand-in that sleeps for a fixed per-call latency and can leave a share
+of each batch unprocessed, the way a throttled table does. Reports
+items/s per DELETE_MAX_WORKERS setting; 1 worker is the serial baseline.
+This is the data behind the deletion numbers in the deleteAll change
+(20,000 items at 5 ms per call). Needs the packages from
+requirements.txt; no AWS access is used.
+
+    python benchmarks/delete_throughput.py
+    python benchmarks/delete_throughput.py --items 50000 --latency-ms 8 --unprocessed 0.1 --json results.json
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import threading
+import time
+from types import SimpleNamespace
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import lambda_function  # noqa: E402
+
+
+class SimulatedBatchWriter:
+    """BatchWriteItem stand-in: fixed latency, a share of requests left unprocessed."""
+
+    def __init__(self, latency, unprocessed, seed=0):
+        self.latency = latency
+        self.unprocessed = unprocessed
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.calls = 0
+        self.deleted = 0
+
+    def batch_write_item(self, RequestItems):
+        time.sleep(self.latency)
+        response = {'UnprocessedItems': {}}
+        for table_name, requests in RequestItems.items():
+            with self.lock:
+                self.calls += 1
+                left = [r for r in requests if self.rng.random() < self.unprocessed]
+                self.deleted += len(requests) - len(left)
+            if left:
+                response['UnprocessedItems'][table_name] = left
+        return response
+
+
+def run_case(workers, keys, args):
+    writer = SimulatedBatchWriter(args.latency_ms / 1000, args.unprocessed)
+    client = SimpleNamespace(meta=SimpleNamespace(client=writer))
+    with mock.patch.object(lambda_function, 'dynamodb', client), \
+            mock.patch.object(lambda_function, 'table', SimpleNamespace(name='chatHistory')), \
+            mock.patch.object(lambda_function, 'DELETE_MAX_WORKERS', workers), \
+            mock.patch('builtins.print'):
+        started = time.perf_counter()
+        deleted, undeleted = lambda_function.batch_delete_keys(keys)
+        elapsed = time.perf_counter() - started
+    return {
+        'workers': workers,
+        'items': len(keys),
+        'deleted': deleted,
+        'undeleted': len(undeleted),
+        'calls': writer.calls,
+        'seconds': round(elapsed, 3),
+        'itemsPerSecond': round(deleted / elapsed, 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark batched session deletion.')
+    parser.add_argument('--items', type=int, default=20000, help='Chat items in the session')
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 4, 8, 16])
+    parser.add_argument('--latency-ms', type=float, default=5, help='Simulated BatchWriteItem latency')
+    parser.add_argument('--unprocessed', type=float, default=0.0,
+                        help='Share of requests DynamoDB leaves unprocessed per call (throttling)')
+    parser.add_argument('--json', help='Also write the results to this file')
+    args = parser.parse_args()
+
+    keys = [{'sessionid': 'bench-session', 'timestamp': i} for i in range(args.items)]
+    results = []
+    print(f"{'workers':>7} {'calls':>7} {'seconds':>8} {'items/s':>9} {'undeleted':>9}")
+    for workers in args.workers:
+        result = run_case(workers, keys, args)
+        results.append(result)
+        print(f"{workers:>7} {result['calls']:>7} {result['seconds']:>8.2f} "
+              f"{result['itemsPerSecond']:>9.0f} {result['undeleted']:>9}")
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,121 @@
+"""Benchmark the FAISS index types chosen by page size.
+
+Builds flat, HNSW and IVF-PQ indexes over synthetic clustered vectors of
+the Titan v2 dimension and reports, per page size (chunk count): build
+time, mean search latency, index size and recall@k against exact search.
+This is the data behind FAISS_HNSW_MIN_CHUNKS (1000) and
+FAISS_IVFPQ_MIN_CHUNKS (50000). Index parameters come from
+lambda_function.choose_index_params, so the numbers track the shipped
+settings. Needs the packages from requirements.txt; no AWS access is used.
+
+    python benchmarks/faiss_index_selection.py
+    python benchmarks/faiss_index_selection.py --sizes 500 1000 5000 50000 --json results.json
+"""
+import argparse
+import json
+import math
+import os
+import sys
+import time
+from types import SimpleNamespace
+
+import faiss
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import lambda_function  # noqa: E402
+
+INDEX_TYPES = ('flat', 'hnsw', 'ivfpq')
+
+
+def synthetic_page(num_chunks, dimension, num_queries, rng):
+    """Clustered chunk vectors plus queries near existing chunks, like questions about a page."""
+    centers = rng.normal(size=(max(10, num_chunks // 20), dimension)).astype('float32')
+    vectors = centers[rng.integers(0, len(centers), num_chunks)]
+    vectors = (vectors + 0.3 * rng.normal(size=vectors.shape)).astype('float32')
+    queries = vectors[rng.integers(0, num_chunks, num_queries)]
+    queries = (queries + 0.2 * rng.normal(size=queries.shape)).astype('float32')
+    return vectors, queries
+
+
+def index_params_for(index_type, num_chunks, dimension):
+    """The params choose_index_params would give index_type at this size."""
+    thresholds = {
+        'flat': (math.inf, math.inf),
+        'hnsw': (0, math.inf),
+        'ivfpq': (0, 0),
+    }[index_type]
+    saved = lambda_function.FAISS_HNSW_MIN_CHUNKS, lambda_function.FAISS_IVFPQ_MIN_CHUNKS
+    lambda_function.FAISS_HNSW_MIN_CHUNKS, lambda_function.FAISS_IVFPQ_MIN_CHUNKS = thresholds
+    try:
+        return lambda_function.choose_index_params(num_chunks, dimension)
+    finally:
+        lambda_function.FAISS_HNSW_MIN_CHUNKS, lambda_function.FAISS_IVFPQ_MIN_CHUNKS = saved
+
+
+def run_case(index_type, vectors, queries, truth, k):
+    num_chunks, dimension = vectors.shape
+    params = index_params_for(index_type, num_chunks, dimension)
+
+    started = time.perf_counter()
+    index = lambda_function.create_faiss_index(params, vectors)
+    index.add(vectors)
+    build_s = time.perf_counter() - started
+
+    started = time.perf_counter()
+    _, found = index.search(queries, k)
+    search_ms = (time.perf_counter() - started) * 1000 / len(queries)
+
+    recall = np.mean([len(set(found[i]) & set(truth[i])) / k for i in range(len(queries))])
+    return {
+        'chunks': num_chunks,
+        'type': index_type,
+        'chosen': lambda_function.choose_index_params(num_chunks, dimension)['type'] == index_type,
+        'buildSeconds': round(build_s, 3),
+        'searchMs': round(search_ms, 3),
+        'fileMB': round(len(faiss.serialize_index(index)) / 1e6, 2),
+        'memoryMB': round(lambda_function.index_memory_bytes(SimpleNamespace(index=index), params) / 1e6, 2),
+        f'recall@{k}': round(float(recall), 3),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark FAISS index types across page sizes.')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[300, 1000, 3000, 10000, 50000])
+    parser.add_argument('--dimension', type=int, default=1024, help='Titan v2 embeddings are 1024-d')
+    parser.add_argument('--queries', type=int, default=200)
+    parser.add_argument('-k', type=int, default=5, help='Results per query (the retriever uses 5)')
+    parser.add_argument('--threads', type=int, default=2, help='FAISS threads (Lambda at 2 GB has ~2 vCPUs)')
+    parser.add_argument('--json', help='Also write the results to this file')
+    args = parser.parse_args()
+
+    faiss.omp_set_num_threads(args.threads)
+    rng = np.random.default_rng(0)
+    results = []
+    print(f"{'chunks':>7} {'type':>6} {'build s':>8} {'search ms':>10} {'file MB':>8} {'mem MB':>8} "
+          f"{'recall@' + str(args.k):>9}")
+    for num_chunks in args.sizes:
+        vectors, queries = synthetic_page(num_chunks, args.dimension, args.queries, rng)
+        exact = faiss.IndexFlatL2(args.dimension)
+        exact.add(vectors)
+        _, truth = exact.search(queries, args.k)
+
+        for index_type in INDEX_TYPES:
+            # Training 8-bit PQ codebooks wants ~39 points per centroid (256)
+            if index_type == 'ivfpq' and num_chunks < 39 * 256:
+                continue
+            result = run_case(index_type, vectors, queries, truth, args.k)
+            results.append(result)
+            print(f"{num_chunks:>7} {index_type:>6}{'*' if result['chosen'] else ' '}"
+                  f"{result['buildSeconds']:>8.2f} {result['searchMs']:>10.3f} {result['fileMB']:>8.1f} "
+                  f"{result['memoryMB']:>8.1f} {result[f'recall@{args.k}']:>9.3f}")
+    print('* = the type choose_index_params picks at this size')
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,116 @@
+"""Benchmark response size and encoding cost of a listSessions reply.
+
+Builds a listSessions payload from synthetic chat items (titles, page URLs
+and content hashes like the extension sends) through
+lambda_function.list_chat_sessions, then serializes it with
+build_response as identity, gzip and brotli, with and without a fields
+list. Reports body bytes on the wire and build time. This is the data
+behind the listSessions figures in the response layer change (3,000
+summaries). Needs the packages from requirements.txt; no AWS access is
+used.
+
+    python benchmarks/response_size.py
+    python benchmarks/response_size.py --sessions 500 3000 10000 --json results.json
+"""
+import argparse
+import hashlib
+import json
+import os
+import random
+import sys
+import time
+from types import SimpleNamespace
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import lambda_function  # noqa: E402
+
+WORDS = ('how does the pricing page compare plans for teams what is the refund policy summarize '
+         'this article about climate data explain the main argument list the steps to install').split()
+SITES = ('docs.python.org', 'en.wikipedia.org', 'news.ycombinator.com', 'aws.amazon.com', 'github.com')
+
+ENCODINGS = (('identity', ''), ('gzip', 'gzip'), ('br', 'br'))
+
+
+def synthetic_items(num_sessions, messages_per_session, rng):
+    """Chat items as listSessions scans them back, a few messages per session."""
+    items = []
+    now = 1_760_000_000_000
+    for s in range(num_sessions):
+        session_id = f"{rng.getrandbits(128):032x}"
+        page_url = f"https://{rng.choice(SITES)}/{'/'.join(rng.choices(WORDS, k=3))}?id={s}"
+        content_hash = hashlib.sha256(page_url.encode()).hexdigest()
+        for m in range(messages_per_session):
+            question = ' '.join(rng.choices(WORDS, k=rng.randint(6, 14))).capitalize() + '?'
+            items.append({
+                'sessionid': session_id,
+                'timestamp': now - s * 3_600_000 + m * 60_000,
+                'userId': 'bench-user',
+                'question': question,
+                'pageURL': page_url,
+                'contentHash': content_hash,
+                'createdAt': now - s * 3_600_000,
+            })
+    return items
+
+
+def run_case(payload, accept, fields, repeats):
+    payload = lambda_function.select_fields('listSessions', json.loads(json.dumps(payload)), fields)
+    event = {'headers': {'Accept-Encoding': accept} if accept else {}}
+    started = time.perf_counter()
+    for _ in range(repeats):
+        response = lambda_function.build_response(event, 200, payload)
+    build_ms = (time.perf_counter() - started) * 1000 / repeats
+    size = len(response['body'])
+    if response.get('isBase64Encoded'):
+        # Bytes on the wire: API Gateway decodes the base64 body
+        size = size * 3 // 4 - response['body'][-2:].count('=')
+    return {
+        'encoding': response['headers'].get('Content-Encoding', 'identity'),
+        'fields': ','.join(fields) if fields else 'all',
+        'bytes': size,
+        'buildMs': round(build_ms, 2),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark listSessions response size by encoding.')
+    parser.add_argument('--sessions', type=int, nargs='+', default=[300, 3000])
+    parser.add_argument('--messages', type=int, default=4, help='Chat items per session')
+    parser.add_argument('--fields', nargs='+', default=['session_id', 'sessionTitle', 'lastMessageAt'],
+                        help='Fields list for the trimmed runs')
+    parser.add_argument('--repeats', type=int, default=20)
+    parser.add_argument('--json', help='Also write the results to this file')
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+    results = []
+    print(f"{'sessions':>8} {'fields':>8} {'encoding':>9} {'KB':>8} {'build ms':>9}")
+    for num_sessions in args.sessions:
+        items = synthetic_items(num_sessions, args.messages, rng)
+        fake_table = SimpleNamespace(scan=lambda **kwargs: {'Items': items})
+        with mock.patch.object(lambda_function, 'table', fake_table):
+            _, payload = lambda_function.handle_list_sessions({'user_id': 'bench-user'})
+
+        with mock.patch.object(lambda_function, 'COMPRESS_RESPONSES', True):
+            for fields in (None, args.fields):
+                for encoding, accept in ENCODINGS:
+                    # brotli is an optional dependency
+                    if encoding == 'br' and not lambda_function.brotli:
+                        continue
+                    result = dict(run_case(payload, accept, fields, args.repeats), sessions=num_sessions)
+                    results.append(result)
+                    print(f"{num_sessions:>8} {'trimmed' if fields else 'all':>8} {result['encoding']:>9} "
+                          f"{result['bytes'] / 1000:>8.1f} {result['buildMs']:>9.2f}")
+
+    if not lambda_function.brotli:
+        print('brotli is not installed; br rows skipped')
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,236 @@
+"""Benchmark ask throughput: one request per invocation vs the pooled server.
+
+Replaces the AWS and Bedrock calls an ask makes with stand-ins that sleep
+for a fixed latency (DynamoDB reads and writes, S3 index download, FAISS
+load, query embedding, LLM), then sends hash-only asks over a few pages
+two ways: serially through lambda_handler with the index cache off, the
+way Lambda handles one request per container, and concurrently over
+keep-alive connections to server.PooledHTTPServer with the in-memory
+index cache on. This is the data behind the throughput figures in the
+server mode change. Needs the packages from requirements.txt; no AWS
+access is used.
+
+    python benchmarks/server_throughput.py
+    python benchmarks/server_throughput.py --workers 32 --clients 32 --requests 1000 --json results.json
+    python benchmarks/server_throughput.py --lambda-pools   # server with the Lambda-sized pools
+"""
+import argparse
+import http.client
+import json
+import os
+import sys
+import threading
+import time
+from types import SimpleNamespace
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Benchmark ask throughput per invocation and in server mode.')
+    parser.add_argument('--workers', type=int, default=16, help='Server worker threads')
+    parser.add_argument('--clients', type=int, default=16, help='Concurrent keep-alive clients')
+    parser.add_argument('--requests', type=int, default=400)
+    parser.add_argument('--pages', type=int, default=4, help='Distinct pages (content hashes) asked about')
+    parser.add_argument('--db-ms', type=float, default=10, help='DynamoDB call latency')
+    parser.add_argument('--download-ms', type=float, default=30, help='S3 index download latency')
+    parser.add_argument('--load-ms', type=float, default=40, help='FAISS index load latency')
+    parser.add_argument('--embed-ms', type=float, default=20, help='Query embedding and search latency')
+    parser.add_argument('--llm-ms', type=float, default=150, help='LLM answer latency')
+    parser.add_argument('--lambda-pools', action='store_true',
+                        help='Keep the Lambda-sized shared pools in the server run')
+    parser.add_argument('--json', help='Also write the results to this file')
+    return parser.parse_args()
+
+
+ARGS = parse_args()
+if ARGS.lambda_pools:
+    for name, size in (('IO_MAX_WORKERS', 16), ('WRITE_MAX_WORKERS', 4),
+                       ('S3_TRANSFER_MAX_WORKERS', 16), ('AWS_MAX_POOL_CONNECTIONS', 50)):
+        os.environ[f'SERVER_{name}'] = str(size)
+
+# server sizes the shared pools from --workers before importing lambda_function
+import server  # noqa: E402
+
+lambda_function = server.lambda_function
+
+
+class SimulatedTable:
+    """DynamoDB table stand-in: every call sleeps, reads find nothing."""
+
+    def __init__(self, latency):
+        self.latency = latency
+        self.name = 'bench'
+
+    def query(self, **kwargs):
+        time.sleep(self.latency)
+        return {'Items': []}
+
+    def get_item(self, **kwargs):
+        time.sleep(self.latency)
+        return {}
+
+    def put_item(self, **kwargs):
+        time.sleep(self.latency)
+        return {}
+
+    def update_item(self, **kwargs):
+        time.sleep(self.latency)
+        return {}
+
+
+class SimulatedStore:
+    """Vector store stand-in sized like a 2,000-chunk Titan v2 page."""
+    index = SimpleNamespace(ntotal=2000, d=1024)
+
+    def as_retriever(self, search_kwargs, metadata):
+        return SimpleNamespace(vectorstore=self, search_kwargs=search_kwargs, metadata=metadata)
+
+
+class SimulatedLLM:
+    def __init__(self, latency):
+        self.latency = latency
+
+    def invoke(self, message):
+        time.sleep(self.latency)
+        return SimpleNamespace(content='Simulated answer.')
+
+
+def simulated_aws(args):
+    """Patches that stand in for every AWS call an ask makes."""
+    table = SimulatedTable(args.db_ms / 1000)
+    cache_table = SimulatedTable(args.db_ms / 1000)
+
+    def load_local_index(content_hash, version, embeddings):
+        # The first load per container finds nothing in /tmp and downloads
+        if (content_hash, version) not in downloaded:
+            return None
+        time.sleep(args.load_ms / 1000)
+        return SimulatedStore(), {'type': 'flat'}
+
+    downloaded = set()
+
+    def download_index_version(content_hash, version):
+        time.sleep(args.download_ms / 1000)
+        downloaded.add((content_hash, version))
+
+    def retrieve_page_content(retrievers, prompt, query_vector=None):
+        time.sleep(args.embed_ms / 1000)
+        return ''
+
+    return [
+        mock.patch.object(lambda_function, 'table', table),
+        mock.patch.object(lambda_function, 'cache_table', cache_table),
+        mock.patch.object(lambda_function, 'published_index_version', lambda content_hash: 'bench'),
+        mock.patch.object(lambda_function, 'load_local_index', load_local_index),
+        mock.patch.object(lambda_function, 'download_index_version', download_index_version),
+        mock.patch.object(lambda_function, 'read_local_version', lambda content_hash: None),
+        mock.patch.object(lambda_function, 'write_local_version', lambda content_hash, version: None),
+        mock.patch.object(lambda_function, 'prune_local_versions', lambda content_hash, keep: None),
+        mock.patch.object(lambda_function, 'retrieve_page_content', retrieve_page_content),
+        mock.patch.object(lambda_function, 'make_bedrock_llm', lambda streaming=False: SimulatedLLM(args.llm_ms / 1000)),
+        # The per-request latency metric lines would drown the report
+        mock.patch.object(lambda_function, 'print', lambda *a, **k: None, create=True),
+    ]
+
+
+def ask_body(i, args):
+    return json.dumps({
+        'action': 'ask',
+        'prompt': 'What is this page about?',
+        'pageURL': f'https://example.com/page/{i % args.pages}',
+        'contentHash': f'{i % args.pages:064x}',
+        'session_id': f'bench-session-{i % args.clients}',
+    })
+
+
+def summarize(mode, latencies, elapsed):
+    latencies = sorted(latencies)
+    return {
+        'mode': mode,
+        'requests': len(latencies),
+        'requestsPerSecond': round(len(latencies) / elapsed, 1),
+        'p50Ms': round(latencies[len(latencies) // 2] * 1000),
+        'p95Ms': round(latencies[int(len(latencies) * 0.95)] * 1000),
+    }
+
+
+def run_per_invocation(args):
+    """Serial lambda_handler calls with the index cache off, as in Lambda."""
+    requests = max(args.requests // 4, args.pages * 4)
+    latencies = []
+    with mock.patch.object(lambda_function, 'INDEX_CACHE_MAX_BYTES', 0):
+        started = time.monotonic()
+        for i in range(requests):
+            event = {'httpMethod': 'POST', 'headers': {}, 'body': ask_body(i, args)}
+            request_started = time.monotonic()
+            response = lambda_function.lambda_handler(event, None)
+            latencies.append(time.monotonic() - request_started)
+            assert response['statusCode'] == 200, response
+        elapsed = time.monotonic() - started
+    return summarize('per-invocation, serial', latencies, elapsed)
+
+
+def run_server(args):
+    """Concurrent keep-alive clients against the pooled HTTP server."""
+    with lambda_function.index_cache_lock:
+        lambda_function.index_cache.clear()
+        lambda_function.index_cache_bytes[0] = 0
+    httpd = server.PooledHTTPServer(('127.0.0.1', 0), server.QuickpageRequestHandler, args.workers)
+    serving = threading.Thread(target=httpd.serve_forever, daemon=True)
+    serving.start()
+    port = httpd.server_address[1]
+
+    latencies = []
+    lock = threading.Lock()
+
+    def client(k):
+        connection = http.client.HTTPConnection('127.0.0.1', port)
+        for i in range(k, args.requests, args.clients):
+            request_started = time.monotonic()
+            connection.request('POST', '/', body=ask_body(i, args), headers={'Content-Type': 'application/json'})
+            response = connection.getresponse()
+            response.read()
+            assert response.status == 200, response.status
+            with lock:
+                latencies.append(time.monotonic() - request_started)
+        connection.close()
+
+    started = time.monotonic()
+    clients = [threading.Thread(target=client, args=(k,)) for k in range(args.clients)]
+    for thread in clients:
+        thread.start()
+    for thread in clients:
+        thread.join()
+    elapsed = time.monotonic() - started
+    httpd.stop()
+
+    pools = 'Lambda-sized pools' if args.lambda_pools else 'scaled pools'
+    return summarize(f'server, {args.workers} workers, {pools}', latencies, elapsed)
+
+
+def main():
+    args = ARGS
+    results = []
+    patches = simulated_aws(args)
+    for patch in patches:
+        patch.start()
+    try:
+        print(f"{'mode':<42} {'req/s':>7} {'p50 ms':>7} {'p95 ms':>7}")
+        for run in (run_per_invocation, run_server):
+            result = run(args)
+            results.append(result)
+            print(f"{result['mode']:<42} {result['requestsPerSecond']:>7.1f} "
+                  f"{result['p50Ms']:>7} {result['p95Ms']:>7}")
+    finally:
+        for patch in reversed(patches):
+            patch.stop()
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -3,6 +3,7 @@ import boto3
 import json
 import requests
 import base64
+import gzip
 from io import BytesIO
 import time
 import uuid
@@ -10,12 +11,34 @@ from boto3.dynamodb.conditions import Key, Attr
 import io
 import os
 import hashlib
+import hmac
 import pickle
+import math
+import random
+import re
+import shutil
+import threading
+import tracemalloc
+from collections import Counter, OrderedDict
 from decimal import Decimal
+from concurrent.futures import ThreadPoolExecutor, wait
+from botocore.config import Config
+from botocore.exceptions import (
+    ClientError, ConnectionClosedError, ConnectTimeoutError, EndpointConnectionError, ReadTimeoutError
+)
 from jose import jwt, JWTError
+import faiss
+import numpy as np
+
+# Brotli is optional; without it responses fall back to gzip
+try:
+    import brotli
+except ImportError:
+    brotli = None
 
 from langchain_aws import ChatBedrock, BedrockEmbeddings
 from langchain_community.vectorstores import FAISS
+from langchain_community.docstore.in_memory import InMemoryDocstore
 from langchain_text_splitters import RecursiveCharacterTextSplitter
 from langchain_core.documents import Document
 
@@ -27,21 +50,283 @@ def decimal_to_int(obj):
         return int(obj)
     raise TypeError
 
-# Initialize the Bedrock client for AI inference
-bedrock_runtime = boto3.client(
-    service_name='bedrock-runtime',
-    region_name=os.environ.get('AWS_REGION', 'us-east-1')
+# Bedrock rate limiting. Every Bedrock call (Titan embeddings inside FAISS,
+# retriever queries, ChatBedrock and converse) goes through one limiter per
+# model id: a token bucket caps the request rate and an AIMD limit caps
+# concurrency, growing by one per window of successes at the limit and
+# halving on a throttle. Interactive work is always admitted before background work.
+BEDROCK_THROTTLE_CODES = {
+    'ThrottlingException',
+    'TooManyRequestsException',
+    'ServiceUnavailableException',
+    'ModelNotReadyException',
+}
+# Errors worth retrying that say nothing about our request rate: they are
+# retried with the same backoff but do not shrink the concurrency limit.
+# botocore's own retries are off on the Bedrock client, so these replace them.
+BEDROCK_TRANSIENT_CODES = {
+    'InternalServerException',
+    'ModelTimeoutException',
+}
+BEDROCK_TRANSIENT_ERRORS = (ConnectionClosedError, ConnectTimeoutError, EndpointConnectionError, ReadTimeoutError)
+BEDROCK_LANES = ('interactive', 'background')
+
+
+class BedrockQueueTimeout(Exception):
+    """Raised when a Bedrock call waits in the limiter queue past its deadline."""
+
+
+class ModelRateLimiter:
+    """Token bucket plus AIMD concurrency limit for a single model id."""
+
+    def __init__(self, requests_per_second, burst, max_concurrency, initial_concurrency=None):
+        self.rate = float(requests_per_second)
+        self.burst = float(burst)
+        self.max_concurrency = max_concurrency
+        self.limit = float(initial_concurrency or max(1, max_concurrency // 2))
+        self.tokens = self.burst
+        self.last_refill = time.monotonic()
+        self.in_flight = 0
+        self.waiting = {lane: 0 for lane in BEDROCK_LANES}
+        self.cond = threading.Condition()
+        self.stats = {
+            'calls': 0,
+            'throttles': 0,
+            'transientErrors': 0,
+            'queueTimeouts': 0,
+            'queueWaitMs': 0.0,
+            'maxQueueWaitMs': 0.0,
+        }
+
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.last_refill) * self.rate)
+        self.last_refill = now
+
+    def acquire(self, lane='interactive', timeout=None):
+        """Block until a token and a concurrency slot are free; returns the wait in ms."""
+        started = time.monotonic()
+        deadline = None if timeout is None else started + timeout
+        with self.cond:
+            self.waiting[lane] += 1
+            try:
+                while True:
+                    now = time.monotonic()
+                    self._refill(now)
+                    yield_to_interactive = lane != 'interactive' and self.waiting['interactive'] > 0
+                    if not yield_to_interactive and self.in_flight < int(self.limit) and self.tokens >= 1:
+                        self.tokens -= 1
+                        self.in_flight += 1
+                        waited_ms = (now - started) * 1000
+                        self.stats['calls'] += 1
+                        self.stats['queueWaitMs'] += waited_ms
+                        self.stats['maxQueueWaitMs'] = max(self.stats['maxQueueWaitMs'], waited_ms)
+                        return waited_ms
+                    
+                    # Sleep until a token refills or a release wakes us
+                    sleep_for = None
+                    if self.tokens < 1:
+                        sleep_for = (1 - self.tokens) / self.rate
+                    if deadline is not None:
+                        remaining = deadline - now
+                        if remaining <= 0:
+                            self.stats['queueTimeouts'] += 1
+                            raise BedrockQueueTimeout(f'Timed out after {timeout}s waiting for Bedrock capacity')
+                        sleep_for = remaining if sleep_for is None else min(sleep_for, remaining)
+                    self.cond.wait(sleep_for)
+            finally:
+                self.waiting[lane] -= 1
+
+    def release(self, throttled=False, transient=False):
+        """Return a slot and adapt the concurrency limit (AIMD).
+
+        The limit only grows when the call ran with every slot in use;
+        successes well below the limit say nothing about a higher one.
+        """
+        with self.cond:
+            saturated = self.in_flight >= int(self.limit)
+            self.in_flight -= 1
+            if throttled:
+                self.stats['throttles'] += 1
+                self.limit = max(1.0, self.limit / 2)
+            elif transient:
+                self.stats['transientErrors'] += 1
+            elif saturated:
+                self.limit = min(float(self.max_concurrency), self.limit + 1 / self.limit)
+            self.cond.notify_all()
+
+    def snapshot(self):
+        with self.cond:
+            return dict(
+                self.stats,
+                queueWaitMs=round(self.stats['queueWaitMs'], 1),
+                maxQueueWaitMs=round(self.stats['maxQueueWaitMs'], 1),
+                concurrencyLimit=round(self.limit, 2),
+                inFlight=self.in_flight,
+                waiting=dict(self.waiting),
+            )
+
+
+class BedrockRateLimiter:
+    """Per-model limiters with throttle-aware retries and priority lanes.
+
+    The lane for calls made on the current thread is set with lane();
+    threads default to the interactive lane.
+    """
+
+    def __init__(self, requests_per_second, burst, max_concurrency, model_overrides=None,
+                 max_retries=4, queue_timeout=30.0, sleep=time.sleep):
+        self.defaults = {
+            'requests_per_second': requests_per_second,
+            'burst': burst,
+            'max_concurrency': max_concurrency,
+        }
+        self.model_overrides = model_overrides or {}
+        self.max_retries = max_retries
+        self.queue_timeout = queue_timeout
+        self.sleep = sleep
+        self.models = {}
+        self.models_lock = threading.Lock()
+        self.local = threading.local()
+
+    def for_model(self, model_id):
+        with self.models_lock:
+            if model_id not in self.models:
+                settings = dict(self.defaults, **self.model_overrides.get(model_id, {}))
+                self.models[model_id] = ModelRateLimiter(**settings)
+            return self.models[model_id]
+
+    def current_lane(self):
+        return getattr(self.local, 'lane', 'interactive')
+
+    def lane(self, lane):
+        """Context manager that runs this thread's Bedrock calls in the given lane."""
+        limiter = self
+
+        class _Lane:
+            def __enter__(self):
+                self.previous = limiter.current_lane()
+                limiter.local.lane = lane
+
+            def __exit__(self, *exc):
+                limiter.local.lane = self.previous
+
+        return _Lane()
+
+    def bind_lane(self, fn):
+        """Wrap fn so it runs in the calling thread's lane on whatever thread calls it.
+
+        Lanes are thread-local, so work handed to a pool must carry its lane.
+        """
+        lane = self.current_lane()
+
+        def in_lane(*args, **kwargs):
+            with self.lane(lane):
+                return fn(*args, **kwargs)
+        return in_lane
+
+    def call(self, model_id, fn, *args, **kwargs):
+        """Run fn under the model's limits, retrying throttles and transient
+        errors with jittered backoff."""
+        model = self.for_model(model_id)
+        lane = self.current_lane()
+        attempt = 0
+        while True:
+            model.acquire(lane, timeout=self.queue_timeout)
+            try:
+                result = fn(*args, **kwargs)
+            except ClientError as e:
+                code = e.response.get('Error', {}).get('Code')
+                throttled = code in BEDROCK_THROTTLE_CODES
+                transient = code in BEDROCK_TRANSIENT_CODES
+                model.release(throttled=throttled, transient=transient)
+                if not (throttled or transient) or attempt >= self.max_retries:
+                    raise
+            except BEDROCK_TRANSIENT_ERRORS:
+                model.release(transient=True)
+                if attempt >= self.max_retries:
+                    raise
+            except Exception:
+                model.release()
+                raise
+            else:
+                model.release()
+                return result
+            attempt += 1
+            self.sleep(random.uniform(0, min(8.0, 0.25 * (2 ** attempt))))
+
+    def snapshot(self):
+        with self.models_lock:
+            models = dict(self.models)
+        return {model_id: model.snapshot() for model_id, model in models.items()}
+
+
+class RateLimitedBedrockClient:
+    """bedrock-runtime client wrapper that routes model calls through a limiter.
+
+    Passed to ChatBedrock and BedrockEmbeddings in place of the raw client;
+    everything other than the model invocation operations passes through.
+    """
+    LIMITED_OPERATIONS = ('invoke_model', 'invoke_model_with_response_stream', 'converse', 'converse_stream')
+
+    def __init__(self, client, limiter):
+        self._client = client
+        self._limiter = limiter
+
+    def __getattr__(self, name):
+        attr = getattr(self._client, name)
+        if name not in self.LIMITED_OPERATIONS:
+            return attr
+
+        def limited(**kwargs):
+            return self._limiter.call(kwargs.get('modelId', ''), attr, **kwargs)
+        return limited
+
+
+bedrock_limiter = BedrockRateLimiter(
+    requests_per_second=float(os.environ.get('BEDROCK_REQUESTS_PER_SECOND', '10')),
+    burst=float(os.environ.get('BEDROCK_BURST', '10')),
+    max_concurrency=int(os.environ.get('BEDROCK_MAX_CONCURRENCY', '8')),
+    model_overrides=json.loads(os.environ.get('BEDROCK_MODEL_LIMITS', '{}')),
+    max_retries=int(os.environ.get('BEDROCK_MAX_RETRIES', '4')),
+    queue_timeout=float(os.environ.get('BEDROCK_QUEUE_TIMEOUT_SECONDS', '30')),
+)
+
+# Keep-alive HTTP connections per AWS client. The worker pools below run many
+# calls at once, so the pools must be at least as large as the botocore
+# default of 10 would otherwise allow.
+aws_client_config = Config(
+    max_pool_connections=int(os.environ.get('AWS_MAX_POOL_CONNECTIONS', '50'))
+)
+
+# Initialize the Bedrock client for AI inference. botocore's own retries are
+# off so throttles reach the limiter, which retries them (and transient
+# server and connection errors) and backs off.
+bedrock_runtime = RateLimitedBedrockClient(
+    boto3.client(
+        service_name='bedrock-runtime',
+        region_name=os.environ.get('AWS_REGION', 'us-east-1'),
+        config=aws_client_config.merge(Config(retries={'total_max_attempts': 1, 'mode': 'standard'}))
+    ),
+    bedrock_limiter
 )
 
 # Initialize S3 client for caching
-s3_client = boto3.client('s3', region_name=os.environ.get('AWS_REGION', 'us-east-1'))
+s3_client = boto3.client('s3', region_name=os.environ.get('AWS_REGION', 'us-east-1'), config=aws_client_config)
 CACHE_BUCKET = os.environ.get('S3_CACHE_BUCKET', 'your-embeddings-cache-bucket')
 
+# Lambda client for async self-invocation (bulk preload jobs)
+lambda_client = boto3.client('lambda', region_name=os.environ.get('AWS_REGION', 'us-east-1'), config=aws_client_config)
+
 # Initialize DynamoDB resource and tables
-dynamodb = boto3.resource('dynamodb', region_name=os.environ.get('AWS_REGION', 'us-east-1'))
+dynamodb = boto3.resource('dynamodb', region_name=os.environ.get('AWS_REGION', 'us-east-1'), config=aws_client_config)
 table = dynamodb.Table(os.environ.get('DYNAMODB_CHAT_TABLE', 'chatHistory'))
 cache_table = dynamodb.Table(os.environ.get('DYNAMODB_CACHE_TABLE', 'pageEmbeddingsCache'))
 
+# Secondary indexes on the chat table used for bulk deletion and cache
+# cleanup: userId-index projects contentHash, contentHash-index is KEYS_ONLY
+CHAT_USER_INDEX = os.environ.get('DYNAMODB_CHAT_USER_INDEX', 'userId-index')
+CHAT_CONTENT_HASH_INDEX = os.environ.get('DYNAMODB_CHAT_CONTENT_HASH_INDEX', 'contentHash-index')
+
 # AWS Bedrock model configuration
 MODEL_ID = os.environ.get('BEDROCK_MODEL_ID', 'us.meta.llama3-2-90b-instruct-v1:0')
 
@@ -51,6 +336,166 @@ COGNITO_USER_POOL_ID = os.environ.get('COGNITO_USER_POOL_ID', 'your-user-pool-id
 COGNITO_APP_CLIENT_ID = os.environ.get('COGNITO_APP_CLIENT_ID', 'your-app-client-id')
 COGNITO_KEYS_URL = f'https://cognito-idp.{COGNITO_REGION}.amazonaws.com/{COGNITO_USER_POOL_ID}/.well-known/jwks.json'
 
+# Response layer: CORS headers shared by every response and compression
+# settings. Compressed bodies are base64 encoded for API Gateway.
+CORS_HEADERS = {
+    'Content-Type': 'application/json',
+    'Access-Control-Allow-Origin': '*',
+    'Access-Control-Allow-Headers': 'Content-Type, Authorization',
+    'Access-Control-Allow-Methods': 'POST, OPTIONS'
+}
+COMPRESS_RESPONSES = os.environ.get('COMPRESS_RESPONSES', 'true').lower() == 'true'
+COMPRESSION_MIN_BYTES = int(os.environ.get('COMPRESSION_MIN_BYTES', '1024'))
+
+# Actions whose `fields` request parameter trims a nested object or list
+FIELD_SELECTION_TARGETS = {
+    'listSessions': 'sessions',
+    'getSession': 'session',
+    'preloadStatus': 'pages',
+    'askBatch': 'results',
+}
+
+# Worker pools for independent network I/O. They live at module level so warm
+# invocations reuse the threads. S3 file transfers get their own pool so a
+# download started from inside an I/O task can never wait on its own pool.
+io_executor = ThreadPoolExecutor(
+    max_workers=int(os.environ.get('IO_MAX_WORKERS', '16')),
+    thread_name_prefix='quickpage-io'
+)
+s3_transfer_executor = ThreadPoolExecutor(
+    max_workers=int(os.environ.get('S3_TRANSFER_MAX_WORKERS', '16')),
+    thread_name_prefix='quickpage-s3'
+)
+
+# Per-task timeouts (seconds) for the ask fan-out
+HISTORY_TIMEOUT = float(os.environ.get('HISTORY_TIMEOUT_SECONDS', '5'))
+CURRENT_PAGE_TIMEOUT = float(os.environ.get('CURRENT_PAGE_TIMEOUT_SECONDS', '90'))
+PREVIOUS_PAGE_TIMEOUT = float(os.environ.get('PREVIOUS_PAGE_TIMEOUT_SECONDS', '15'))
+IMAGE_TIMEOUT = float(os.environ.get('IMAGE_TIMEOUT_SECONDS', '15'))
+
+# Deferred write pipeline. Index persistence and chat writes are queued here
+# so they run alongside answer generation; lambda_handler drains the queue
+# before the invocation ends so nothing is lost when the container freezes.
+write_executor = ThreadPoolExecutor(
+    max_workers=int(os.environ.get('WRITE_MAX_WORKERS', '4')),
+    thread_name_prefix='quickpage-write'
+)
+WRITE_DRAIN_TIMEOUT = float(os.environ.get('WRITE_DRAIN_TIMEOUT_SECONDS', '30'))
+pending_writes = []
+pending_writes_lock = threading.Lock()
+
+# Background work that runs in this process when there is no Lambda to hand
+# it to (preload jobs, ingestion, delayed orphan checks). The threads are
+# tracked so a long-running server can stop them between steps and wait for
+# them before exiting.
+background_tasks = set()
+background_tasks_lock = threading.Lock()
+background_stopping = threading.Event()
+
+# FAISS index selection by page size: exact flat search for small pages,
+# HNSW for large ones. IVF-PQ trades recall for a much smaller index, so it
+# is kept for pages too big to hold as full vectors.
+FAISS_HNSW_MIN_CHUNKS = int(os.environ.get('FAISS_HNSW_MIN_CHUNKS', '1000'))
+FAISS_IVFPQ_MIN_CHUNKS = int(os.environ.get('FAISS_IVFPQ_MIN_CHUNKS', '50000'))
+
+# Progressive ingestion. Pages with at least PROGRESSIVE_MIN_CHUNKS chunks
+# answer from a partial index built on the highest-priority chunks while the
+# rest is embedded in the background and published as snapshots. Embedding
+# runs on its own pools because page builds already run inside io_executor;
+# background work (preloads, ingestion) gets a separate pool so an ask's
+# first batch never queues behind it.
+PROGRESSIVE_MIN_CHUNKS = int(os.environ.get('PROGRESSIVE_MIN_CHUNKS', '64'))
+PROGRESSIVE_FIRST_BATCH = int(os.environ.get('PROGRESSIVE_FIRST_BATCH', '32'))
+PROGRESSIVE_BATCH = int(os.environ.get('PROGRESSIVE_BATCH', '64'))
+PROGRESSIVE_SNAPSHOT_EVERY = int(os.environ.get('PROGRESSIVE_SNAPSHOT_EVERY', '256'))
+PROGRESSIVE_TOP_CHUNKS = int(os.environ.get('PROGRESSIVE_TOP_CHUNKS', '8'))
+PROGRESSIVE_VISIBLE_CHUNKS = int(os.environ.get('PROGRESSIVE_VISIBLE_CHUNKS', '8'))
+PROGRESSIVE_STALE_SECONDS = int(os.environ.get('PROGRESSIVE_STALE_SECONDS', '300'))
+EMBED_MAX_WORKERS = int(os.environ.get('EMBED_MAX_WORKERS', '8'))
+embed_executor = ThreadPoolExecutor(
+    max_workers=EMBED_MAX_WORKERS,
+    thread_name_prefix='quickpage-embed'
+)
+background_embed_executor = ThreadPoolExecutor(
+    max_workers=EMBED_MAX_WORKERS,
+    thread_name_prefix='quickpage-embed-bg'
+)
+
+# Opt-in memory profiling. When enabled, tracemalloc runs for every
+# invocation and the latency metric line gains a per-stage memory report.
+# tracing slows allocation-heavy code noticeably, so leave it off in
+# production.
+MEMORY_PROFILING = os.environ.get('MEMORY_PROFILING', 'false').lower() == 'true'
+memory_stages = []
+memory_stages_lock = threading.Lock()
+memory_active_stages = [0]
+
+# In-memory cache of complete page indexes, most recently used last. The
+# long-running server (server.py) answers repeat pages without reloading the
+# index from /tmp or S3. It is bounded by the estimated FAISS index size, not
+# the index count, since one large page can outweigh hundreds of small ones.
+# Off by default so a Lambda container's memory stays with the request.
+INDEX_CACHE_MAX_BYTES = int(os.environ.get('INDEX_CACHE_MAX_BYTES', '0'))
+index_cache = OrderedDict()
+index_cache_bytes = [0]
+index_cache_lock = threading.Lock()
+
+# Page text is hashed in slices so no full-size UTF-8 copy is made
+HASH_SLICE_CHARS = 1 << 20
+
+# Session page manifests live in cache_table as session#<id> items. Each ask
+# searches at most SESSION_MAX_PREVIOUS_PAGES earlier pages, picked by
+# recency and by overlap between the question and each page's keywords.
+SESSION_MAX_PREVIOUS_PAGES = int(os.environ.get('SESSION_MAX_PREVIOUS_PAGES', '5'))
+SESSION_PAGE_KEYWORDS = int(os.environ.get('SESSION_PAGE_KEYWORDS', '12'))
+# Pages kept per manifest; the least recently visited are dropped past this
+SESSION_MANIFEST_MAX_PAGES = int(os.environ.get('SESSION_MANIFEST_MAX_PAGES', '50'))
+KEYWORD_STOPWORDS = frozenset((
+    'about', 'after', 'also', 'been', 'before', 'being', 'between', 'both', 'could', 'does',
+    'each', 'from', 'have', 'here', 'into', 'just', 'like', 'more', 'most', 'only', 'other',
+    'over', 'same', 'some', 'such', 'than', 'that', 'their', 'them', 'then', 'there', 'these',
+    'they', 'this', 'those', 'through', 'very', 'were', 'what', 'when', 'where', 'which',
+    'while', 'will', 'with', 'would', 'your'
+))
+
+# Shared secret carried by async self-invocations (runPreloadJob,
+# continueIngestion). Internal actions are refused without it, so a client
+# cannot trigger them through a non-proxy API Gateway integration. Required
+# in Lambda: a background thread would be frozen with the container as soon
+# as the response returns. Outside Lambda those jobs run in threads.
+INTERNAL_INVOKE_SECRET = os.environ.get('INTERNAL_INVOKE_SECRET', '')
+if os.environ.get('AWS_LAMBDA_FUNCTION_NAME') and not INTERNAL_INVOKE_SECRET:
+    print(json.dumps({
+        'event': 'config_error',
+        'message': 'INTERNAL_INVOKE_SECRET is not set: preload jobs and long-page ingestion are disabled'
+    }))
+
+# askBatch limits
+BATCH_MAX_PROMPTS = int(os.environ.get('BATCH_MAX_PROMPTS', '10'))
+BATCH_MAX_CONCURRENCY = int(os.environ.get('BATCH_MAX_CONCURRENCY', '4'))
+
+# preloadBatch limits; PRELOAD_EMBED_CONCURRENCY is how many pages embed at once
+PRELOAD_MAX_PAGES = int(os.environ.get('PRELOAD_MAX_PAGES', '100'))
+PRELOAD_EMBED_CONCURRENCY = int(os.environ.get('PRELOAD_EMBED_CONCURRENCY', '4'))
+
+# Parallel BatchWriteItem workers for session deletion, and how many times
+# each batch retries unprocessed (throttled) deletes before giving up
+DELETE_MAX_WORKERS = int(os.environ.get('DELETE_MAX_WORKERS', '8'))
+DELETE_MAX_ATTEMPTS = int(os.environ.get('DELETE_MAX_ATTEMPTS', '8'))
+
+# The cache sweep (sweepCache, run on a schedule) deletes S3 index versions
+# no cache item refers to once they are older than this: superseded
+# snapshots, expired pages and builds that failed mid-upload
+INDEX_SWEEP_GRACE_SECONDS = int(os.environ.get('INDEX_SWEEP_GRACE_SECONDS', '3600'))
+# Cache items of complete indexes expire this long after their last use
+INDEX_TTL_SECONDS = 7 * 24 * 60 * 60
+
+# Page caches a deletion may have orphaned are checked by the first cache
+# sweep at least this long after it, once the contentHash index has caught
+# up, and only pages idle for at least ORPHAN_MIN_IDLE_SECONDS are removed
+ORPHAN_CLEANUP_DELAY_SECONDS = int(os.environ.get('ORPHAN_CLEANUP_DELAY_SECONDS', '60'))
+ORPHAN_MIN_IDLE_SECONDS = int(os.environ.get('ORPHAN_MIN_IDLE_SECONDS', '3600'))
+
 
 def verify_cognito_token(token):
     """Verify and decode Cognito JWT token."""
@@ -89,6 +534,177 @@ def verify_cognito_token(token):
         return None
 
 
+def wait_for_result(future, deadline, default=None):
+    """Wait for a future until the deadline, returning default on timeout or failure."""
+    try:
+        return future.result(timeout=max(0, deadline - time.monotonic()))
+    except Exception:
+        return default
+
+
+def defer_write(name, fn, *args, **kwargs):
+    """Queue a persistence task to run off the response path."""
+    def run():
+        start = time.monotonic()
+        try:
+            with memory_stage(f'write:{name}'):
+                fn(*args, **kwargs)
+            ok = True
+        except Exception:
+            ok = False
+        return {'name': name, 'ok': ok, 'ms': int((time.monotonic() - start) * 1000)}
+
+    future = write_executor.submit(run)
+    with pending_writes_lock:
+        pending_writes.append(future)
+    return future
+
+
+def drain_pending_writes(timeout=WRITE_DRAIN_TIMEOUT):
+    """Wait for queued writes to finish and return their latency stats."""
+    with pending_writes_lock:
+        futures = list(pending_writes)
+        pending_writes.clear()
+    if not futures:
+        return {'writes': [], 'pending': 0}
+
+    done, not_done = wait(futures, timeout=timeout)
+    # Anything still running is kept so the next drain picks it up
+    with pending_writes_lock:
+        pending_writes.extend(not_done)
+    return {'writes': [f.result() for f in done], 'pending': len(not_done)}
+
+
+class BackgroundWorkStopped(Exception):
+    """Raised inside background work once stop_background_tasks was called."""
+
+
+def start_background_task(name, fn, *args):
+    """Run fn(*args) on a tracked daemon thread."""
+    def run():
+        try:
+            fn(*args)
+        except BackgroundWorkStopped:
+            print(json.dumps({'event': 'background_task_stopped', 'task': name}))
+        except Exception as e:
+            print(json.dumps({'event': 'background_task_failed', 'task': name, 'error': str(e)}))
+        finally:
+            with background_tasks_lock:
+                background_tasks.discard(thread)
+    
+    thread = threading.Thread(target=run, name=f"quickpage-{name}", daemon=True)
+    with background_tasks_lock:
+        background_tasks.add(thread)
+    thread.start()
+    return thread
+
+
+def stop_background_tasks(timeout=None):
+    """Ask background tasks to stop at their next step and wait for them.
+
+    Returns the names of the tasks still running after timeout.
+    """
+    background_stopping.set()
+    deadline = None if timeout is None else time.monotonic() + timeout
+    with background_tasks_lock:
+        threads = list(background_tasks)
+    for thread in threads:
+        thread.join(None if deadline is None else max(0, deadline - time.monotonic()))
+    return [thread.name for thread in threads if thread.is_alive()]
+
+
+def read_rss_kb():
+    """Current resident set size of this process in KB (0 if unavailable)."""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') // 1024
+    except Exception:
+        return 0
+
+
+def start_memory_profile():
+    """Start tracing for one invocation and forget the previous invocation's stages."""
+    if not tracemalloc.is_tracing():
+        tracemalloc.start()
+    tracemalloc.reset_peak()
+    with memory_stages_lock:
+        memory_stages.clear()
+        memory_active_stages[0] = 0
+
+
+def memory_stage(name):
+    """Context manager recording the memory a stage allocated and its peak.
+
+    A no-op unless MEMORY_PROFILING is on. Stages run concurrently on the
+    I/O pools, so the peak of overlapping stages covers all of them; the
+    peak counter is only reset when a stage starts with no other stage open.
+    """
+    class _Stage:
+        def __enter__(self):
+            if not tracemalloc.is_tracing():
+                self.start = None
+                return
+            with memory_stages_lock:
+                if memory_active_stages[0] == 0:
+                    tracemalloc.reset_peak()
+                memory_active_stages[0] += 1
+            self.start, _ = tracemalloc.get_traced_memory()
+            self.started = time.monotonic()
+
+        def __exit__(self, *exc):
+            if self.start is None:
+                return
+            current, peak = tracemalloc.get_traced_memory()
+            with memory_stages_lock:
+                memory_active_stages[0] -= 1
+                memory_stages.append({
+                    'stage': name,
+                    'ms': int((time.monotonic() - self.started) * 1000),
+                    'allocatedKb': (current - self.start) // 1024,
+                    'peakKb': peak // 1024,
+                    'rssKb': read_rss_kb()
+                })
+
+    return _Stage()
+
+
+def run_stage(name, fn, *args, **kwargs):
+    """Call fn inside a memory_stage; used for work submitted to the pools."""
+    with memory_stage(name):
+        return fn(*args, **kwargs)
+
+
+def memory_profile_report():
+    """Per-stage memory report for the metric line, or None when profiling is off."""
+    if not tracemalloc.is_tracing():
+        return None
+    current, peak = tracemalloc.get_traced_memory()
+    with memory_stages_lock:
+        stages = list(memory_stages)
+    return {
+        'stages': stages,
+        'tracedKb': current // 1024,
+        'peakKb': peak // 1024,
+        'rssKb': read_rss_kb()
+    }
+
+
+def content_hash_of(text: str):
+    """SHA-256 of text's UTF-8 encoding, without encoding the whole text at once."""
+    digest = hashlib.sha256()
+    for start in range(0, len(text), HASH_SLICE_CHARS):
+        digest.update(text[start:start + HASH_SLICE_CHARS].encode('utf-8'))
+    return digest.hexdigest()
+
+
+def is_conditional_check_failure(error):
+    """True if a DynamoDB write was rejected by its ConditionExpression."""
+    return (
+        isinstance(error, ClientError)
+        and error.response.get('Error', {}).get('Code') == 'ConditionalCheckFailedException'
+    )
+
+
 def make_bedrock_llm(streaming=False):
     """Create a LangChain ChatBedrock LLM wrapper around Llama 3.2 90B."""
     return ChatBedrock(
@@ -102,14 +718,250 @@ def make_bedrock_llm(streaming=False):
     )
 
 
+def index_memory_bytes(vector_store, params):
+    """Estimate the resident size of a FAISS index from its type and vector count."""
+    index = vector_store.index
+    count, dimension = index.ntotal, index.d
+    if params.get('type') == 'ivfpq':
+        # PQ codes plus 8-byte ids per vector, coarse centroids, PQ codebooks
+        code_size = getattr(index, 'code_size', params.get('m', dimension))
+        return count * (code_size + 8) + params.get('nlist', 0) * dimension * 4 + 256 * dimension * 4
+    size = count * dimension * 4
+    if params.get('type') == 'hnsw':
+        # Level-0 neighbour lists hold 2*M int32 ids per vector
+        size += count * params.get('M', 32) * 2 * 4
+    return size
+
+
+def cached_index(content_hash):
+    """Return the in-memory (vector store, params) for a hash, or None."""
+    with index_cache_lock:
+        entry = index_cache.get(content_hash)
+        if entry is None:
+            return None
+        index_cache.move_to_end(content_hash)
+        return entry[:2]
+
+
+def remember_index(content_hash, vector_store, params):
+    """Keep a complete index in memory, evicting the least recently used
+    until the cache fits in INDEX_CACHE_MAX_BYTES."""
+    if INDEX_CACHE_MAX_BYTES <= 0 or index_coverage(params) < 1:
+        return
+    try:
+        size = index_memory_bytes(vector_store, params)
+    except Exception as e:
+        print(f"Could not size index {content_hash}, not caching: {str(e)}")
+        return
+    if size > INDEX_CACHE_MAX_BYTES:
+        return
+    with index_cache_lock:
+        previous = index_cache.pop(content_hash, None)
+        if previous is not None:
+            index_cache_bytes[0] -= previous[2]
+        index_cache[content_hash] = (vector_store, params, size)
+        index_cache_bytes[0] += size
+        while index_cache_bytes[0] > INDEX_CACHE_MAX_BYTES:
+            _, (_, _, evicted_size) = index_cache.popitem(last=False)
+            index_cache_bytes[0] -= evicted_size
+
+
+def forget_index(content_hash):
+    """Drop a hash from the in-memory index cache."""
+    with index_cache_lock:
+        entry = index_cache.pop(content_hash, None)
+        if entry is not None:
+            index_cache_bytes[0] -= entry[2]
+
+
+# Index versions. Every persisted index (each progressive snapshot and the
+# final build) gets its own S3 prefix and /tmp directory, so a reader never
+# mixes files from two builds. The cache_table item names the published
+# version; indexes cached before versioning live directly under the hash
+# prefix and are read as version 'legacy'.
+INDEX_FILES = ('index.faiss', 'index.pkl', 'index_params.json')
+
+
+def index_prefix(content_hash, version):
+    """S3 prefix holding one version of a page index."""
+    if version == 'legacy':
+        return f"embeddings/{content_hash}"
+    return f"embeddings/{content_hash}/{version}"
+
+
+def local_index_dir(content_hash, version):
+    return f"/tmp/faiss_{content_hash}/{version}"
+
+
+def read_local_version(content_hash):
+    """Version of the complete index last loaded or built here, or None."""
+    try:
+        with open(f"/tmp/faiss_{content_hash}/CURRENT") as f:
+            return f.read().strip() or None
+    except Exception:
+        return None
+
+
+def write_local_version(content_hash, version):
+    """Point CURRENT at a complete local index version (atomic rename)."""
+    pointer = f"/tmp/faiss_{content_hash}/CURRENT"
+    staging = f"{pointer}.{uuid.uuid4().hex}"
+    with open(staging, 'w') as f:
+        f.write(version)
+    os.replace(staging, pointer)
+
+
+def published_index_version(content_hash):
+    """Version named by the cache table; 'legacy' when the item predates versions."""
+    try:
+        item = cache_table.get_item(
+            Key={'contentHash': content_hash},
+            ConsistentRead=True,
+            ProjectionExpression='indexVersion'
+        ).get('Item')
+    except Exception:
+        item = None
+    return (item or {}).get('indexVersion') or 'legacy'
+
+
+def delete_index_version(content_hash, version):
+    """Remove one superseded index version from S3 and /tmp."""
+    prefix = index_prefix(content_hash, version)
+    s3_client.delete_objects(
+        Bucket=CACHE_BUCKET,
+        Delete={'Objects': [{'Key': f"{prefix}/{name}"} for name in INDEX_FILES]}
+    )
+    shutil.rmtree(local_index_dir(content_hash, version), ignore_errors=True)
+
+
+def sweep_index_versions(grace_seconds=None):
+    """Delete S3 index versions that no cache item refers to.
+
+    Catches what the publish path cannot: versions of items that expired by
+    TTL, and uploads of builds that died before cleaning up. Objects newer
+    than grace_seconds are kept, so uploads in flight are never touched.
+    Returns the number of objects deleted.
+    """
+    cutoff = time.time() - (INDEX_SWEEP_GRACE_SECONDS if grace_seconds is None else grace_seconds)
+    found = {}  # hash -> version -> [(key, last modified)]
+    deleted = 0
+    
+    def delete_unreferenced():
+        items = get_cache_items(list(found), ('indexVersion', 'previousVersion'), consistent=True)
+        stale = []
+        for content_hash, versions in found.items():
+            item = items.get(content_hash)
+            keep = {item.get('indexVersion', 'legacy'), item.get('previousVersion')} if item else set()
+            for version, objects in versions.items():
+                if version not in keep and all(modified < cutoff for _, modified in objects):
+                    stale.extend(key for key, _ in objects)
+        for start in range(0, len(stale), 1000):
+            s3_client.delete_objects(
+                Bucket=CACHE_BUCKET,
+                Delete={'Objects': [{'Key': key} for key in stale[start:start + 1000]]}
+            )
+        found.clear()
+        return len(stale)
+    
+    # Keys are embeddings/<hash>/<version>/<file>, or embeddings/<hash>/<file>
+    # for indexes cached before versioning
+    paginator = s3_client.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=CACHE_BUCKET, Prefix='embeddings/'):
+        for obj in page.get('Contents', []):
+            parts = obj['Key'].split('/')
+            if len(parts) not in (3, 4) or not is_valid_content_hash(parts[1]):
+                continue
+            version = parts[2] if len(parts) == 4 else 'legacy'
+            if parts[1] not in found and len(found) >= 100:
+                deleted += delete_unreferenced()
+            found.setdefault(parts[1], {}).setdefault(version, []).append(
+                (obj['Key'], obj['LastModified'].timestamp())
+            )
+    if found:
+        deleted += delete_unreferenced()
+    return deleted
+
+
+def run_cache_sweep():
+    """Scheduled cache maintenance (the sweepCache action)."""
+    started = time.monotonic()
+    # Orphans first, so the versions of removed pages go in the same run
+    result = {'status': 'done', 'orphansRemoved': cleanup_orphan_candidates()}
+    result['indexObjectsDeleted'] = sweep_index_versions()
+    result['elapsedMs'] = int((time.monotonic() - started) * 1000)
+    print(json.dumps(dict(result, metric='cache_sweep')))
+    return result
+
+
+def prune_local_versions(content_hash, keep):
+    """Remove this container's copies of a hash's index versions other than
+    keep and the one CURRENT names. Downloads and builds still in progress
+    (.part- directories) are left alone."""
+    root = f"/tmp/faiss_{content_hash}"
+    keep = {keep, read_local_version(content_hash)}
+    try:
+        names = os.listdir(root)
+    except OSError:
+        return
+    for name in names:
+        path = f"{root}/{name}"
+        if name in keep or '.part-' in name or not os.path.isdir(path):
+            continue
+        shutil.rmtree(path, ignore_errors=True)
+
+
+def load_local_index(content_hash, version, embeddings):
+    """Load a version from /tmp into a store and its params, or None if absent."""
+    path = local_index_dir(content_hash, version)
+    if not (os.path.exists(f"{path}/index.faiss") and os.path.exists(f"{path}/index.pkl")):
+        return None
+    vector_store = FAISS.load_local(path, embeddings, allow_dangerous_deserialization=True)
+    params = read_index_params(path)
+    apply_search_params(vector_store.index, params)
+    return vector_store, params
+
+
+def download_index_version(content_hash, version):
+    """Fetch a version from S3 into /tmp (all files in parallel).
+
+    Files land in a staging directory that is renamed into place, so a
+    concurrent local reader never sees a half-downloaded version.
+    """
+    prefix = index_prefix(content_hash, version)
+    path = local_index_dir(content_hash, version)
+    staging = f"{path}.part-{uuid.uuid4().hex}"
+    os.makedirs(staging, exist_ok=True)
+    try:
+        downloads = [
+            s3_transfer_executor.submit(s3_client.download_file, CACHE_BUCKET, f"{prefix}/{name}", f"{staging}/{name}")
+            for name in ('index.faiss', 'index.pkl')
+        ]
+        params_download = s3_transfer_executor.submit(
+            s3_client.download_file, CACHE_BUCKET, f"{prefix}/index_params.json", f"{staging}/index_params.json"
+        )
+        for download in downloads:
+            download.result()
+        # Indexes cached before index selection have no params file
+        try:
+            params_download.result()
+        except Exception:
+            pass
+        try:
+            os.rename(staging, path)
+        except OSError:
+            pass  # Another reader already placed this version
+    finally:
+        shutil.rmtree(staging, ignore_errors=True)
+
+
 def load_retriever_from_hash(content_hash: str, page_url: str = None):
     """Attempt to load retriever from cache using content hash."""
     if not content_hash:
         return None
-        
-    s3_key = f"embeddings/{content_hash}/index.faiss"
-    s3_pkl_key = f"embeddings/{content_hash}/index.pkl"
-    temp_path = f"/tmp/faiss_{content_hash}"
+    
+    entry = cached_index(content_hash)
+    if entry is not None:
+        return make_retriever(*entry)
     
     # Initialize embeddings model
     embeddings = BedrockEmbeddings(
@@ -117,689 +969,1818 @@ def load_retriever_from_hash(content_hash: str, page_url: str = None):
         model_id="amazon.titan-embed-text-v2:0",
     )
     
-    # Attempt to load from local temporary storage
-    if os.path.exists(f"{temp_path}/index.faiss") and os.path.exists(f"{temp_path}/index.pkl"):
+    # Attempt to load from local temporary storage. CURRENT only ever names
+    # a complete index, which never changes once published.
+    local_version = read_local_version(content_hash)
+    if local_version:
         try:
-            vector_store = FAISS.load_local(temp_path, embeddings, allow_dangerous_deserialization=True)
-            return vector_store.as_retriever(search_kwargs={"k": 5})
+            loaded = load_local_index(content_hash, local_version, embeddings)
+            if loaded:
+                remember_index(content_hash, *loaded)
+                return make_retriever(*loaded)
         except Exception:
             pass
-            
-    # Attempt to load from S3 storage
+    
+    # Otherwise load the published version (possibly a partial snapshot),
+    # downloading it from S3 unless this container already has it
     try:
-        os.makedirs(temp_path, exist_ok=True)
-        s3_client.download_file(CACHE_BUCKET, s3_key, f"{temp_path}/index.faiss")
-        s3_client.download_file(CACHE_BUCKET, s3_pkl_key, f"{temp_path}/index.pkl")
-        
-        vector_store = FAISS.load_local(temp_path, embeddings, allow_dangerous_deserialization=True)
-        return vector_store.as_retriever(search_kwargs={"k": 5})
+        version = published_index_version(content_hash)
+        loaded = load_local_index(content_hash, version, embeddings)
+        if loaded is None:
+            download_index_version(content_hash, version)
+            loaded = load_local_index(content_hash, version, embeddings)
+        if index_coverage(loaded[1]) >= 1:
+            write_local_version(content_hash, version)
+        # Superseded snapshots would otherwise pile up in /tmp
+        prune_local_versions(content_hash, version)
+        remember_index(content_hash, *loaded)
+        return make_retriever(*loaded)
     except:
         return None
 
-def build_page_retriever(page_text: str, page_url: str = None):
-    """Build retriever with cached embeddings in S3 for fast subsequent queries."""
-    if not page_text:
-        class EmptyRetriever:
-            def get_relevant_documents(self, query):
-                return []
-        return EmptyRetriever()
 
-    # Generate content hash for caching
-    content_hash = hashlib.sha256(page_text.encode('utf-8')).hexdigest()
-    
-    # Attempt to retrieve cached retriever
-    retriever = load_retriever_from_hash(content_hash, page_url=page_url)
-    if retriever:
-        # Update metadata
-        try:
-            cache_table.update_item(
-                Key={'contentHash': content_hash},
-                UpdateExpression='SET lastAccessed = :timestamp, #s = :status',
-                ExpressionAttributeNames={'#s': 'status'},
-                ExpressionAttributeValues={
-                    ':timestamp': int(time.time()),
-                    ':status': 'ready'
-                },
-                ReturnValues='NONE'
-            )
-        except:
-            pass
-        return retriever
-    
-    # Check if build is already IN PROGRESS by another Lambda (e.g. preload)
-    try:
-        response = cache_table.get_item(
-            Key={'contentHash': content_hash},
-            ConsistentRead=True
-        )
-        item = response.get('Item')
-        
-        if item and item.get('status') == 'processing':
-            # Check if processing is stale (older than 2 minutes)
-            start_time = item.get('createdAt', 0)
-            if int(time.time()) - start_time < 120:
-                # Wait for concurrent processing to complete (maximum 30 seconds)
-                for _ in range(30):
-                    time.sleep(1)
-                    if load_retriever_from_hash(content_hash):
-                        return load_retriever_from_hash(content_hash)
-    except Exception as e:
-        pass
+def choose_index_params(num_chunks: int, dimension: int):
+    """Pick a FAISS index type and tuned parameters for a page of num_chunks."""
+    if num_chunks < FAISS_HNSW_MIN_CHUNKS:
+        return {'type': 'flat'}
+    if num_chunks < FAISS_IVFPQ_MIN_CHUNKS:
+        return {'type': 'hnsw', 'M': 32, 'efConstruction': 80, 'efSearch': 128}
     
-    # Mark as PROCESSING
+    # ~4*sqrt(n) lists; PQ splits vectors into at most 64 sub-quantizers of
+    # 8 bits each, so the sub-vector count has to divide the dimension
+    nlist = int(4 * math.sqrt(num_chunks))
+    m = max(d for d in range(1, 65) if dimension % d == 0)
+    return {'type': 'ivfpq', 'nlist': nlist, 'm': m, 'nbits': 8, 'nprobe': max(8, nlist // 8)}
+
+
+def create_faiss_index(params, vectors):
+    """Create (and train, for IVF-PQ) an empty FAISS index for the given params."""
+    dimension = vectors.shape[1]
+    if params['type'] == 'hnsw':
+        index = faiss.IndexHNSWFlat(dimension, params['M'])
+        index.hnsw.efConstruction = params['efConstruction']
+    elif params['type'] == 'ivfpq':
+        quantizer = faiss.IndexFlatL2(dimension)
+        index = faiss.IndexIVFPQ(quantizer, dimension, params['nlist'], params['m'], params['nbits'])
+        # Training on a sample keeps k-means time bounded on huge pages
+        sample_size = min(len(vectors), 64 * params['nlist'])
+        sample = np.random.default_rng(0).choice(len(vectors), sample_size, replace=False)
+        index.train(vectors[sample])
+    else:
+        index = faiss.IndexFlatL2(dimension)
+    apply_search_params(index, params)
+    return index
+
+
+def apply_search_params(index, params):
+    """Set search-time parameters that faiss does not keep in the index file."""
+    if params.get('type') == 'hnsw':
+        index.hnsw.efSearch = params['efSearch']
+    elif params.get('type') == 'ivfpq':
+        index.nprobe = params['nprobe']
+
+
+def read_index_params(path: str):
+    """Read index params saved next to a cached index; flat if there are none."""
     try:
-        cache_table.put_item(
-            Item={
-                'contentHash': content_hash,
-                'status': 'processing',
-                'createdAt': int(time.time()),
-                'ttl': int(time.time()) + 3600
-            }
-        )
-    except:
-        pass
+        with open(f"{path}/index_params.json") as f:
+            return json.load(f)
+    except Exception:
+        return {'type': 'flat'}
+
+
+def build_vector_store(chunks, embeddings):
+    """Embed chunks and index them with the FAISS index type chosen for their count."""
+    indices = list(range(len(chunks)))
+    vectors = dict(zip(indices, embed_chunk_batch(embeddings, chunks, indices)))
+    return index_vectors(chunks, vectors, embeddings)
+
+
+def index_vectors(chunks, vectors, embeddings):
+    """Build a FAISS store from the chunks embedded so far.
+
+    vectors maps chunk position -> embedding. A partial set always gets a
+    flat index (cheap to rebuild per snapshot); a complete set gets the index
+    type chosen for the page size. The params record the coverage.
+    """
+    positions = sorted(vectors)
+    matrix = np.array([vectors[i] for i in positions], dtype='float32')
+    if len(positions) < len(chunks):
+        params = {'type': 'flat'}
+    else:
+        params = choose_index_params(len(chunks), matrix.shape[1])
+    params['embeddedChunks'] = len(positions)
+    params['numChunks'] = len(chunks)
     
-    # Initialize embeddings model
-    embeddings = BedrockEmbeddings(
-        client=bedrock_runtime,
-        model_id="amazon.titan-embed-text-v2:0",
+    vector_store = FAISS(
+        embedding_function=embeddings,
+        index=create_faiss_index(params, matrix),
+        docstore=InMemoryDocstore(),
+        index_to_docstore_id={}
     )
-    
-    # Split text into chunks for processing
+    vector_store.add_embeddings(
+        [(chunks[i], vectors[i]) for i in positions],
+        metadatas=[{'chunk': i} for i in positions]
+    )
+    return vector_store, params
+
+
+def index_coverage(params):
+    """Fraction of the page's chunks present in an index (1.0 if unknown)."""
+    num_chunks = params.get('numChunks')
+    if not num_chunks:
+        return 1.0
+    return params.get('embeddedChunks', num_chunks) / num_chunks
+
+
+def make_retriever(vector_store, params):
+    """Wrap a store as a k=5 retriever that carries the index coverage."""
+    return vector_store.as_retriever(
+        search_kwargs={"k": 5},
+        metadata={'coverage': index_coverage(params)}
+    )
+
+
+def retriever_coverage(retriever):
+    """Coverage a retriever was built with; 1.0 for complete or unknown indexes."""
+    return (getattr(retriever, 'metadata', None) or {}).get('coverage', 1.0)
+
+
+def split_page_text(page_text: str):
+    """Split page text into the chunks that get embedded."""
     splitter = RecursiveCharacterTextSplitter(
         chunk_size=1200,
         chunk_overlap=120,
         separators=["\n\n", "\n", ". ", " "],
     )
-    chunks = splitter.split_text(page_text)
+    return splitter.split_text(page_text)
+
+
+def embed_chunk_batch(embeddings, chunks, indices):
+    """Embed the chunks at the given positions, split across the embedding pool.
+
+    The slices run in the caller's Bedrock lane, on the pool for that lane.
+    """
+    texts = [chunks[i] for i in indices]
+    if not texts:
+        return []
+    if bedrock_limiter.current_lane() == 'background':
+        pool = background_embed_executor
+    else:
+        pool = embed_executor
+    embed_documents = bedrock_limiter.bind_lane(embeddings.embed_documents)
+    step = max(1, math.ceil(len(texts) / EMBED_MAX_WORKERS))
+    futures = [
+        pool.submit(embed_documents, texts[start:start + step])
+        for start in range(0, len(texts), step)
+    ]
+    vectors = []
+    for future in futures:
+        vectors.extend(future.result())
+    return vectors
+
+
+def prioritize_chunks(chunks, question=None, scroll_ratio=None):
+    """Order chunk positions for progressive embedding.
+
+    The top of the page comes first, then the section that was on screen,
+    then chunks sharing rare words with the pending question, then the rest
+    in document order.
+    """
+    n = len(chunks)
+    order = list(range(min(PROGRESSIVE_TOP_CHUNKS, n)))
+    
+    if scroll_ratio is not None:
+        try:
+            center = int(min(max(float(scroll_ratio), 0.0), 1.0) * n)
+            half = PROGRESSIVE_VISIBLE_CHUNKS // 2
+            order.extend(range(max(0, center - half), min(n, center + half + 1)))
+        except (TypeError, ValueError):
+            pass
+    
+    terms = set(re.findall(r'\w{3,}', question.lower())) if question else set()
+    if terms:
+        chunk_terms = [set(re.findall(r'\w{3,}', chunk.lower())) & terms for chunk in chunks]
+        doc_freq = {t: sum(1 for ct in chunk_terms if t in ct) for t in terms}
+        scores = [
+            (sum(math.log(1 + n / doc_freq[t]) for t in ct), i)
+            for i, ct in enumerate(chunk_terms) if ct
+        ]
+        scores.sort(key=lambda s: -s[0])
+        order.extend(i for _, i in scores[:PROGRESSIVE_FIRST_BATCH])
+    
+    order.extend(range(n))
+    return list(dict.fromkeys(order))
+
+
+def continue_ingestion(content_hash, chunks, order, vectors, embeddings):
+    """Embed the remaining chunks in order, publishing snapshots, then the final index.
+
+    Returns None, without embedding the rest, as soon as another build
+    (a preload, or a restart racing a slow builder) has published a
+    complete index: persist_page_index would throw this one away anyway.
+    """
+    remaining = [i for i in order if i not in vectors]
+    since_snapshot = 0
+    for start in range(0, len(remaining), PROGRESSIVE_BATCH):
+        if background_stopping.is_set():
+            # Keep the progress made so far for whoever resumes the build
+            if since_snapshot:
+                vector_store, params = index_vectors(chunks, vectors, embeddings)
+                persist_page_index(vector_store, content_hash, len(chunks), params)
+            raise BackgroundWorkStopped(f"build of {content_hash} stopped at {len(vectors)}/{len(chunks)} chunks")
+        if is_index_ready(content_hash):
+            print(f"Index {content_hash} was completed elsewhere; stopping this build")
+            return None
+        batch = remaining[start:start + PROGRESSIVE_BATCH]
+        vectors.update(zip(batch, embed_chunk_batch(embeddings, chunks, batch)))
+        since_snapshot += len(batch)
+        if since_snapshot >= PROGRESSIVE_SNAPSHOT_EVERY and len(vectors) < len(chunks):
+            vector_store, params = index_vectors(chunks, vectors, embeddings)
+            persist_page_index(vector_store, content_hash, len(chunks), params)
+            since_snapshot = 0
+    
+    vector_store, params = index_vectors(chunks, vectors, embeddings)
+    persist_page_index(vector_store, content_hash, len(chunks), params)
+    return vector_store, params
+
+
+def snapshot_vectors(vector_store):
+    """Recover chunk position -> embedding from a published partial snapshot."""
+    vectors = {}
+    for position, doc_id in vector_store.index_to_docstore_id.items():
+        doc = vector_store.docstore.search(doc_id)
+        chunk = getattr(doc, 'metadata', {}).get('chunk')
+        if chunk is not None:
+            vectors[chunk] = vector_store.index.reconstruct(position).tolist()
+    return vectors
+
+
+def resume_ingestion(content_hash, page_text=None):
+    """Finish a progressive build from its latest snapshot (async worker)."""
+    staged_key = f"ingest/{content_hash}.txt"
+    
+    # Nothing to do if the published index is already complete
+    snapshot = load_retriever_from_hash(content_hash)
+    if (snapshot is not None and retriever_coverage(snapshot) >= 1) or is_index_ready(content_hash):
+        delete_staged_text(staged_key)
+        return {'status': 'done', 'contentHash': content_hash, 'skipped': 'already_ready'}
+    
+    if page_text is None:
+        page_text = s3_client.get_object(Bucket=CACHE_BUCKET, Key=staged_key)['Body'].read().decode('utf-8')
+    
+    embeddings = BedrockEmbeddings(
+        client=bedrock_runtime,
+        model_id="amazon.titan-embed-text-v2:0",
+    )
+    chunks = split_page_text(page_text)
+    
+    vectors = {}
+    if snapshot is not None:
+        try:
+            vectors = snapshot_vectors(snapshot.vectorstore)
+        except Exception:
+            vectors = {}
+    
+    with bedrock_limiter.lane('background'):
+        continue_ingestion(content_hash, chunks, prioritize_chunks(chunks), vectors, embeddings)
+    delete_staged_text(staged_key)
+    return {'status': 'done', 'contentHash': content_hash}
+
+
+def delete_staged_text(staged_key):
+    try:
+        s3_client.delete_object(Bucket=CACHE_BUCKET, Key=staged_key)
+    except Exception:
+        pass
+
+
+def hand_off_ingestion(content_hash, page_text):
+    """Continue a progressive build outside this request.
+
+    In Lambda the page text is staged in S3 and an async self-invocation
+    picks it up; elsewhere a background thread does the work.
+    """
+    def stage_text():
+        s3_client.put_object(
+            Bucket=CACHE_BUCKET,
+            Key=f"ingest/{content_hash}.txt",
+            Body=page_text.encode('utf-8')
+        )
+    
+    try:
+        invoked = invoke_self_async({'action': 'continueIngestion', 'content_hash': content_hash}, stage=stage_text)
+    except InternalInvokeNotConfigured as e:
+        # The published snapshot stays searchable; the page is left partial
+        print(f"Ingestion of {content_hash} stopped after its first snapshot: {str(e)}")
+        return
+    if not invoked:
+        start_background_task(f"ingest-{content_hash[:12]}", resume_ingestion, content_hash, page_text)
+
+
+def publish_partial_and_hand_off(vector_store, content_hash, num_chunks, index_params, page_text):
+    """Publish the first snapshot, then hand the rest of the build off.
+
+    Runs as one deferred task so the hand-off never overtakes (and gets
+    overwritten by) this snapshot.
+    """
+    persist_page_index(vector_store, content_hash, num_chunks, index_params)
+    hand_off_ingestion(content_hash, page_text)
+
+
+class InternalInvokeNotConfigured(Exception):
+    """Raised in Lambda when background work needs a self-invocation but
+    INTERNAL_INVOKE_SECRET is not set."""
+
+
+def lambda_function_name(context=None):
+    """Name of the running Lambda function, or None outside Lambda."""
+    return getattr(context, 'function_name', None) or os.environ.get('AWS_LAMBDA_FUNCTION_NAME')
+
+
+def invoke_self_async(payload, stage=None, context=None):
+    """Run an internal action in an async invocation of this function.
+
+    Returns False when not running in Lambda so callers can fall back to a
+    local thread. In Lambda without INTERNAL_INVOKE_SECRET it raises
+    InternalInvokeNotConfigured instead: a thread would be frozen with the
+    container. stage() runs first, only when the invocation will happen.
+    """
+    function_name = lambda_function_name(context)
+    if not function_name:
+        return False
+    if not INTERNAL_INVOKE_SECRET:
+        raise InternalInvokeNotConfigured('INTERNAL_INVOKE_SECRET is not set on this function')
+    if stage:
+        stage()
+    lambda_client.invoke(
+        FunctionName=function_name,
+        InvocationType='Event',
+        Payload=json.dumps(dict(payload, internal_secret=INTERNAL_INVOKE_SECRET)).encode('utf-8')
+    )
+    return True
+
+
+def build_page_retriever(page_text: str, page_url: str = None, question: str = None,
+                         scroll_ratio=None, wait_for_full: bool = False, content_hash: str = None):
+    """Build retriever with cached embeddings in S3 for fast subsequent queries.
+
+    Long pages are ingested progressively: the chunks most likely to matter
+    (page top, visible section, words from the question) are embedded first
+    and the retriever is returned from that partial index, carrying its
+    coverage. The rest of the build continues in the background, publishing
+    snapshots other invocations can search. With wait_for_full the whole
+    build runs here instead (preloading).
+    """
+    if not page_text:
+        class EmptyRetriever:
+            def get_relevant_documents(self, query):
+                return []
+        return EmptyRetriever()
+
+    # Generate content hash for caching (callers that already hashed pass it)
+    content_hash = content_hash or content_hash_of(page_text)
+    
+    # Attempt to retrieve cached retriever (possibly a partial snapshot)
+    retriever = load_retriever_from_hash(content_hash, page_url=page_url)
+    if retriever:
+        # Update metadata; only a complete index may mark the entry ready
+        try:
+            if retriever_coverage(retriever) >= 1:
+                # Pages in use keep their index: the TTL restarts on access.
+                # The condition keeps an expired item from being recreated
+                # without the version it points at.
+                cache_table.update_item(
+                    Key={'contentHash': content_hash},
+                    UpdateExpression='SET lastAccessed = :timestamp, #s = :status, #ttl = :ttl',
+                    ConditionExpression='attribute_exists(contentHash)',
+                    ExpressionAttributeNames={'#s': 'status', '#ttl': 'ttl'},
+                    ExpressionAttributeValues={
+                        ':timestamp': int(time.time()),
+                        ':status': 'ready',
+                        ':ttl': int(time.time()) + INDEX_TTL_SECONDS
+                    },
+                    ReturnValues='NONE'
+                )
+            else:
+                # Restart the background build unless one is visibly alive:
+                # a fresh partial snapshot or a fresh processing marker. A
+                # failed, expired or stalled build is resumed from the
+                # snapshot; the condition lets only one caller claim it.
+                stale = int(time.time()) - PROGRESSIVE_STALE_SECONDS
+                cache_table.update_item(
+                    Key={'contentHash': content_hash},
+                    UpdateExpression='SET lastAccessed = :timestamp, snapshotAt = :timestamp, #s = :partial, #ttl = :ttl',
+                    ConditionExpression=(
+                        'attribute_not_exists(#s) OR #s = :failed'
+                        ' OR (#s = :partial AND (attribute_not_exists(snapshotAt) OR snapshotAt < :stale))'
+                        ' OR (#s = :processing AND createdAt < :stale)'
+                    ),
+                    ExpressionAttributeNames={'#s': 'status', '#ttl': 'ttl'},
+                    ExpressionAttributeValues={
+                        ':timestamp': int(time.time()),
+                        ':ttl': int(time.time()) + 3600,
+                        ':partial': 'partial',
+                        ':failed': 'failed',
+                        ':processing': 'processing',
+                        ':stale': stale
+                    },
+                    ReturnValues='NONE'
+                )
+                hand_off_ingestion(content_hash, page_text)
+        except:
+            pass
+        return retriever
+    
+    # Check if build is already IN PROGRESS by another Lambda (e.g. preload).
+    # Progressive builds publish a first snapshot within seconds.
+    try:
+        response = cache_table.get_item(
+            Key={'contentHash': content_hash},
+            ConsistentRead=True
+        )
+        item = response.get('Item')
+        
+        if item and item.get('status') == 'processing':
+            # Check if processing is stale (older than 2 minutes)
+            start_time = item.get('createdAt', 0)
+            if int(time.time()) - start_time < 120:
+                # Wait for concurrent processing to publish (maximum 30 seconds)
+                for _ in range(30):
+                    time.sleep(1)
+                    retriever = load_retriever_from_hash(content_hash)
+                    if retriever:
+                        return retriever
+    except Exception as e:
+        pass
+    
+    # Mark as PROCESSING (never overwrite an index another invocation finished)
+    try:
+        cache_table.put_item(
+            Item={
+                'contentHash': content_hash,
+                'status': 'processing',
+                'createdAt': int(time.time()),
+                'ttl': int(time.time()) + 3600
+            },
+            ConditionExpression='attribute_not_exists(contentHash) OR #s <> :ready',
+            ExpressionAttributeNames={'#s': 'status'},
+            ExpressionAttributeValues={':ready': 'ready'}
+        )
+    except:
+        pass
+    
+    # Initialize embeddings model
+    embeddings = BedrockEmbeddings(
+        client=bedrock_runtime,
+        model_id="amazon.titan-embed-text-v2:0",
+    )
+    
+    # Split text into chunks for processing
+    chunks = split_page_text(page_text)
+
+    # Short pages: build the FAISS vector store in one go
+    if len(chunks) < PROGRESSIVE_MIN_CHUNKS:
+        vector_store, index_params = build_vector_store(chunks, embeddings)
+        
+        # Persist the FAISS index in the background; the in-memory retriever
+        # is usable right away
+        defer_write('page_index', persist_page_index, vector_store, content_hash, len(chunks), index_params)
+        return make_retriever(vector_store, index_params)
+    
+    # Long pages: embed the highest-priority chunks first
+    order = prioritize_chunks(chunks, question=question, scroll_ratio=scroll_ratio)
+    first = order[:PROGRESSIVE_FIRST_BATCH]
+    vectors = dict(zip(first, embed_chunk_batch(embeddings, chunks, first)))
+    vector_store, index_params = index_vectors(chunks, vectors, embeddings)
+    
+    if wait_for_full:
+        persist_page_index(vector_store, content_hash, len(chunks), index_params)
+        finished = continue_ingestion(content_hash, chunks, order, vectors, embeddings)
+        if finished is None:
+            # Another build completed the index first; use that one
+            return load_retriever_from_hash(content_hash) or make_retriever(vector_store, index_params)
+        return make_retriever(*finished)
+    
+    defer_write(
+        'page_index_partial',
+        publish_partial_and_hand_off,
+        vector_store, content_hash, len(chunks), index_params, page_text
+    )
+    return make_retriever(vector_store, index_params)
+
+
+def persist_page_index(vector_store, content_hash: str, num_chunks: int, index_params=None):
+    """Save a built FAISS index to /tmp and S3 and record it in the cache table.
+
+    The index is written as a new version and only becomes visible when the
+    cache table item is switched to it, after all of its files are uploaded.
+    A complete index is marked ready; a progressive snapshot is marked
+    partial and is never written over an index that is already ready.
+    A build that fails before publishing removes its own files.
+    """
+    index_params = index_params or {'type': 'flat'}
+    partial = index_coverage(index_params) < 1
+    version = f"{int(time.time() * 1000)}-{uuid.uuid4().hex[:8]}"
+    temp_path = local_index_dir(content_hash, version)
+    staging = f"{temp_path}.part-{uuid.uuid4().hex}"
+    prefix = index_prefix(content_hash, version)
+    published = False
+    
+    if partial and is_index_ready(content_hash):
+        return
+    
+    try:
+        os.makedirs(staging, exist_ok=True)
+        # Params go first so a local load never sees the index without them
+        with open(f"{staging}/index_params.json", 'w') as f:
+            json.dump(index_params, f)
+        vector_store.save_local(staging)
+        
+        # upload_file raises on failure, so no head_object check is needed
+        uploads = [
+            s3_transfer_executor.submit(s3_client.upload_file, f"{staging}/{name}", CACHE_BUCKET, f"{prefix}/{name}")
+            for name in INDEX_FILES
+        ]
+        for upload in uploads:
+            upload.result()
+        os.rename(staging, temp_path)
+        
+        # Save metadata to DynamoDB. The condition makes the write idempotent:
+        # if another invocation already marked this hash ready, keep its item.
+        item = {
+            'contentHash': content_hash,
+            'status': 'partial' if partial else 'ready',
+            's3Key': f"{prefix}/index.faiss",
+            'indexVersion': version,
+            'createdAt': int(time.time()),
+            'lastAccessed': int(time.time()),
+            'numChunks': num_chunks,
+            'indexType': index_params['type'],
+            'ttl': int(time.time()) + INDEX_TTL_SECONDS
+        }
+        if partial:
+            item['embeddedChunks'] = index_params['embeddedChunks']
+            item['snapshotAt'] = int(time.time())
+        try:
+            previous = cache_table.put_item(
+                Item=item,
+                ConditionExpression='attribute_not_exists(contentHash) OR #s <> :ready',
+                ExpressionAttributeNames={'#s': 'status'},
+                ExpressionAttributeValues={':ready': 'ready'},
+                ReturnValues='ALL_OLD'
+            ).get('Attributes', {})
+        except ClientError as e:
+            if not is_conditional_check_failure(e):
+                raise
+            # Another build published first; this version is never read
+            try:
+                delete_index_version(content_hash, version)
+            except Exception:
+                pass
+            return
+        published = True
+        
+        # The version just replaced may still be mid-download by a reader,
+        # so it is kept; the one before it is not reachable any more
+        stale_version = previous.get('previousVersion')
+        if previous.get('indexVersion'):
+            try:
+                cache_table.update_item(
+                    Key={'contentHash': content_hash},
+                    UpdateExpression='SET previousVersion = :v',
+                    ConditionExpression='indexVersion = :current',
+                    ExpressionAttributeValues={':v': previous['indexVersion'], ':current': version}
+                )
+            except ClientError as e:
+                # A newer version was published meanwhile and tracks its own
+                if not is_conditional_check_failure(e):
+                    raise
+        if stale_version and stale_version != version:
+            try:
+                delete_index_version(content_hash, stale_version)
+            except Exception:
+                pass
+        
+        if not partial:
+            write_local_version(content_hash, version)
+        prune_local_versions(content_hash, version)
+        remember_index(content_hash, vector_store, index_params)
+    except Exception as e:
+        shutil.rmtree(staging, ignore_errors=True)
+        if not published:
+            try:
+                delete_index_version(content_hash, version)
+            except Exception:
+                pass
+        
+        # Mark as failed in DynamoDB, unless another build finished meanwhile.
+        # The published snapshot (if any) is kept; a later ask sees the
+        # failed status and resumes the build from it.
+        try:
+            cache_table.update_item(
+                Key={'contentHash': content_hash},
+                UpdateExpression='SET #s = :failed, #e = :error, #ttl = if_not_exists(#ttl, :ttl)',
+                ConditionExpression='attribute_not_exists(contentHash) OR #s <> :ready',
+                ExpressionAttributeNames={'#s': 'status', '#e': 'error', '#ttl': 'ttl'},
+                ExpressionAttributeValues={
+                    ':failed': 'failed',
+                    ':ready': 'ready',
+                    ':error': str(e),
+                    ':ttl': int(time.time()) + 3600
+                }
+            )
+        except:
+            pass
+        raise
+
+
+def fetch_image_for_model(image_url: str, page_url: str = None):
+    """Download an image and re-encode it as a small JPEG for the vision model.
+
+    Returns a (JPEG bytes, media type) tuple, or (None, None) if the image
+    could not be fetched or decoded. The image is decoded up front so the
+    download can be freed before resizing; JPEG sources are decoded at
+    reduced scale so a large photo is never fully expanded in memory.
+    """
+    with memory_stage('image'):
+        try:
+            # Configure HTTP headers to prevent access restrictions
+            headers = {
+                'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36',
+                'Accept': 'image/avif,image/webp,image/apng,image/svg+xml,image/*,*/*;q=0.8',
+                'Accept-Language': 'en-US,en;q=0.9',
+                'Referer': page_url
+            }
+            response = requests.get(image_url, timeout=10, headers=headers)
+            response.raise_for_status()
+            
+            # Optimize image dimensions for vision model processing
+            max_dimension = 512
+            buf = io.BytesIO()
+            # The buffer shares the downloaded bytes; it is the only reference left
+            source = io.BytesIO(response.content)
+            response = None
+            with Image.open(source) as image:
+                width, height = image.size
+                new_size = None
+                if max(width, height) > max_dimension:
+                    scaling_factor = max_dimension / max(width, height)
+                    new_size = (int(width * scaling_factor), int(height * scaling_factor))
+                    # Lets the JPEG decoder skip detail the resize throws away
+                    image.draft('RGB', new_size)
+                # An image opened from a buffer keeps reading from it until
+                # loaded; once decoded, closing the buffer frees the download
+                image.load()
+                source.close()
+                if new_size:
+                    resized = image.resize(new_size, Image.Resampling.LANCZOS)
+                else:
+                    # Even if not resizing, still convert to JPEG for consistency
+                    resized = image
+                
+                # Compress image to JPEG format for efficient processing
+                if resized.mode == 'RGBA':
+                    # Convert RGBA to RGB for JPEG compatibility
+                    background = Image.new('RGB', resized.size, (255, 255, 255))
+                    background.paste(resized, mask=resized.split()[3])
+                    background.save(buf, format='JPEG', quality=75)
+                else:
+                    resized.convert('RGB').save(buf, format='JPEG', quality=75)
+            
+            # Converse takes raw bytes, so no base64 copy is made
+            return buf.getvalue(), 'image/jpeg'
+        except Exception:
+            return None, None
+
+
+def parse_page_data(pageContent):
+    """Decode the extension's page content payload."""
+    if isinstance(pageContent, str):
+        return json.loads(pageContent)
+    return pageContent
+
+
+def parse_page_text(pageContent):
+    """Decode the extension's page content payload and return its text."""
+    return parse_page_data(pageContent).get('text', '')
+
+
+def first_image_url(image_context):
+    """Pick the first valid image URL from the newline-separated imageContext."""
+    if image_context and '\n' in image_context:
+        image_urls = [url.strip() for url in image_context.split('\n') if url.strip()]
+        return image_urls[0] if image_urls else ''
+    return image_context or ''
+
+
+def is_valid_content_hash(content_hash):
+    """True for a hex SHA-256 digest; hashes from clients end up in S3 keys and /tmp paths."""
+    return isinstance(content_hash, str) and re.fullmatch(r'[0-9a-f]{64}', content_hash) is not None
+
+
+def is_index_ready(content_hash):
+    """Check whether a ready index exists for a content hash without loading it."""
+    if read_local_version(content_hash):
+        return True
+    try:
+        response = cache_table.get_item(
+            Key={'contentHash': content_hash},
+            ProjectionExpression='#s',
+            ExpressionAttributeNames={'#s': 'status'},
+            ConsistentRead=True
+        )
+        return response.get('Item', {}).get('status') == 'ready'
+    except Exception:
+        return False
+
+
+def load_ask_context(session_id, user_id, page_text, page_url, image_url='', content_hash=None,
+                     question=None, scroll_ratio=None):
+    """Load history, page retrievers and image for answering questions about a page.
+
+    The independent I/O (history, current page index and image download) all
+    starts at once. Each task gets its own deadline and a failed or slow task
+    degrades to an empty result instead of failing the whole request.
+
+    With page_text=None the page is identified by content_hash alone and its
+    index is only loaded from cache; the current retriever is None on a miss.
+    question and scroll_ratio steer which chunks of a long page are embedded
+    first; coverage is the fraction of the current page that is searchable.
+    """
+    # Generate content hash for session tracking and caching
+    if page_text is not None:
+        with memory_stage('hash_page'):
+            content_hash = content_hash_of(page_text)
+    
+    started = time.monotonic()
+    history_future = io_executor.submit(
+        run_stage, 'history', get_session_conversation_history, session_id, user_id, limit=100
+    )
+    manifest_future = io_executor.submit(run_stage, 'manifest', get_session_manifest, session_id, user_id)
+    if page_text is not None:
+        current_future = io_executor.submit(
+            run_stage, 'page_index', build_page_retriever, page_text, page_url=page_url,
+            question=question, scroll_ratio=scroll_ratio, content_hash=content_hash
+        )
+    else:
+        current_future = io_executor.submit(
+            run_stage, 'page_index', load_retriever_from_hash, content_hash, page_url=page_url
+        )
+    image_future = None
+    if image_url and image_url.strip():
+        image_future = io_executor.submit(fetch_image_for_model, image_url, page_url)
+    
+    # Retrieve conversation history for contextual processing. None means
+    # it could not be read (error or timeout), which is not the same as a
+    # new session with no messages.
+    session_history_response = wait_for_result(history_future, started + HISTORY_TIMEOUT)
+    history_read = session_history_response is not None
+    session_history_response = session_history_response or {}
+    previous_messages = session_history_response.get('messages', [])
+    
+    # Pages come from the session manifest. Pages seen only in the history
+    # were visited before the session had a manifest, so they go first.
+    manifest_pages = wait_for_result(manifest_future, started + HISTORY_TIMEOUT) or {}
+    session_pages = {
+        url: data for url, data in session_history_response.get('pages', {}).items()
+        if url not in manifest_pages
+    }
+    session_pages.update(manifest_pages)
+    
+    # Add current page to session pages. The prompt only lists URLs, so the
+    # text is not kept here (history entries leave it empty too).
+    # Keywords of an unchanged page are reused; new text is counted later,
+    # in the deferred manifest write (None marks them as still to compute)
+    now = int(time.time() * 1000)
+    known = session_pages.get(page_url, {})
+    unchanged = known.get('contentHash') == content_hash and 'keywords' in known
+    session_pages[page_url] = {
+        'text': '',
+        'contentHash': content_hash,
+        'firstVisit': known.get('firstVisit', now),
+        'lastVisit': now,
+        'keywords': known.get('keywords', []) if unchanged or not page_text else None
+    }
+    
+    # Multi-page Retrieval Strategy:
+    # 1. Start loading the most useful previous page retrievers in parallel
+    previous_started = time.monotonic()
+    previous_futures = []
+    for url, data in rank_previous_pages(session_pages, page_url, question):
+        previous_futures.append(
+            io_executor.submit(
+                run_stage, 'previous_index', load_retriever_from_hash, data['contentHash'], page_url=url
+            )
+        )
+    
+    # 2. Collect previous page retrievers, keeping visit order
+    previous_retrievers = []
+    for future in previous_futures:
+        r = wait_for_result(future, previous_started + PREVIOUS_PAGE_TIMEOUT)
+        if r:
+            previous_retrievers.append(r)
+    
+    # 3. Combine retrievers with current page as last element
+    current_retriever = wait_for_result(current_future, started + CURRENT_PAGE_TIMEOUT)
+    
+    # Prepare image for multimodal input
+    image_bytes = None
+    image_media_type = None
+    if image_future:
+        image_bytes, image_media_type = wait_for_result(
+            image_future, started + IMAGE_TIMEOUT, default=(None, None)
+        )
+    
+    return {
+        'content_hash': content_hash,
+        'previous_messages': previous_messages,
+        'is_first_message': history_read and not previous_messages,
+        'session_pages': session_pages,
+        'page_entry': session_pages[page_url],
+        'page_text': page_text,
+        'retrievers': previous_retrievers + [current_retriever],
+        'coverage': retriever_coverage(current_retriever) if current_retriever else 1.0,
+        'image_bytes': image_bytes,
+        'image_media_type': image_media_type
+    }
+
+
+def embed_queries(prompts):
+    """Embed each question once so every page index can be searched by vector.
+
+    Titan has no multi-input embedding call, so the batch is sent as
+    concurrent single requests. Failed embeddings come back as None.
+    """
+    embeddings = BedrockEmbeddings(
+        client=bedrock_runtime,
+        model_id="amazon.titan-embed-text-v2:0",
+    )
+    embed_query = bedrock_limiter.bind_lane(embeddings.embed_query)
+    futures = [io_executor.submit(embed_query, prompt) for prompt in prompts]
+    vectors = []
+    for future in futures:
+        try:
+            vectors.append(future.result())
+        except Exception:
+            vectors.append(None)
+    return vectors
+
+
+def search_retriever(retriever, prompt, query_vector=None, k=5):
+    """Search one page index, reusing a precomputed query vector when possible."""
+    vector_store = getattr(retriever, 'vectorstore', None)
+    if query_vector is not None and vector_store is not None:
+        return vector_store.similarity_search_by_vector(query_vector, k=k)
+    retriever.search_kwargs = {"k": k}
+    return retriever.invoke(prompt)
+
+
+def retrieve_page_content(retrievers, prompt, query_vector=None):
+    """Search current and previous page indexes and format the chunks for the prompt."""
+    # The query only needs embedding once, however many pages are searched
+    if query_vector is None and len(retrievers) > 1:
+        query_vector = embed_queries([prompt])[0]
+    
+    # Retrieve relevant content from current and previous pages. Docs are
+    # tagged in a side list, not their metadata, because cached stores are
+    # shared between concurrent questions.
+    tagged_docs = []
+    
+    if retrievers:
+        # Extract and tag content from current page
+        current_retriever = retrievers[-1]
+        if current_retriever:
+            try:
+                docs = search_retriever(current_retriever, prompt, query_vector)
+                tagged_docs.extend(('current', doc) for doc in docs)
+            except Exception as e:
+                pass
+        
+        # Extract and tag content from previous pages
+        for prev_retriever in retrievers[:-1]:
+            if prev_retriever:
+                try:
+                    docs = search_retriever(prev_retriever, prompt, query_vector)
+                    tagged_docs.extend(('previous', doc) for doc in docs)
+                except Exception as e:
+                    pass
+    
+    # Deduplicate by content
+    seen = set()
+    unique_docs = []
+    for priority, d in tagged_docs:
+        content = d.page_content.strip()
+        if content and content not in seen:
+            seen.add(content)
+            unique_docs.append((priority, d))
+    
+    # Organize retrieved content by page priority
+    current_chunks = [d for priority, d in unique_docs if priority == 'current']
+    previous_chunks = [d for priority, d in unique_docs if priority == 'previous']
+    
+    # Construct structured context for model input
+    retrieved_content = ""
+    if current_chunks:
+        retrieved_content += "=== CURRENT PAGE CONTENT ===\n"
+        retrieved_content += "\n---\n".join(d.page_content for d in current_chunks[:15])
+        retrieved_content += "\n\n"
+    
+    if previous_chunks:
+        retrieved_content += "=== PREVIOUS PAGES CONTENT (for context) ===\n"
+        retrieved_content += "\n---\n".join(d.page_content for d in previous_chunks[:15])
+    
+    if not retrieved_content:
+        retrieved_content = "No relevant page content found."
+    return retrieved_content
+
+
+def build_answer_prompt(prompt, page_url, previous_messages, session_pages, retrieved_content,
+                        user_first_name=None, user_last_name=None):
+    """Assemble the retrieval-augmented prompt sent to the LLM."""
+    # Construct conversation history context
+    conversation_context = ""
+    if previous_messages:
+        conversation_context = "\n\nCONVERSATION HISTORY (Last messages):\n"
+        for msg in previous_messages[-100:]:  # Last 100 for context window
+            conversation_context += f"User: {msg.get('question', '')}\n"
+            conversation_context += f"You: {msg.get('answer', '')}\n"
+        conversation_context += "\n"
+    
+    # Build pages context with numbering
+    pages_context = ""
+    if len(session_pages) > 1:
+        pages_context = f"\n\nIMPORTANT - BROWSING SESSION CONTEXT:\n"
+        pages_context += f"The user is browsing through multiple pages in this session. You have access to content from ALL pages visited (in order):\n"
+        for idx, url in enumerate(session_pages.keys(), 1):
+            if url == page_url:
+                pages_context += f"{idx}. {url} ← CURRENT PAGE\n"
+            else:
+                pages_context += f"{idx}. {url}\n"
+        pages_context += f"\nWhen user says 'previous page' or 'previous one', they mean the page that came BEFORE the current page in this numbered list.\n"
+    
+    # Build user context
+    user_context = ""
+    if user_first_name and user_last_name:
+        user_context = f"\n\nUSER INFORMATION:\nYou are talking to {user_first_name} {user_last_name}.\n"
+    
+    return (
+        f"You are QuickPage, a friendly and helpful AI assistant that helps users understand web pages.\n\n"
+        f"ABOUT YOURSELF:\n"
+        f"- Your name is QuickPage\n"
+        f"- You're a browser extension that helps users quickly understand web page content\n"
+        f"- You can read any web page, answer questions about it, and provide insights\n"
+        f"- You remember the conversation history and all pages visited in this session\n\n"
+        f"{user_context}"
+        f"{conversation_context}"
+        f"CURRENT BROWSING SESSION:\n"
+        f"Currently viewing: {page_url}\n"
+        f"{pages_context}"
+        f"\n=== RELEVANT PAGE CONTENT ===\n"
+        f"(Content is organized with CURRENT page first, then PREVIOUS pages for context)\n\n"
+        f"{retrieved_content}\n"
+        f"=== END OF PAGE CONTENT ===\n\n"
+        f"IMPORTANT INSTRUCTIONS:\n"
+        f"1. Content above is clearly marked as 'CURRENT PAGE' vs 'PREVIOUS PAGES'.\n"
+        f"2. Naturally understand what the user is asking about - it could be about the current page or previous pages. If the question is vague, consider it about the current page.\n"
+        f"3. Answer questions in a NATURAL, CONVERSATIONAL way - like a helpful friend, not a formal analyst.\n"
+        f"4. AVOID formal phrases like 'According to my analysis...', 'Based on my findings...', etc. Just answer directly!\n"
+        f"5. CONVERSATION FLOW - CRITICAL RULES:\n"
+        f"   - USE the conversation history to understand what the user is talking about. User questions almost always depend on previous questions and answers.\n"
+        f"   - The user is continuing the conversation - understand context from their previous messages to know what they're referring to.\n"
+        f"   - DO NOT explain what they're doing. DO NOT say 'It seems like...', 'You're acknowledging...', 'Would you like to know more...', 'you asked this earlier', 'as I mentioned'.\n"
+        f"   - Just answer naturally, incorporating the context from previous messages without explicitly mentioning the conversation itself.\n"
+        f"   - Example: If user asks 'what is the area of Texas?' then 'compare it with Florida', understand they mean compare Texas with Florida.\n"
+        f"6. Only if information is NOT found in the page content, then you may use general knowledge and state: "
+        f"'This information isn't available on the pages you've visited, but [your answer]'\n"
+        f"7. Be confident and direct - just give the answer naturally!\n\n"
+        f"User question: {prompt}"
+    )
+
+
+def answer_image_question(prompt, image_bytes):
+    """Ask the vision model about an image through the Bedrock Converse API."""
+    try:
+        response = bedrock_runtime.converse(
+            modelId=MODEL_ID,
+            messages=[
+                {
+                    "role": "user",
+                    "content": [
+                        {
+                            "image": {
+                                "format": "jpeg",
+                                "source": {
+                                    "bytes": image_bytes
+                                }
+                            }
+                        },
+                        {
+                            "text": prompt
+                        }
+                    ]
+                }
+            ],
+            inferenceConfig={
+                "temperature": 0.2,
+                "maxTokens": 1024
+            }
+        )
+        
+        return response['output']['message']['content'][0]['text']
+    except Exception as e:
+        # Provide error message if image analysis fails
+        return f"I was able to fetch the image, but encountered an error analyzing it: {str(e)}"
+
+
+def generate_answer(prompt, page_url, ask_context, user_first_name=None, user_last_name=None,
+                    query_vector=None):
+    """Answer one question from a loaded ask context (image or page RAG)."""
+    # Handle image questions differently - call LLM directly with vision
+    if ask_context['image_bytes']:
+        return answer_image_question(prompt, ask_context['image_bytes'])
+    
+    # Process text query using direct retrieval-augmented generation
+    retrieved_content = retrieve_page_content(ask_context['retrievers'], prompt, query_vector)
+    message_content = build_answer_prompt(
+        prompt,
+        page_url,
+        ask_context['previous_messages'],
+        ask_context['session_pages'],
+        retrieved_content,
+        user_first_name=user_first_name,
+        user_last_name=user_last_name
+    )
+    if ask_context.get('coverage', 1.0) < 1:
+        message_content += (
+            f"\n\n(Note: only {ask_context['coverage']:.0%} of the current page has been indexed so far. "
+            f"If the answer is not in the content above, say the rest of the page is still being read.)"
+        )
+    response = make_bedrock_llm().invoke(message_content)
+    return response.content
+
+
+def make_chat_item(session_id, timestamp, user_id, prompt, answer, image_url, page_url,
+                   page_content, content_hash, is_first_message):
+    """Build the DynamoDB item for one question/answer turn."""
+    item = {
+        'sessionid': session_id,
+        'timestamp': timestamp,
+        'userId': user_id,
+        'question': prompt,
+        'answer': answer,
+        'ImageURL': image_url,
+        'pageURL': page_url,
+        'contentHash': content_hash,
+        'lastMessageAt': timestamp
+    }
+    
+    # Hash-only requests carry no page content to store
+    if page_content is not None:
+        item['pageContent'] = page_content
+    
+    # Initialize session metadata for new conversations
+    if is_first_message:
+        item['sessionTitle'] = prompt[:50] + ('...' if len(prompt) > 50 else '')
+        item['createdAt'] = timestamp
+    return item
+
+
+def write_chat_items(items):
+    """Persist several chat turns in a single batch_writer pass."""
+    with table.batch_writer() as batch:
+        for item in items:
+            batch.put_item(Item=item)
+
+
+# Lambda function entry point
+def lambda_handler(event, context):
+    if MEMORY_PROFILING:
+        start_memory_profile()
+    started = time.monotonic()
+    response = handle_request(event, context)
+    response_ms = int((time.monotonic() - started) * 1000)
+    
+    # Finish deferred writes before the container can be frozen, and report
+    # their latency separately from the time it took to produce the response
+    drain_started = time.monotonic()
+    write_stats = drain_pending_writes()
+    log_latency_metric(response, response_ms, write_stats, int((time.monotonic() - drain_started) * 1000))
+    return response
+
+
+def log_latency_metric(response, response_ms, write_stats, write_drain_ms):
+    """Print the per-request latency metric line (API responses only)."""
+    if isinstance(response, dict) and 'statusCode' in response:
+        print(json.dumps({
+            'metric': 'latency',
+            'responseMs': response_ms,
+            'responseBytes': len(response.get('body') or ''),
+            'contentEncoding': response['headers'].get('Content-Encoding', 'identity'),
+            'writeDrainMs': write_drain_ms,
+            'writes': write_stats['writes'],
+            'pendingWrites': write_stats['pending'],
+            'bedrock': bedrock_limiter.snapshot(),
+            'memory': memory_profile_report()
+        }))
+
+
+def handle_request(event, context):
+    # Parse request body from the event
+    if isinstance(event.get('body'), str):
+        with memory_stage('parse_body'):
+            body = event['body']
+            if event.get('isBase64Encoded'):
+                # json.loads reads UTF-8 bytes directly; skip the str copy
+                body = base64.b64decode(body)
+            requestBody = json.loads(body)
+            body = None
+    elif isinstance(event.get('body'), dict):
+        requestBody = event['body']
+    else:
+        requestBody = event
+    
+    # Verify authentication token (if provided)
+    auth_token = requestBody.get('authToken', '')
+    user_id = 'anonymous'  # Default
+    user_first_name = None
+    user_last_name = None
+    
+    if auth_token:
+        token_payload = verify_cognito_token(auth_token)
+        if token_payload:
+            # Extract user info from token
+            user_id = token_payload.get('sub')  # Cognito user ID (unique)
+            user_first_name = token_payload.get('given_name')
+            user_last_name = token_payload.get('family_name')
+        else:
+            # Invalid token
+            return build_response(event, 401, {'error': 'Invalid or expired authentication token'})
+    
+    action = requestBody.get('action', '')
+    
+    # Async worker for preloadBatch. Only accepted from a direct invocation
+    # carrying the internal secret, never from an API Gateway request.
+    if action == 'runPreloadJob':
+        if not is_internal_invocation(event, requestBody):
+            return build_response(event, 400, {'error': f'Unknown action: {action}'})
+        return run_preload_job(requestBody.get('job_id', ''))
+    
+    # Async worker that finishes a progressive page build; same restriction
+    if action == 'continueIngestion':
+        if not is_internal_invocation(event, requestBody):
+            return build_response(event, 400, {'error': f'Unknown action: {action}'})
+        content_hash = requestBody.get('content_hash', '')
+        if not is_valid_content_hash(content_hash):
+            return {'status': 'error', 'message': 'invalid content hash'}
+        return resume_ingestion(content_hash)
+    
+    # Scheduled cache sweep (an EventBridge rule whose input carries the
+    # secret); same restriction
+    if action == 'sweepCache':
+        if not is_internal_invocation(event, requestBody):
+            return build_response(event, 400, {'error': f'Unknown action: {action}'})
+        return run_cache_sweep()
+    
+    handler = ACTION_HANDLERS.get(action)
+    if not handler:
+        return build_response(event, 400, {'error': f'Unknown action: {action}'})
+    
+    request = {
+        'body': requestBody,
+        'event': event,
+        'context': context,
+        'user_id': user_id,
+        'user_first_name': user_first_name,
+        'user_last_name': user_last_name,
+        'session_id': requestBody.get('session_id', str(uuid.uuid4())),
+        'timestamp': int(time.time() * 1000)
+    }
+    try:
+        with memory_stage(action):
+            status_code, payload = handler(request)
+    except Exception as e:
+        status_code, payload = 500, {'error': str(e)}
+    
+    payload = select_fields(action, payload, requestBody.get('fields'))
+    with memory_stage('build_response'):
+        return build_response(event, status_code, payload)
+
+
+def is_internal_invocation(event, requestBody):
+    """True for an async self-invocation: a raw event with the internal secret."""
+    if 'body' in event or 'httpMethod' in event or not INTERNAL_INVOKE_SECRET:
+        return False
+    return hmac.compare_digest(str(requestBody.get('internal_secret', '')), INTERNAL_INVOKE_SECRET)
+
+
+def build_response(event, status_code, payload):
+    """Serialize a payload into an API Gateway response, compressing when the client allows."""
+    body = json.dumps(payload, default=decimal_to_int, separators=(',', ':'))
+    response = {
+        'statusCode': status_code,
+        'headers': dict(CORS_HEADERS),
+        'body': body
+    }
+    
+    # json.dumps escapes non-ASCII, so len(body) is the byte size
+    encoding = negotiate_encoding(event)
+    if encoding and len(body) >= COMPRESSION_MIN_BYTES:
+        raw = body.encode('utf-8')
+        if encoding == 'br':
+            compressed = brotli.compress(raw, quality=5)
+        else:
+            compressed = gzip.compress(raw, compresslevel=6)
+        response['body'] = base64.b64encode(compressed).decode('ascii')
+        response['isBase64Encoded'] = True
+        response['headers']['Content-Encoding'] = encoding
+        response['headers']['Vary'] = 'Accept-Encoding'
+    return response
+
+
+def negotiate_encoding(event):
+    """Pick br or gzip from the request's Accept-Encoding header, or None."""
+    if not COMPRESS_RESPONSES:
+        return None
+    headers = event.get('headers') or {}
+    accept = next((v for k, v in headers.items() if k.lower() == 'accept-encoding'), '') or ''
+    
+    accepted = set()
+    for part in accept.split(','):
+        name, _, params = part.strip().partition(';')
+        if params.replace(' ', '') in ('q=0', 'q=0.0', 'q=0.00', 'q=0.000'):
+            continue
+        accepted.add(name.strip().lower())
+    
+    if brotli and ('br' in accepted or '*' in accepted):
+        return 'br'
+    if 'gzip' in accepted or '*' in accepted:
+        return 'gzip'
+    return None
+
+
+def select_fields(action, payload, fields):
+    """Keep only the requested fields on an action's main object or list entries."""
+    target = FIELD_SELECTION_TARGETS.get(action)
+    if not fields or not target or not isinstance(fields, list) or not isinstance(payload, dict):
+        return payload
+    
+    # Field names only; anything else in the list is ignored
+    wanted = {field for field in fields if isinstance(field, str)}
+    if not wanted:
+        return payload
+    value = payload.get(target)
+    if isinstance(value, list):
+        payload[target] = [
+            {k: v for k, v in entry.items() if k in wanted} if isinstance(entry, dict) else entry
+            for entry in value
+        ]
+    elif isinstance(value, dict):
+        payload[target] = {k: v for k, v in value.items() if k in wanted}
+    return payload
+
+
+# Handle deletion request
+def handle_delete(request):
+    result = delete_chat_history(request['session_id'], request['user_id'])
+    return 200, {'message': result}
+
+
+# Handle delete all sessions request for the signed-in user
+def handle_delete_all(request):
+    return 200, delete_all_user_sessions(request['user_id'])
+
+
+# Handle list sessions request
+def handle_list_sessions(request):
+    return 200, list_chat_sessions(request['user_id'])
+
+
+# Handle get session history request
+def handle_get_session(request):
+    return 200, get_session_history(request['body'].get('session_id'), request['user_id'])
+
+
+# Handle create new session request
+def handle_create_session(request):
+    return 200, {
+        'session_id': str(uuid.uuid4()),
+        'pageURL': request['body'].get('pageURL', ''),
+        'createdAt': request['timestamp']
+    }
+
+
+# Handle preload embeddings request for proactive caching. The extension
+# sends only the content hash first and uploads the text on a cache miss.
+def handle_preload_embeddings(request):
+    pageContent = request['body'].get('pageContent')
+    pageURL = request['body'].get('pageURL', '')
+    
+    try:
+        if pageContent is None:
+            content_hash = request['body'].get('contentHash')
+            if not is_valid_content_hash(content_hash):
+                return 400, {'error': 'pageContent or a valid contentHash is required'}
+            if is_index_ready(content_hash):
+                return 200, {'status': 'cached', 'contentHash': content_hash}
+            return 200, {'status': 'needContent', 'contentHash': content_hash}
+        
+        page_data = parse_page_data(pageContent)
+        page_text = page_data.get('text', '')
+        if not page_text:
+            return 200, {'status': 'skipped', 'reason': 'no_content'}
+        
+        # Build and cache retriever for page embeddings. Preloading is
+        # background work, so interactive asks get Bedrock capacity first.
+        # Long pages publish a partial index and finish asynchronously.
+        content_hash = content_hash_of(page_text)
+        with bedrock_limiter.lane('background'):
+            retriever = build_page_retriever(
+                page_text, page_url=pageURL, scroll_ratio=page_data.get('scrollRatio'),
+                content_hash=content_hash
+            )
+        return 200, {
+            'status': 'success',
+            'contentHash': content_hash,
+            'coverage': retriever_coverage(retriever)
+        }
+    except Exception as e:
+        return 200, {'status': 'error', 'message': str(e)}
+
+
+# Handle bulk preload request: queue many pages and return a job id
+def handle_preload_batch(request):
+    pages = request['body'].get('pages')
+    if not isinstance(pages, list) or not pages or len(pages) > PRELOAD_MAX_PAGES:
+        return 400, {'error': f'pages must be a list of 1 to {PRELOAD_MAX_PAGES} pages'}
+    
+    try:
+        return 200, start_preload_job(pages, request['user_id'], request['context'])
+    except Exception as e:
+        return 200, {'status': 'error', 'message': str(e)}
+
+
+# Handle bulk preload status request
+def handle_preload_status(request):
+    return 200, get_preload_job_status(request['body'].get('job_id', ''), request['user_id'])
+
+
+def load_page_ask_context(request, pageContent, pageURL, ImageURL, question=None):
+    """Load the ask context from uploaded page content or from a content hash alone.
+
+    Returns None when only a hash was sent and the server has no index for
+    it, so the client should resend with the full page content.
+    """
+    if pageContent is not None:
+        page_data = parse_page_data(pageContent)
+        return load_ask_context(
+            request['session_id'], request['user_id'], page_data.get('text', ''), pageURL, ImageURL,
+            question=question, scroll_ratio=page_data.get('scrollRatio')
+        )
+    
+    content_hash = request['body'].get('contentHash')
+    if not is_valid_content_hash(content_hash):
+        raise ValueError('pageContent or a valid contentHash is required')
+    ask_context = load_ask_context(
+        request['session_id'], request['user_id'], None, pageURL, ImageURL, content_hash=content_hash
+    )
+    # Image questions do not search the page, so they never need the text
+    if ask_context['retrievers'][-1] is None and not ask_context['image_bytes']:
+        return None
+    return ask_context
+
+
+# Handle user query (ask action)
+def handle_ask(request):
+    requestBody = request['body']
+    session_id = request['session_id']
+    user_id = request['user_id']
+    ImageURL = first_image_url(requestBody.get('imageContext', ''))
+    pageContent = requestBody.get('pageContent')
+    prompt = requestBody['prompt']
+    pageURL = requestBody['pageURL']
+
+    try:
+        ask_context = load_page_ask_context(request, pageContent, pageURL, ImageURL, question=prompt)
+        if ask_context is None:
+            return 200, {'status': 'needContent', 'contentHash': requestBody.get('contentHash')}
+        
+        generated_text = generate_answer(
+            prompt,
+            pageURL,
+            ask_context,
+            user_first_name=request['user_first_name'],
+            user_last_name=request['user_last_name']
+        )
+
+        # Persist conversation data to DynamoDB. The history fetch already
+        # tells us whether this session has earlier messages, so no extra
+        # query is needed; if it failed, the session title is left alone.
+        item = make_chat_item(
+            session_id, request['timestamp'], user_id, prompt, generated_text, ImageURL, pageURL,
+            pageContent, ask_context['content_hash'],
+            is_first_message=ask_context['is_first_message']
+        )
+        
+        # Write in the background; the condition keeps retries from
+        # overwriting an existing turn
+        defer_write(
+            'chat_item',
+            table.put_item,
+            Item=item,
+            ConditionExpression='attribute_not_exists(sessionid)'
+        )
+        defer_write(
+            'session_manifest', record_page_visit, session_id, user_id, pageURL, ask_context['page_entry'],
+            ask_context['page_text'], ask_context['session_pages']
+        )
+
+        return 200, {'prompt': prompt, 'response': generated_text, 'coverage': ask_context['coverage']}
+    except Exception as e:
+        return 500, {'error': str(e)}
+
+
+# Handle several questions about one page in a single round trip
+def handle_ask_batch(request):
+    requestBody = request['body']
+    session_id = request['session_id']
+    user_id = request['user_id']
+    timestamp = request['timestamp']
+    ImageURL = first_image_url(requestBody.get('imageContext', ''))
+    pageContent = requestBody.get('pageContent')
+    prompts = requestBody.get('prompts')
+    pageURL = requestBody['pageURL']
+    
+    if not isinstance(prompts, list) or not prompts or len(prompts) > BATCH_MAX_PROMPTS:
+        return 400, {'error': f'prompts must be a list of 1 to {BATCH_MAX_PROMPTS} questions'}
+
+    try:
+        # History, indexes and image are loaded once for the whole batch.
+        # Every question sees the same history; answers in this batch do
+        # not feed into each other.
+        ask_context = load_page_ask_context(
+            request, pageContent, pageURL, ImageURL,
+            question=' '.join(p for p in prompts if isinstance(p, str))
+        )
+        if ask_context is None:
+            return 200, {'status': 'needContent', 'contentHash': requestBody.get('contentHash')}
+        
+        # Embed all questions up front so each index is searched by vector
+        query_vectors = [None] * len(prompts)
+        if not ask_context['image_bytes']:
+            valid = [i for i, p in enumerate(prompts) if isinstance(p, str) and p.strip()]
+            for i, vector in zip(valid, embed_queries([prompts[i] for i in valid])):
+                query_vectors[i] = vector
+        
+        def answer_one(idx):
+            prompt = prompts[idx]
+            if not isinstance(prompt, str) or not prompt.strip():
+                return {'prompt': prompt, 'status': 'error', 'error': 'empty prompt'}
+            try:
+                answer = generate_answer(
+                    prompt,
+                    pageURL,
+                    ask_context,
+                    user_first_name=request['user_first_name'],
+                    user_last_name=request['user_last_name'],
+                    query_vector=query_vectors[idx]
+                )
+                return {'prompt': prompt, 'status': 'success', 'response': answer}
+            except Exception as e:
+                return {'prompt': prompt, 'status': 'error', 'error': str(e)}
+        
+        # Run generations concurrently, bounded so one batch cannot flood Bedrock
+        with ThreadPoolExecutor(max_workers=BATCH_MAX_CONCURRENCY) as pool:
+            results = list(pool.map(answer_one, range(len(prompts))))
+        
+        # Persist every answered turn in one batch_writer pass. Each turn
+        # gets its own timestamp so the sort keys stay unique and ordered.
+        items = []
+        is_first_message = ask_context['is_first_message']
+        for idx, result in enumerate(results):
+            if result['status'] != 'success':
+                continue
+            items.append(make_chat_item(
+                session_id, timestamp + idx, user_id, result['prompt'], result['response'],
+                ImageURL, pageURL, pageContent, ask_context['content_hash'],
+                is_first_message=is_first_message and not items
+            ))
+        if items:
+            defer_write('chat_batch', write_chat_items, items)
+            defer_write(
+                'session_manifest', record_page_visit, session_id, user_id, pageURL, ask_context['page_entry'],
+                ask_context['page_text'], ask_context['session_pages']
+            )
+
+        return 200, {'session_id': session_id, 'results': results, 'coverage': ask_context['coverage']}
+    except Exception as e:
+        return 500, {'error': str(e)}
+
+
+# Action name -> handler. Each handler takes the parsed request and returns
+# (status code, JSON payload); build_response does the rest.
+ACTION_HANDLERS = {
+    'delete': handle_delete,
+    'deleteAll': handle_delete_all,
+    'listSessions': handle_list_sessions,
+    'getSession': handle_get_session,
+    'createSession': handle_create_session,
+    'preloadEmbeddings': handle_preload_embeddings,
+    'preloadBatch': handle_preload_batch,
+    'preloadStatus': handle_preload_status,
+    'ask': handle_ask,
+    'askBatch': handle_ask_batch,
+}
+
+
+# Function to delete chat history from DynamoDB
+def delete_chat_history(session_id, user_id):
+    try:
+        started = time.monotonic()
+        
+        # Page through the session reading keys only; ownership is checked
+        # by DynamoDB so pageContent never leaves the table
+        query_kwargs = {
+            'KeyConditionExpression': Key('sessionid').eq(session_id),
+            'ProjectionExpression': 'sessionid, #ts, contentHash',
+            'ExpressionAttributeNames': {'#ts': 'timestamp'}
+        }
+        if user_id and user_id != 'anonymous':
+            query_kwargs['FilterExpression'] = Attr('userId').eq(user_id)
+        items = query_all(table.query, **query_kwargs)
+        
+        deleted, undeleted = batch_delete_keys(
+            [{'sessionid': item['sessionid'], 'timestamp': item['timestamp']} for item in items]
+        )
+        queue_orphan_candidates({item['contentHash'] for item in items if item.get('contentHash')})
+        log_delete_throughput('delete', deleted, started)
+        if undeleted:
+            # Keep the manifest while chat items remain; deleting again retries them
+            return f"Deleted {deleted} items for session {session_id}; {len(undeleted)} could not be deleted, try again."
+        delete_session_manifests([session_id], user_id)
+        return f"Deleted {deleted} items for session {session_id}."
+    except Exception as e:
+        return f"Error deleting items: {str(e)}"
 
-    # Build FAISS vector store
-    vector_store = FAISS.from_texts(chunks, embeddings)
-    retriever = vector_store.as_retriever(search_kwargs={"k": 5})
-    
-    # Cache the FAISS index
-    temp_path = f"/tmp/faiss_{content_hash}"
-    s3_key = f"embeddings/{content_hash}/index.faiss"
-    s3_pkl_key = f"embeddings/{content_hash}/index.pkl"
+
+def delete_all_user_sessions(user_id):
+    """Delete every chat item a signed-in user owns, plus orphaned page caches."""
+    if not user_id or user_id == 'anonymous':
+        return {'deletedItems': 0, 'sessions': 0, 'error': 'Sign in to delete all sessions'}
     
     try:
-        os.makedirs(temp_path, exist_ok=True)
-        vector_store.save_local(temp_path)
-        s3_client.upload_file(f"{temp_path}/index.faiss", CACHE_BUCKET, s3_key)
-        s3_client.upload_file(f"{temp_path}/index.pkl", CACHE_BUCKET, s3_pkl_key)
+        started = time.monotonic()
         
-        # Verify upload
-        s3_client.head_object(Bucket=CACHE_BUCKET, Key=s3_key)
-        s3_client.head_object(Bucket=CACHE_BUCKET, Key=s3_pkl_key)
+        # Read keys through the per-user index; fall back to a filtered,
+        # key-only scan if the index has not been created yet (DynamoDB
+        # rejects a query on a missing index with ValidationException)
+        projection = {
+            'ProjectionExpression': 'sessionid, #ts, contentHash',
+            'ExpressionAttributeNames': {'#ts': 'timestamp'}
+        }
+        try:
+            items = query_all(
+                table.query,
+                IndexName=CHAT_USER_INDEX,
+                KeyConditionExpression=Key('userId').eq(user_id),
+                **projection
+            )
+        except ClientError as e:
+            if e.response.get('Error', {}).get('Code') != 'ValidationException':
+                raise
+            items = query_all(table.scan, FilterExpression=Attr('userId').eq(user_id), **projection)
         
-        # Save metadata to DynamoDB
-        cache_table.put_item(
-            Item={
-                'contentHash': content_hash,
-                'status': 'ready',
-                's3Key': s3_key,
-                'createdAt': int(time.time()),
-                'lastAccessed': int(time.time()),
-                'numChunks': len(chunks),
-                'ttl': int(time.time()) + (7 * 24 * 60 * 60)
-            }
+        deleted, undeleted = batch_delete_keys(
+            [{'sessionid': item['sessionid'], 'timestamp': item['timestamp']} for item in items]
         )
+        orphan_candidates = queue_orphan_candidates(
+            {item['contentHash'] for item in items if item.get('contentHash')}
+        )
+        # Sessions with chat items left keep their manifests
+        incomplete = {key['sessionid'] for key in undeleted}
+        delete_session_manifests({item['sessionid'] for item in items} - incomplete, user_id)
+        
+        elapsed_ms = log_delete_throughput('deleteAll', deleted, started)
+        result = {
+            'deletedItems': deleted,
+            'sessions': len({item['sessionid'] for item in items}),
+            'orphanCandidates': orphan_candidates,
+            'elapsedMs': elapsed_ms
+        }
+        if undeleted:
+            result['undeletedItems'] = len(undeleted)
+            result['undeletedKeys'] = undeleted
+        return result
     except Exception as e:
-        # Mark as failed in DynamoDB
-        try:
-            cache_table.put_item(
-                Item={
-                    'contentHash': content_hash,
-                    'status': 'failed',
-                    'error': str(e),
-                    'createdAt': int(time.time()),
-                    'ttl': int(time.time()) + 3600
-                }
-            )
-        except:
-            pass
-    
-    return retriever
+        return {'deletedItems': 0, 'sessions': 0, 'error': str(e)}
 
 
-# Lambda function entry point
-def lambda_handler(event, context):
-    # Parse request body from the event
-    if isinstance(event.get('body'), str):
-        requestBody = json.loads(event['body'])
-    elif isinstance(event.get('body'), dict):
-        requestBody = event['body']
-    else:
-        requestBody = event
-    
-    # Verify authentication token (if provided)
-    auth_token = requestBody.get('authToken', '')
-    user_id = 'anonymous'  # Default
-    user_email = None
-    user_first_name = None
-    user_last_name = None
-    
-    if auth_token:
-        token_payload = verify_cognito_token(auth_token)
-        if token_payload:
-            # Extract user info from token
-            user_id = token_payload.get('sub')  # Cognito user ID (unique)
-            user_email = token_payload.get('email')
-            user_first_name = token_payload.get('given_name')
-            user_last_name = token_payload.get('family_name')
-        else:
-            # Invalid token
-            return {
-                'statusCode': 401,
-                'headers': {
-                    'Content-Type': 'application/json',
-                    'Access-Control-Allow-Origin': '*',
-                    'Access-Control-Allow-Headers': 'Content-Type, Authorization',
-                    'Access-Control-Allow-Methods': 'POST, OPTIONS'
-                },
-                'body': json.dumps({'error': 'Invalid or expired authentication token'})
-            }
-    
-    timestamp = int(time.time() * 1000)
-    action = requestBody.get('action', '')
-    session_id = requestBody.get('session_id', str(uuid.uuid4()))
+def query_all(operation, **kwargs):
+    """Run a DynamoDB query or scan through every page of results."""
+    items = []
+    response = operation(**kwargs)
+    items.extend(response['Items'])
+    while 'LastEvaluatedKey' in response:
+        response = operation(ExclusiveStartKey=response['LastEvaluatedKey'], **kwargs)
+        items.extend(response['Items'])
+    return items
 
-    # Handle deletion request
-    if action == 'delete':
-        result = delete_chat_history(session_id, user_id)
-        return {
-            'statusCode': 200,
-            'headers': {
-                'Content-Type': 'application/json',
-                'Access-Control-Allow-Origin': '*',
-                'Access-Control-Allow-Headers': 'Content-Type, Authorization',
-                'Access-Control-Allow-Methods': 'POST, OPTIONS'
-            },
-            'body': json.dumps({
-                'message': result
-            })
-        }
+
+def batch_delete_keys(keys):
+    """Delete chat items by key using parallel BatchWriteItem workers.
+
+    Uses the low-level client because boto3 clients are thread-safe and
+    resources (and their batch_writer) are not. Returns the number deleted
+    and the keys still unprocessed after DELETE_MAX_ATTEMPTS tries.
+    """
+    client = dynamodb.meta.client
     
-    # Handle list sessions request
-    elif action == 'listSessions':
-        result = list_chat_sessions(user_id)
-        return {
-            'statusCode': 200,
-            'headers': {
-                'Content-Type': 'application/json',
-                'Access-Control-Allow-Origin': '*',
-                'Access-Control-Allow-Headers': 'Content-Type, Authorization',
-                'Access-Control-Allow-Methods': 'POST, OPTIONS'
-            },
-            'body': json.dumps(result, default=decimal_to_int)
-        }
+    def delete_chunk(chunk):
+        request = {table.name: [{'DeleteRequest': {'Key': key}} for key in chunk]}
+        for attempt in range(1, DELETE_MAX_ATTEMPTS + 1):
+            response = client.batch_write_item(RequestItems=request)
+            request = response.get('UnprocessedItems') or None
+            if not request:
+                return len(chunk), []
+            if attempt < DELETE_MAX_ATTEMPTS:
+                # Back off before retrying throttled items
+                time.sleep(min(0.05 * (2 ** attempt), 2))
+        left = [item['DeleteRequest']['Key'] for item in request.get(table.name, [])]
+        return len(chunk) - len(left), left
     
-    # Handle get session history request
-    elif action == 'getSession':
-        session_id = requestBody.get('session_id')
-        result = get_session_history(session_id, user_id)
-        return {
-            'statusCode': 200,
-            'headers': {
-                'Content-Type': 'application/json',
-                'Access-Control-Allow-Origin': '*',
-                'Access-Control-Allow-Headers': 'Content-Type, Authorization',
-                'Access-Control-Allow-Methods': 'POST, OPTIONS'
-            },
-            'body': json.dumps(result, default=decimal_to_int)
-        }
+    # BatchWriteItem accepts at most 25 requests per call
+    chunks = [keys[i:i + 25] for i in range(0, len(keys), 25)]
+    if not chunks:
+        return 0, []
+    deleted, undeleted = 0, []
+    with ThreadPoolExecutor(max_workers=min(DELETE_MAX_WORKERS, len(chunks))) as pool:
+        for count, left in pool.map(delete_chunk, chunks):
+            deleted += count
+            undeleted.extend(left)
+    if undeleted:
+        print(json.dumps({'event': 'delete_incomplete', 'undeletedKeys': undeleted}, default=decimal_to_int))
+    return deleted, undeleted
+
+
+# Orphan candidates wait for the cache sweep in cache_table, spread over
+# 256 items keyed by the first two hex digits of the hash. Each holds a
+# candidates map of content hash -> time of the latest deletion.
+def orphan_shard_key(content_hash):
+    return f"orphans#{content_hash[:2]}"
+
+
+def queue_orphan_candidates(content_hashes):
+    """Record hashes whose chat items were deleted for the cache sweep to check.
+
+    The contentHash index is eventually consistent, so checking right after
+    the deletes could miss chat items written moments ago; run_cache_sweep
+    checks a hash once ORPHAN_CLEANUP_DELAY_SECONDS have passed. Returns the
+    number of hashes queued.
+    """
+    shards = {}
+    for content_hash in sorted(content_hashes):
+        shards.setdefault(orphan_shard_key(content_hash), []).append(content_hash)
     
-    # Handle create new session request
-    elif action == 'createSession':
-        new_session_id = str(uuid.uuid4())
-        pageURL = requestBody.get('pageURL', '')
-        return {
-            'statusCode': 200,
-            'headers': {
-                'Content-Type': 'application/json',
-                'Access-Control-Allow-Origin': '*',
-                'Access-Control-Allow-Headers': 'Content-Type, Authorization',
-                'Access-Control-Allow-Methods': 'POST, OPTIONS'
-            },
-            'body': json.dumps({
-                'session_id': new_session_id,
-                'pageURL': pageURL,
-                'createdAt': timestamp
-            })
+    def queue(key, batch):
+        names = {f'#h{i}': h for i, h in enumerate(batch)}
+        kwargs = {
+            'Key': {'contentHash': key},
+            'UpdateExpression': 'SET ' + ', '.join(f'candidates.{name} = :now' for name in names),
+            'ConditionExpression': 'attribute_exists(candidates)',
+            'ExpressionAttributeNames': names,
+            'ExpressionAttributeValues': {':now': int(time.time())}
         }
+        try:
+            cache_table.update_item(**kwargs)
+        except ClientError as e:
+            if not is_conditional_check_failure(e):
+                raise
+            # First candidate in this shard: create the map, then add to it
+            cache_table.update_item(
+                Key={'contentHash': key},
+                UpdateExpression='SET candidates = if_not_exists(candidates, :empty)',
+                ExpressionAttributeValues={':empty': {}}
+            )
+            cache_table.update_item(**kwargs)
     
-    # Handle preload embeddings request for proactive caching
-    elif action == 'preloadEmbeddings':
-        pageContent = requestBody.get('pageContent', '')
-        pageURL = requestBody.get('pageURL', '')
-        
+    # Update expressions are capped at 4 KB
+    futures = [
+        (io_executor.submit(queue, key, hashes[start:start + 100]), len(hashes[start:start + 100]))
+        for key, hashes in shards.items()
+        for start in range(0, len(hashes), 100)
+    ]
+    queued = 0
+    for future, size in futures:
         try:
-            # Decode page content JSON and extract text
-            if isinstance(pageContent, str):
-                page_data = json.loads(pageContent)
-            else:
-                page_data = pageContent
-            page_text = page_data.get('text', '')
-            
-            if not page_text:
-                return {
-                    'statusCode': 200,
-                    'headers': {
-                        'Content-Type': 'application/json',
-                        'Access-Control-Allow-Origin': '*',
-                        'Access-Control-Allow-Headers': 'Content-Type, Authorization',
-                        'Access-Control-Allow-Methods': 'POST, OPTIONS'
-                    },
-                    'body': json.dumps({'status': 'skipped', 'reason': 'no_content'})
-                }
-            
-            # Build and cache retriever for page embeddings
-            retriever = build_page_retriever(page_text, page_url=pageURL)
-            
-            return {
-                'statusCode': 200,
-                'headers': {
-                    'Content-Type': 'application/json',
-                    'Access-Control-Allow-Origin': '*',
-                    'Access-Control-Allow-Headers': 'Content-Type, Authorization',
-                    'Access-Control-Allow-Methods': 'POST, OPTIONS'
-                },
-                'body': json.dumps({
-                    'status': 'success'
-                })
-            }
+            future.result()
+            queued += size
         except Exception as e:
-            return {
-                'statusCode': 200,
-                'headers': {
-                    'Content-Type': 'application/json',
-                    'Access-Control-Allow-Origin': '*',
-                    'Access-Control-Allow-Headers': 'Content-Type, Authorization',
-                    'Access-Control-Allow-Methods': 'POST, OPTIONS'
-                },
-                'body': json.dumps({'status': 'error', 'message': str(e)})
-            }
+            print(f"Could not queue orphaned page cache checks: {str(e)}")
+    return queued
 
-    # Handle user query (ask action)
-    elif action == 'ask':
-        ImageURL = requestBody.get('imageContext', '')
-        pageContent = requestBody['pageContent']
-        prompt = requestBody['prompt']
-        pageURL = requestBody['pageURL']
-        
-        # Extract first valid image from multiple image URLs
-        if ImageURL and '\n' in ImageURL:
-            image_urls = [url.strip() for url in ImageURL.split('\n') if url.strip()]
-            ImageURL = image_urls[0] if image_urls else ''
 
-        try:
-            # Retrieve conversation history for contextual processing
-            previous_messages = []
-            session_pages = {}
-            
+def cleanup_orphan_candidates():
+    """Check the queued orphan candidates whose delay has passed (cache sweep step).
+
+    Returns the number of page caches removed.
+    """
+    cutoff = int(time.time()) - ORPHAN_CLEANUP_DELAY_SECONDS
+    shards = get_cache_items([f"orphans#{i:02x}" for i in range(256)], ('candidates',), consistent=True)
+    removed = 0
+    for key, item in shards.items():
+        due = sorted(h for h, deleted_at in (item.get('candidates') or {}).items() if deleted_at <= cutoff)
+        if not due:
+            continue
+        removed += cleanup_orphaned_hashes(due)
+        for start in range(0, len(due), 100):
+            names = {f'#h{i}': h for i, h in enumerate(due[start:start + 100])}
+            # If one was queued again since it was read, the group stays for
+            # the next sweep; checking a hash twice is harmless
             try:
-                session_history_response = get_session_conversation_history(session_id, user_id, limit=100)
-                previous_messages = session_history_response.get('messages', [])
-                session_pages = session_history_response.get('pages', {})
-            except Exception as hist_err:
-                pass
-            
-            # Decode page content JSON and extract text
-            if isinstance(pageContent, str):
-                page_data = json.loads(pageContent)
-            else:
-                page_data = pageContent
-            page_text = page_data.get('text', '')
+                cache_table.update_item(
+                    Key={'contentHash': key},
+                    UpdateExpression='REMOVE ' + ', '.join(f'candidates.{name}' for name in names),
+                    ConditionExpression=' AND '.join(f'candidates.{name} <= :cutoff' for name in names),
+                    ExpressionAttributeNames=names,
+                    ExpressionAttributeValues={':cutoff': cutoff}
+                )
+            except ClientError as e:
+                if not is_conditional_check_failure(e):
+                    print(f"Could not clear orphan candidates in {key}: {str(e)}")
+    return removed
 
-            # Generate content hash for session tracking and caching
-            content_hash = hashlib.sha256(page_text.encode('utf-8')).hexdigest()
-            
-            # Add current page to session pages
-            session_pages[pageURL] = {
-                'text': page_text,
-                'contentHash': content_hash
-            }
-            
-            # Multi-page Retrieval Strategy:
-            # 1. Build current page retriever first
-            current_retriever = build_page_retriever(page_text, page_url=pageURL)
-            
-            # 2. Load previous page retrievers from cache
-            previous_retrievers = []
-            for url, data in session_pages.items():
-                if url == pageURL:
-                    continue  # Skip current page
-                
-                prev_hash = data.get('contentHash')
-                if prev_hash:
-                    r = load_retriever_from_hash(prev_hash, page_url=url)
-                    if r:
-                        previous_retrievers.append(r)
-            
-            # 3. Combine retrievers with current page as last element
-            retriever = previous_retrievers + [current_retriever]
-                
-            # Prepare pages content for contextual prompt construction
-            pages_with_content = session_pages
 
-            # Prepare image for multimodal input
-            image_data_base64 = None
-            image_media_type = None
-            if ImageURL and ImageURL.strip():
-                try:
-                    # Configure HTTP headers to prevent access restrictions
-                    headers = {
-                        'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36',
-                        'Accept': 'image/avif,image/webp,image/apng,image/svg+xml,image/*,*/*;q=0.8',
-                        'Accept-Language': 'en-US,en;q=0.9',
-                        'Referer': pageURL
-                    }
-                    response = requests.get(ImageURL, timeout=10, headers=headers)
-                    response.raise_for_status()
-                    imageData = response.content
-                    
-                    image = Image.open(io.BytesIO(imageData))
-                    width, height = image.size
-                    img_format = image.format
-
-                    # Optimize image dimensions for vision model processing
-                    max_dimension = 512
-                    if max(width, height) > max_dimension:
-                        scaling_factor = max_dimension / max(width, height)
-                        new_width = int(width * scaling_factor)
-                        new_height = int(height * scaling_factor)
-
-                        image = image.resize((new_width, new_height), Image.Resampling.LANCZOS)
-                        # Compress image to JPEG format for efficient processing
-                        buf = io.BytesIO()
-                        if img_format == 'PNG' and image.mode == 'RGBA':
-                            # Convert RGBA to RGB for JPEG compatibility
-                            background = Image.new('RGB', image.size, (255, 255, 255))
-                            background.paste(image, mask=image.split()[3])
-                            background.save(buf, format='JPEG', quality=75)
-                        else:
-                            image.convert('RGB').save(buf, format='JPEG', quality=75)
-                        buf.seek(0)
-                        imageData = buf.getvalue()
-                        img_format = 'JPEG'
-                    else:
-                        # Even if not resizing, still convert to JPEG for consistency
-                        buf = io.BytesIO()
-                        if img_format == 'PNG' and image.mode == 'RGBA':
-                            background = Image.new('RGB', image.size, (255, 255, 255))
-                            background.paste(image, mask=image.split()[3])
-                            background.save(buf, format='JPEG', quality=75)
-                        else:
-                            image.convert('RGB').save(buf, format='JPEG', quality=75)
-                        buf.seek(0)
-                        imageData = buf.getvalue()
-                        img_format = 'JPEG'
-
-                    # Convert to base64 for Bedrock
-                    image_data_base64 = base64.b64encode(imageData).decode('utf-8')
-                    
-                    # Map format to media type
-                    format_map = {
-                        'jpeg': 'image/jpeg',
-                        'jpg': 'image/jpeg',
-                        'png': 'image/png',
-                        'gif': 'image/gif',
-                        'webp': 'image/webp'
-                    }
-                    img_format_lower = (img_format or 'jpeg').lower()
-                    image_media_type = format_map.get(img_format_lower, 'image/jpeg')
-                except Exception as img_err:
-                    import traceback
-
-            # Initialize LLM and tools
-            llm = make_bedrock_llm()
-            
-            # Handle image questions differently - call LLM directly with vision
-            if image_data_base64:
-                # Use Bedrock Converse API directly for Llama vision
-                try:
-                    # Decode base64 to bytes for Converse API
-                    image_bytes = base64.b64decode(image_data_base64)
-                    response = bedrock_runtime.converse(
-                        modelId=MODEL_ID,
-                        messages=[
-                            {
-                                "role": "user",
-                                "content": [
-                                    {
-                                        "image": {
-                                            "format": "jpeg",
-                                            "source": {
-                                                "bytes": image_bytes
-                                            }
-                                        }
-                                    },
-                                    {
-                                        "text": prompt
-                                    }
-                                ]
-                            }
-                        ],
-                        inferenceConfig={
-                            "temperature": 0.2,
-                            "maxTokens": 1024
-                        }
-                    )
-                    
-                    generated_text = response['output']['message']['content'][0]['text']
-                except Exception as e:
-                    import traceback
-                    # Provide error message if image analysis fails
-                    generated_text = f"I was able to fetch the image, but encountered an error analyzing it: {str(e)}"
-                
-            else:
-                # Process text query using direct retrieval-augmented generation
-                
-                # Construct conversation history context
-                conversation_context = ""
-                if previous_messages:
-                    conversation_context = "\n\nCONVERSATION HISTORY (Last messages):\n"
-                    for msg in previous_messages[-100:]:  # Last 100 for context window
-                        conversation_context += f"User: {msg.get('question', '')}\n"
-                        conversation_context += f"You: {msg.get('answer', '')}\n"
-                    conversation_context += "\n"
-                
-                # Build pages context with numbering
-                pages_context = ""
-                if len(pages_with_content) > 1:
-                    pages_context = f"\n\nIMPORTANT - BROWSING SESSION CONTEXT:\n"
-                    pages_context += f"The user is browsing through multiple pages in this session. You have access to content from ALL pages visited (in order):\n"
-                    for idx, url in enumerate(pages_with_content.keys(), 1):
-                        if url == pageURL:
-                            pages_context += f"{idx}. {url} ← CURRENT PAGE\n"
-                        else:
-                            pages_context += f"{idx}. {url}\n"
-                    pages_context += f"\nWhen user says 'previous page' or 'previous one', they mean the page that came BEFORE the current page in this numbered list.\n"
-                
-                # Build user context
-                user_context = ""
-                if user_first_name and user_last_name:
-                    user_context = f"\n\nUSER INFORMATION:\nYou are talking to {user_first_name} {user_last_name}.\n"
-                
-                # Retrieve relevant content from current and previous pages
-                all_docs = []
-                
-                if retriever:
-                    # Extract and tag content from current page
-                    current_retriever = retriever[-1]
-                    if current_retriever:
-                        try:
-                            current_retriever.search_kwargs = {"k": 5}
-                            docs = current_retriever.invoke(prompt)
-                            for doc in docs:
-                                doc.metadata['page_priority'] = 'current'
-                            all_docs.extend(docs)
-                        except Exception as e:
-                            pass
-                    
-                    # Extract and tag content from previous pages
-                    for idx, prev_retriever in enumerate(retriever[:-1]):
-                        if prev_retriever:
-                            try:
-                                prev_retriever.search_kwargs = {"k": 5}
-                                docs = prev_retriever.invoke(prompt)
-                                for doc in docs:
-                                    doc.metadata['page_priority'] = 'previous'
-                                all_docs.extend(docs)
-                            except Exception as e:
-                                pass
-                
-                # Deduplicate by content
-                seen = set()
-                unique_docs = []
-                for d in all_docs:
-                    content = d.page_content.strip()
-                    if content and content not in seen:
-                        seen.add(content)
-                        unique_docs.append(d)
-                
-                # Organize retrieved content by page priority
-                current_chunks = [d for d in unique_docs if d.metadata.get('page_priority') == 'current']
-                previous_chunks = [d for d in unique_docs if d.metadata.get('page_priority') == 'previous']
-                
-                # Construct structured context for model input
-                retrieved_content = ""
-                if current_chunks:
-                    retrieved_content += "=== CURRENT PAGE CONTENT ===\n"
-                    retrieved_content += "\n---\n".join(d.page_content for d in current_chunks[:15])
-                    retrieved_content += "\n\n"
-                
-                if previous_chunks:
-                    retrieved_content += "=== PREVIOUS PAGES CONTENT (for context) ===\n"
-                    retrieved_content += "\n---\n".join(d.page_content for d in previous_chunks[:15])
-                
-                if not retrieved_content:
-                    retrieved_content = "No relevant page content found."
-                
-                # Generate AI response using retrieved context
-                message_content = (
-                    f"You are QuickPage, a friendly and helpful AI assistant that helps users understand web pages.\n\n"
-                    f"ABOUT YOURSELF:\n"
-                    f"- Your name is QuickPage\n"
-                    f"- You're a browser extension that helps users quickly understand web page content\n"
-                    f"- You can read any web page, answer questions about it, and provide insights\n"
-                    f"- You remember the conversation history and all pages visited in this session\n\n"
-                    f"{user_context}"
-                    f"{conversation_context}"
-                    f"CURRENT BROWSING SESSION:\n"
-                    f"Currently viewing: {pageURL}\n"
-                    f"{pages_context}"
-                    f"\n=== RELEVANT PAGE CONTENT ===\n"
-                    f"(Content is organized with CURRENT page first, then PREVIOUS pages for context)\n\n"
-                    f"{retrieved_content}\n"
-                    f"=== END OF PAGE CONTENT ===\n\n"
-                    f"IMPORTANT INSTRUCTIONS:\n"
-                    f"1. Content above is clearly marked as 'CURRENT PAGE' vs 'PREVIOUS PAGES'.\n"
-                    f"2. Naturally understand what the user is asking about - it could be about the current page or previous pages. If the question is vague, consider it about the current page.\n"
-                    f"3. Answer questions in a NATURAL, CONVERSATIONAL way - like a helpful friend, not a formal analyst.\n"
-                    f"4. AVOID formal phrases like 'According to my analysis...', 'Based on my findings...', etc. Just answer directly!\n"
-                    f"5. CONVERSATION FLOW - CRITICAL RULES:\n"
-                    f"   - USE the conversation history to understand what the user is talking about. User questions almost always depend on previous questions and answers.\n"
-                    f"   - The user is continuing the conversation - understand context from their previous messages to know what they're referring to.\n"
-                    f"   - DO NOT explain what they're doing. DO NOT say 'It seems like...', 'You're acknowledging...', 'Would you like to know more...', 'you asked this earlier', 'as I mentioned'.\n"
-                    f"   - Just answer naturally, incorporating the context from previous messages without explicitly mentioning the conversation itself.\n"
-                    f"   - Example: If user asks 'what is the area of Texas?' then 'compare it with Florida', understand they mean compare Texas with Florida.\n"
-                    f"6. Only if information is NOT found in the page content, then you may use general knowledge and state: "
-                    f"'This information isn't available on the pages you've visited, but [your answer]'\n"
-                    f"7. Be confident and direct - just give the answer naturally!\n\n"
-                    f"User question: {prompt}"
-                )
-                
-                response = llm.invoke(message_content)
-                generated_text = response.content
+def cleanup_orphaned_hashes(content_hashes):
+    """Drop cached page indexes that no remaining chat item refers to.
 
-            # Persist conversation data to DynamoDB
-            session_title = prompt[:50] + ('...' if len(prompt) > 50 else '')
-            
-            # Determine if this is the initial message in the session
+    Needs the contentHash index to prove a hash is unreferenced; without it
+    nothing is removed. Pages read within ORPHAN_MIN_IDLE_SECONDS and pages
+    still being built (by an ask or a preload job) are kept; the cache item
+    is deleted under that condition before its index versions are.
+    """
+    removed = 0
+    cutoff = int(time.time()) - ORPHAN_MIN_IDLE_SECONDS
+    for content_hash in content_hashes:
+        try:
+            response = table.query(
+                IndexName=CHAT_CONTENT_HASH_INDEX,
+                KeyConditionExpression=Key('contentHash').eq(content_hash),
+                Select='COUNT',
+                Limit=1
+            )
+        except ClientError as e:
+            if e.response.get('Error', {}).get('Code') == 'ValidationException':
+                return removed
+            continue
+        if response.get('Count', 0) > 0:
+            continue
+        
+        try:
+            old = cache_table.delete_item(
+                Key={'contentHash': content_hash},
+                ConditionExpression=(
+                    'attribute_exists(contentHash) '
+                    'AND (attribute_not_exists(lastAccessed) OR lastAccessed < :cutoff) '
+                    'AND NOT #s IN (:processing, :partial)'
+                ),
+                ExpressionAttributeNames={'#s': 'status'},
+                ExpressionAttributeValues={':cutoff': cutoff, ':processing': 'processing', ':partial': 'partial'},
+                ReturnValues='ALL_OLD'
+            ).get('Attributes', {})
+        except ClientError as e:
+            if not is_conditional_check_failure(e):
+                print(f"Orphan cleanup failed for {content_hash}: {str(e)}")
+            continue
+        
+        # Only the versions the deleted item published: a build that starts
+        # after this point writes a new version that must survive
+        forget_index(content_hash)
+        versions = {old.get('indexVersion', 'legacy'), old.get('previousVersion')} - {None}
+        if read_local_version(content_hash) in versions:
             try:
-                existing = table.query(
-                    KeyConditionExpression=Key('sessionid').eq(session_id),
-                    Limit=1
-                )
-                is_first_message = len(existing.get('Items', [])) == 0
-            except:
-                is_first_message = True
-            
-            item = {
-                'sessionid': session_id,
-                'timestamp': timestamp,
-                'userId': user_id,
-                'question': prompt,
-                'answer': generated_text,
-                'ImageURL': ImageURL,
-                'pageURL': pageURL,
-                'pageContent': pageContent,
-                'contentHash': content_hash,
-                'lastMessageAt': timestamp
-            }
-            
-            # Initialize session metadata for new conversations
-            if is_first_message:
-                item['sessionTitle'] = session_title
-                item['createdAt'] = timestamp
-            
-            table.put_item(Item=item)
-
-            # Construct and return the response to the client
-            return {
-                'statusCode': 200,
-                'headers': {
-                    'Content-Type': 'application/json',
-                    'Access-Control-Allow-Origin': '*',
-                    'Access-Control-Allow-Headers': 'Content-Type, Authorization',
-                    'Access-Control-Allow-Methods': 'POST, OPTIONS'
-                },
-                'body': json.dumps({
-                    'prompt': prompt,
-                    'response': generated_text
-                })
-            }
-        except Exception as e:
-            # Handle errors
-            return {
-                'statusCode': 500,
-                'headers': {
-                    'Content-Type': 'application/json',
-                    'Access-Control-Allow-Origin': '*',
-                    'Access-Control-Allow-Headers': 'Content-Type, Authorization',
-                    'Access-Control-Allow-Methods': 'POST, OPTIONS'
-                },
-                'body': json.dumps({
-                    'error': str(e)
-                })
-            }
+                os.remove(f"/tmp/faiss_{content_hash}/CURRENT")
+            except OSError:
+                pass
+        for version in versions:
+            try:
+                delete_index_version(content_hash, version)
+            except Exception as e:
+                print(f"Could not delete index version {content_hash}/{version}: {str(e)}")
+        removed += 1
+    return removed
 
-# Function to delete chat history from DynamoDB
-def delete_chat_history(session_id, user_id):
-    try:
-        # Query for items with the given session_id
-        response = table.query(
-            KeyConditionExpression=Key('sessionid').eq(session_id)
-        )
-        items = response['Items']
-        
-        # Filter by userId in Python
-        if user_id and user_id != 'anonymous':
-            items = [item for item in items if item.get('userId') == user_id]
 
-        # Delete each item in the chat history
-        with table.batch_writer() as batch:
-            for item in items:
-                batch.delete_item(
-                    Key={
-                        'sessionid': item['sessionid'],
-                        'timestamp': item['timestamp']
-                    }
-                )
-        return f"Deleted {len(items)} items for session {session_id}."
-    except Exception as e:
-        return f"Error deleting items: {str(e)}"
+def log_delete_throughput(operation, deleted, started):
+    """Log deletion throughput and return the elapsed milliseconds."""
+    elapsed_ms = int((time.monotonic() - started) * 1000)
+    print(json.dumps({
+        'metric': 'delete_throughput',
+        'operation': operation,
+        'deletedItems': deleted,
+        'elapsedMs': elapsed_ms,
+        'itemsPerSecond': round(deleted / max(elapsed_ms / 1000, 0.001), 1)
+    }))
+    return elapsed_ms
 
 
 # Function to list all chat sessions
@@ -915,20 +2896,25 @@ def get_session_history(session_id, user_id):
         return {'session': {}, 'messages': [], 'error': str(e)}
 
 def get_session_conversation_history(session_id, user_id, limit=100):
-    """Get conversation history and all pages visited in this session."""
+    """Get conversation history and all pages visited in this session.
+
+    Returns None if the history could not be read.
+    """
     try:
-        response = table.query(
-            KeyConditionExpression=Key('sessionid').eq(session_id),
-            ScanIndexForward=False,  # Most recent first
-            Limit=limit
-        )
+        # Only the fields used below are read; pageContent stays in the table
+        query_kwargs = {
+            'KeyConditionExpression': Key('sessionid').eq(session_id),
+            'ScanIndexForward': False,  # Most recent first
+            'Limit': limit,
+            'ProjectionExpression': 'question, answer, #ts, pageURL, contentHash',
+            'ExpressionAttributeNames': {'#ts': 'timestamp'}
+        }
+        if user_id and user_id != 'anonymous':
+            query_kwargs['FilterExpression'] = Attr('userId').eq(user_id)
+        response = table.query(**query_kwargs)
         
         items = response['Items']
         
-        # Filter by userId in Python
-        if user_id and user_id != 'anonymous':
-            items = [item for item in items if item.get('userId') == user_id]
-        
         # Reverse to get chronological order
         items.reverse()
         
@@ -949,12 +2935,412 @@ def get_session_conversation_history(session_id, user_id, limit=100):
             if page_url and page_url not in pages:
                 pages[page_url] = {
                     'text': '',  # Empty - we'll only use current page
-                    'contentHash': item.get('contentHash', '')
+                    'contentHash': item.get('contentHash', ''),
+                    'firstVisit': item.get('timestamp', 0)
                 }
+            if page_url:
+                pages[page_url]['lastVisit'] = item.get('timestamp', 0)
         
         return {
             'messages': messages,
             'pages': pages
         }
     except Exception as e:
-        return {'messages': [], 'pages': {}}
+        print(f"Could not read history for session {session_id}: {str(e)}")
+        return None
+
+
+# Session page manifests. One small cache_table item per session maps each
+# visited page URL to its content hash, visit times and keywords, so an ask
+# reads every page of a long session with one key lookup.
+def session_manifest_key(session_id):
+    return f"session#{session_id}"
+
+
+def page_keywords(page_text, limit=None):
+    """Most frequent distinctive words of a page, used to rank it for later questions.
+
+    Words are matched one at a time so no lowercased copy of the page or
+    list of every word is built.
+    """
+    counts = Counter(match.group().lower() for match in re.finditer(r'[A-Za-z]{4,}', page_text))
+    for word in KEYWORD_STOPWORDS:
+        counts.pop(word, None)
+    return [word for word, _ in counts.most_common(limit or SESSION_PAGE_KEYWORDS)]
+
+
+def get_session_manifest(session_id, user_id):
+    """Return the session's pages in visit order, or None if it has no manifest."""
+    try:
+        item = cache_table.get_item(
+            Key={'contentHash': session_manifest_key(session_id)},
+            ProjectionExpression='userId, pages'
+        ).get('Item')
+    except Exception:
+        return None
+    if not item:
+        return None
+    if user_id and user_id != 'anonymous' and item.get('userId') != user_id:
+        return None
+    
+    pages = sorted(item.get('pages', {}).items(), key=lambda kv: kv[1].get('firstVisit', 0))
+    return {
+        url: {
+            'text': '',
+            'contentHash': data.get('contentHash', ''),
+            'firstVisit': int(data.get('firstVisit', 0)),
+            'lastVisit': int(data.get('lastVisit', 0)),
+            'keywords': list(data.get('keywords', []))
+        }
+        for url, data in pages
+    }
+
+
+def record_page_visit(session_id, user_id, page_url, entry, page_text=None, session_pages=None):
+    """Add or refresh one page in the session manifest.
+
+    Keywords still to compute (None in the entry) are counted from page_text
+    here, off the ask's critical path. Pages of session_pages past
+    SESSION_MANIFEST_MAX_PAGES, least recently visited first, are removed.
+    """
+    key = {'contentHash': session_manifest_key(session_id)}
+    keywords = entry['keywords']
+    if keywords is None:
+        keywords = page_keywords(page_text) if page_text else []
+    page = {
+        'contentHash': entry['contentHash'],
+        'firstVisit': entry['firstVisit'],
+        'lastVisit': entry['lastVisit'],
+        'keywords': keywords
+    }
+    
+    others = sorted(
+        (url for url in (session_pages or {}) if url != page_url),
+        key=lambda url: -session_pages[url].get('lastVisit', 0)
+    )
+    dropped = others[max(0, SESSION_MANIFEST_MAX_PAGES - 1):]
+    update_expression = 'SET pages.#u = :page, updatedAt = :now'
+    names = {'#u': page_url}
+    if dropped:
+        names.update({f'#d{i}': url for i, url in enumerate(dropped)})
+        update_expression += ' REMOVE ' + ', '.join(f'pages.#d{i}' for i in range(len(dropped)))
+    
+    def update_page():
+        cache_table.update_item(
+            Key=key,
+            UpdateExpression=update_expression,
+            ConditionExpression='attribute_exists(pages) AND userId = :uid',
+            ExpressionAttributeNames=names,
+            ExpressionAttributeValues={':page': page, ':now': entry['lastVisit'], ':uid': user_id}
+        )
+    
+    try:
+        update_page()
+        return
+    except ClientError as e:
+        if not is_conditional_check_failure(e):
+            raise
+    
+    # First page of the session. If another request created the manifest
+    # in the meantime, add the page to theirs instead.
+    try:
+        cache_table.put_item(
+            Item={
+                'contentHash': key['contentHash'],
+                'userId': user_id,
+                'pages': {page_url: page},
+                'updatedAt': entry['lastVisit']
+            },
+            ConditionExpression='attribute_not_exists(contentHash)'
+        )
+    except ClientError as e:
+        if not is_conditional_check_failure(e):
+            raise
+        update_page()
+
+
+def rank_previous_pages(session_pages, current_url, question=None, limit=None):
+    """Pick the earlier pages whose indexes an ask should search.
+
+    Each page scores by recency (1 for the latest, 1/2 for the one before, ...)
+    plus the share of the question's words found in its keywords. The best
+    pages are returned in visit order; pages sharing an index (with each
+    other or the current page) count once.
+    """
+    limit = SESSION_MAX_PREVIOUS_PAGES if limit is None else limit
+    candidates = [
+        (url, data) for url, data in session_pages.items()
+        if url != current_url and data.get('contentHash')
+    ]
+    by_recency = sorted(candidates, key=lambda c: -c[1].get('lastVisit', 0))
+    terms = set(re.findall(r'[a-z]{4,}', question.lower())) - KEYWORD_STOPWORDS if question else set()
+    
+    scored = []
+    for rank, (url, data) in enumerate(by_recency):
+        score = 1 / (1 + rank)
+        if terms:
+            score += len(terms & set(data.get('keywords', []))) / len(terms)
+        scored.append((score, url, data))
+    scored.sort(key=lambda s: -s[0])
+    
+    # The current page's index is searched anyway
+    chosen = []
+    seen_hashes = {session_pages.get(current_url, {}).get('contentHash')}
+    for _, url, data in scored:
+        if len(chosen) >= limit:
+            break
+        if data['contentHash'] in seen_hashes:
+            continue
+        seen_hashes.add(data['contentHash'])
+        chosen.append((url, data))
+    
+    order = list(session_pages)
+    return sorted(chosen, key=lambda c: order.index(c[0]))
+
+
+def delete_session_manifests(session_ids, user_id):
+    """Remove the page manifests of deleted sessions (only the caller's own)."""
+    def delete_one(session_id):
+        kwargs = {'Key': {'contentHash': session_manifest_key(session_id)}}
+        if user_id and user_id != 'anonymous':
+            kwargs['ConditionExpression'] = 'attribute_not_exists(contentHash) OR userId = :uid'
+            kwargs['ExpressionAttributeValues'] = {':uid': user_id}
+        try:
+            cache_table.delete_item(**kwargs)
+        except ClientError as e:
+            if not is_conditional_check_failure(e):
+                raise
+    
+    for future in [io_executor.submit(delete_one, session_id) for session_id in session_ids]:
+        future.result()
+
+
+# Bulk preload jobs. A job item lives in cache_table next to the per-hash
+# index items, keyed as job#<id>. Page texts are staged in S3 because the
+# async invocation payload is capped at 256 KB.
+def preload_job_key(job_id):
+    return f"job#{job_id}"
+
+
+def start_preload_job(pages, user_id, context=None):
+    """Register a bulk preload job and hand it to an async worker invocation."""
+    # Checked before anything is staged: the job could never run
+    if lambda_function_name(context) and not INTERNAL_INVOKE_SECRET:
+        return {'status': 'error', 'message': 'Bulk preload is not configured (INTERNAL_INVOKE_SECRET is not set)'}
+    
+    job_id = str(uuid.uuid4())
+    
+    # Deduplicate pages by content hash
+    job_pages = []
+    texts_by_hash = {}
+    for page in pages:
+        if not isinstance(page, dict):
+            continue
+        try:
+            page_text = parse_page_text(page.get('pageContent', ''))
+        except Exception:
+            continue
+        if not page_text:
+            continue
+        content_hash = content_hash_of(page_text)
+        texts_by_hash.setdefault(content_hash, page_text)
+        job_pages.append({'pageURL': page.get('pageURL', ''), 'contentHash': content_hash})
+    
+    if not job_pages:
+        return {'status': 'skipped', 'reason': 'no_content'}
+    
+    # Stage page texts for the worker in parallel
+    uploads = [
+        s3_transfer_executor.submit(
+            s3_client.put_object,
+            Bucket=CACHE_BUCKET,
+            Key=f"preload-jobs/{job_id}/{content_hash}.txt",
+            Body=page_text.encode('utf-8')
+        )
+        for content_hash, page_text in texts_by_hash.items()
+    ]
+    for upload in uploads:
+        upload.result()
+    
+    cache_table.put_item(
+        Item={
+            'contentHash': preload_job_key(job_id),
+            'userId': user_id,
+            'status': 'queued',
+            'pages': job_pages,
+            'uniquePages': len(texts_by_hash),
+            'createdAt': int(time.time()),
+            'ttl': int(time.time()) + (24 * 60 * 60)
+        }
+    )
+    
+    # Run the job in a separate invocation so this request returns at once.
+    # Outside Lambda (no function name) fall back to a background thread.
+    if not invoke_self_async({'action': 'runPreloadJob', 'job_id': job_id}, context=context):
+        start_background_task(f"preload-{job_id[:8]}", run_preload_job, job_id)
+    
+    return {
+        'status': 'queued',
+        'job_id': job_id,
+        'pages': len(job_pages),
+        'uniquePages': len(texts_by_hash)
+    }
+
+
+def run_preload_job(job_id):
+    """Build indexes for every unique page of a preload job.
+
+    A page whose build, staged-text fetch or index upload failed is marked
+    failed in cache_table with the error. The job ends done, partial (some
+    pages failed) or failed (all did).
+    """
+    job = cache_table.get_item(Key={'contentHash': preload_job_key(job_id)}).get('Item')
+    if not job:
+        return {'status': 'error', 'message': 'job not found'}
+    
+    cache_table.update_item(
+        Key={'contentHash': preload_job_key(job_id)},
+        UpdateExpression='SET #s = :status, startedAt = :now',
+        ExpressionAttributeNames={'#s': 'status'},
+        ExpressionAttributeValues={':status': 'running', ':now': int(time.time())}
+    )
+    
+    # Skip hashes that already have a ready index
+    unique_hashes = list(dict.fromkeys(p['contentHash'] for p in job.get('pages', [])))
+    statuses = get_cache_statuses(unique_hashes)
+    pending = [h for h in unique_hashes if statuses.get(h, {}).get('status') != 'ready']
+    
+    def build_one(content_hash):
+        if background_stopping.is_set():
+            raise BackgroundWorkStopped('server shut down before the page was built')
+        s3_key = f"preload-jobs/{job_id}/{content_hash}.txt"
+        page_text = s3_client.get_object(Bucket=CACHE_BUCKET, Key=s3_key)['Body'].read().decode('utf-8')
+        with bedrock_limiter.lane('background'):
+            build_page_retriever(page_text, wait_for_full=True, content_hash=content_hash)
+        s3_client.delete_object(Bucket=CACHE_BUCKET, Key=s3_key)
+    
+    # Pages build in parallel, sharing one embedding concurrency budget
+    errors = {}
+    interrupted = set()
+    with ThreadPoolExecutor(max_workers=PRELOAD_EMBED_CONCURRENCY) as pool:
+        futures = {h: pool.submit(build_one, h) for h in pending}
+        for content_hash, future in futures.items():
+            try:
+                future.result()
+            except BackgroundWorkStopped as e:
+                errors[content_hash] = str(e)
+                interrupted.add(content_hash)
+            except Exception as e:
+                errors[content_hash] = str(e)
+    
+    # Index persistence is deferred; make sure it lands before finishing.
+    # A failed upload only shows as a failed write here, so every page is
+    # checked for a ready index afterwards.
+    write_stats = drain_pending_writes(timeout=None)
+    write_failures = sum(
+        1 for w in write_stats['writes'] if w['name'].startswith('page_index') and not w['ok']
+    )
+    built = get_cache_statuses(pending, consistent=True)
+    for content_hash in pending:
+        if built.get(content_hash, {}).get('status') != 'ready':
+            errors.setdefault(content_hash, built.get(content_hash, {}).get('error') or 'index was not saved')
+    for content_hash, error in errors.items():
+        # An interrupted build keeps its snapshot; the next ask resumes it
+        if content_hash not in interrupted:
+            mark_page_failed(content_hash, error)
+    
+    failed = len(errors)
+    status = 'done' if not failed else 'failed' if failed == len(pending) else 'partial'
+    cache_table.update_item(
+        Key={'contentHash': preload_job_key(job_id)},
+        UpdateExpression='SET #s = :status, finishedAt = :now, failedPages = :failed, writeFailures = :writes',
+        ExpressionAttributeNames={'#s': 'status'},
+        ExpressionAttributeValues={
+            ':status': status,
+            ':now': int(time.time()),
+            ':failed': failed,
+            ':writes': write_failures
+        }
+    )
+    return {'status': status, 'built': len(pending) - failed, 'failed': failed}
+
+
+def mark_page_failed(content_hash, error):
+    """Record a failed page build in cache_table, unless an index is ready."""
+    try:
+        cache_table.update_item(
+            Key={'contentHash': content_hash},
+            UpdateExpression='SET #s = :failed, #e = :error, #ttl = if_not_exists(#ttl, :ttl)',
+            ConditionExpression='attribute_not_exists(contentHash) OR #s <> :ready',
+            ExpressionAttributeNames={'#s': 'status', '#e': 'error', '#ttl': 'ttl'},
+            ExpressionAttributeValues={
+                ':failed': 'failed',
+                ':ready': 'ready',
+                ':error': error,
+                ':ttl': int(time.time()) + 3600
+            }
+        )
+    except ClientError as e:
+        if not is_conditional_check_failure(e):
+            print(f"Could not mark {content_hash} failed: {str(e)}")
+
+
+def get_cache_statuses(content_hashes, consistent=False):
+    """Fetch build status fields of cache_table items for many content hashes."""
+    return get_cache_items(content_hashes, ('status', 'numChunks', 'error'), consistent=consistent)
+
+
+def get_cache_items(content_hashes, fields, consistent=False):
+    """Fetch the given fields of cache_table items with batch_get_item."""
+    names = {f'#f{i}': field for i, field in enumerate(fields)}
+    items = {}
+    for start in range(0, len(content_hashes), 100):
+        request = {
+            cache_table.name: {
+                'Keys': [{'contentHash': h} for h in content_hashes[start:start + 100]],
+                'ProjectionExpression': ', '.join(['contentHash'] + list(names)),
+                'ExpressionAttributeNames': names,
+                'ConsistentRead': consistent
+            }
+        }
+        while request:
+            response = dynamodb.batch_get_item(RequestItems=request)
+            for item in response.get('Responses', {}).get(cache_table.name, []):
+                items[item['contentHash']] = item
+            request = response.get('UnprocessedKeys') or None
+    return items
+
+
+def get_preload_job_status(job_id, user_id):
+    """Report per-page progress of a preload job from cache_table."""
+    job = cache_table.get_item(Key={'contentHash': preload_job_key(job_id)}).get('Item')
+    if not job or job.get('userId') != user_id:
+        return {'status': 'error', 'message': 'job not found'}
+    
+    pages = job.get('pages', [])
+    statuses = get_cache_statuses(list(dict.fromkeys(p['contentHash'] for p in pages)))
+    
+    # Once the worker has finished, a page with no cache item was never built
+    # (its failure record may have expired) rather than still pending
+    finished = job.get('status') in ('done', 'partial', 'failed')
+    page_statuses = []
+    counts = {'ready': 0, 'processing': 0, 'failed': 0, 'pending': 0}
+    for page in pages:
+        item = statuses.get(page['contentHash'], {})
+        status = item.get('status', 'failed' if finished else 'pending')
+        counts[status] = counts.get(status, 0) + 1
+        entry = {'pageURL': page['pageURL'], 'contentHash': page['contentHash'], 'status': status}
+        if item.get('numChunks') is not None:
+            entry['numChunks'] = item['numChunks']
+        if item.get('error'):
+            entry['error'] = item['error']
+        page_statuses.append(entry)
+    
+    return {
+        'job_id': job_id,
+        'status': job.get('status'),
+        'failedPages': job.get('failedPages', 0),
+        'createdAt': job.get('createdAt'),
+        'progress': counts,
+        'pages': page_statuses
+    }
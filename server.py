@@ -0,0 +1,188 @@
+"""Long-running HTTP server for self-hosted deployments.
+
+Serves the same actions as the Lambda function from one persistent
+process: requests are handled by a fixed worker pool, AWS clients keep
+their connection pools open between requests, and page indexes stay in
+the shared in-memory cache. SIGTERM/SIGINT stop accepting connections,
+finish in-flight requests, stop background builds at their next step
+(preload jobs record the pages left unbuilt) and flush deferred writes
+before exiting.
+
+    python server.py --port 8080 --workers 16
+"""
+import argparse
+import base64
+import json
+import os
+import signal
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+
+def configured_workers():
+    """--workers (or SERVER_WORKERS), read before lambda_function is imported."""
+    parser = argparse.ArgumentParser(add_help=False)
+    parser.add_argument('--workers', type=int, default=int(os.environ.get('SERVER_WORKERS', '16')))
+    return parser.parse_known_args()[0].workers
+
+
+# Set before import: lambda_function reads its config at import time.
+# A persistent process keeps page indexes in memory between requests; the
+# cache is bounded by estimated index bytes (1 GiB unless configured).
+os.environ['INDEX_CACHE_MAX_BYTES'] = os.environ.get('SERVER_INDEX_CACHE_MAX_BYTES', str(1024 ** 3))
+
+# The shared pools are sized for one Lambda request at a time. Here every
+# HTTP worker can run an ask at once, each queueing up to ~9 reads (history,
+# manifest, page indexes, image) and ~3 deferred writes; queue time counts
+# against the read deadlines, so the pools grow with the worker count.
+# The Lambda-sized settings in .env are replaced; SERVER_* ones still win.
+SERVER_WORKER_COUNT = configured_workers()
+for name, per_worker, minimum in (
+    ('IO_MAX_WORKERS', 9, 16),
+    ('WRITE_MAX_WORKERS', 3, 4),
+    ('S3_TRANSFER_MAX_WORKERS', 3, 16),
+    ('AWS_MAX_POOL_CONNECTIONS', 12, 50),
+):
+    os.environ[name] = os.environ.get(f'SERVER_{name}', str(max(minimum, SERVER_WORKER_COUNT * per_worker)))
+
+import lambda_function
+
+SERVER_KEEPALIVE_SECONDS = float(os.environ.get('SERVER_KEEPALIVE_SECONDS', '5'))
+SERVER_MAX_BODY_BYTES = int(os.environ.get('SERVER_MAX_BODY_BYTES', str(10 * 1024 * 1024)))
+# Lambda deployments run the cache sweep from an EventBridge schedule
+SERVER_CACHE_SWEEP_SECONDS = float(os.environ.get('SERVER_CACHE_SWEEP_SECONDS', '3600'))
+# How long shutdown waits for preload jobs and ingestion to reach a stopping point
+SERVER_SHUTDOWN_TIMEOUT = float(os.environ.get('SERVER_SHUTDOWN_TIMEOUT_SECONDS', '60'))
+
+
+class QuickpageRequestHandler(BaseHTTPRequestHandler):
+    """Translate HTTP requests into API Gateway proxy events."""
+    protocol_version = 'HTTP/1.1'
+    # Idle keep-alive connections give their worker back after this long
+    timeout = SERVER_KEEPALIVE_SECONDS
+
+    def do_OPTIONS(self):
+        self.send_lambda_response({'statusCode': 200, 'headers': dict(lambda_function.CORS_HEADERS), 'body': ''})
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        if length > SERVER_MAX_BODY_BYTES:
+            self.send_lambda_response(lambda_function.build_response({}, 413, {'error': 'Request body too large'}))
+            self.close_connection = True
+            return
+        event = {
+            'httpMethod': 'POST',
+            'path': self.path,
+            'headers': dict(self.headers.items()),
+            'body': self.rfile.read(length).decode('utf-8', errors='replace'),
+            'isBase64Encoded': False
+        }
+
+        started = time.monotonic()
+        try:
+            response = lambda_function.handle_request(event, None)
+        except Exception as e:
+            # API Gateway would turn an unhandled error into a 502
+            response = lambda_function.build_response(event, 502, {'error': str(e)})
+        response_ms = int((time.monotonic() - started) * 1000)
+        self.send_lambda_response(response)
+
+        # The process outlives the request, so deferred writes are not waited
+        # for here; this only collects the ones that already finished.
+        write_stats = lambda_function.drain_pending_writes(timeout=0)
+        lambda_function.log_latency_metric(response, response_ms, write_stats, 0)
+
+    def send_lambda_response(self, response):
+        if response.get('isBase64Encoded'):
+            payload = base64.b64decode(response['body'])
+        else:
+            payload = (response.get('body') or '').encode('utf-8')
+
+        self.send_response(response.get('statusCode', 200))
+        for name, value in (response.get('headers') or {}).items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(payload)))
+        if self.server.stopping.is_set():
+            self.send_header('Connection', 'close')
+            self.close_connection = True
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        # The latency metric line already records every request
+        pass
+
+
+class PooledHTTPServer(HTTPServer):
+    """HTTPServer that handles connections on a bounded worker pool."""
+
+    def __init__(self, address, handler_class, workers):
+        super().__init__(address, handler_class)
+        self.stopping = threading.Event()
+        self.workers = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='quickpage-http')
+        self.sweeper = threading.Thread(target=self.sweep_cache, name='quickpage-sweep', daemon=True)
+        if SERVER_CACHE_SWEEP_SECONDS > 0:
+            self.sweeper.start()
+
+    def sweep_cache(self):
+        while not self.stopping.wait(SERVER_CACHE_SWEEP_SECONDS):
+            try:
+                lambda_function.run_cache_sweep()
+            except Exception as e:
+                print(json.dumps({'event': 'cache_sweep_failed', 'error': str(e)}))
+
+    def process_request(self, request, client_address):
+        self.workers.submit(self.process_request_worker, request, client_address)
+
+    def process_request_worker(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+    def stop(self):
+        """Stop accepting, let in-flight requests finish, stop background work, then flush writes."""
+        self.stopping.set()
+        self.shutdown()
+        self.workers.shutdown(wait=True)
+        self.server_close()
+        if self.sweeper.is_alive():
+            self.sweeper.join()
+        # Requests may have started background work until now
+        still_running = lambda_function.stop_background_tasks(timeout=SERVER_SHUTDOWN_TIMEOUT)
+        if still_running:
+            print(json.dumps({'event': 'background_tasks_abandoned', 'tasks': still_running}))
+        lambda_function.drain_pending_writes(timeout=None)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve the Quickpage API from a long-running process.')
+    parser.add_argument('--host', default=os.environ.get('SERVER_HOST', '0.0.0.0'))
+    parser.add_argument('--port', type=int, default=int(os.environ.get('SERVER_PORT', '8080')))
+    parser.add_argument('--workers', type=int, default=SERVER_WORKER_COUNT)
+    args = parser.parse_args()
+
+    server = PooledHTTPServer((args.host, args.port), QuickpageRequestHandler, args.workers)
+
+    stopper = threading.Thread(target=server.stop)
+
+    def handle_signal(signum, frame):
+        # shutdown() blocks until serve_forever returns, so run it elsewhere
+        if stopper.ident is None:
+            stopper.start()
+
+    signal.signal(signal.SIGTERM, handle_signal)
+    signal.signal(signal.SIGINT, handle_signal)
+
+    print(json.dumps({'event': 'listening', 'host': args.host, 'port': args.port, 'workers': args.workers}))
+    server.serve_forever()
+    stopper.join()
+    print(json.dumps({'event': 'stopped'}))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,147 @@
+"""Bedrock limiter against a fake model endpoint that throttles past a fixed capacity.
+
+Needs the packages from requirements.txt; no AWS access is used.
+
+    python -m unittest discover tests
+"""
+import os
+import sys
+import threading
+import time
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+
+from botocore.exceptions import ClientError, ReadTimeoutError
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import lambda_function  # noqa: E402
+
+
+class FakeBedrock:
+    """Answers up to `capacity` concurrent calls and throttles the rest."""
+
+    def __init__(self, capacity, latency=0.01, failures=None):
+        self.capacity = capacity
+        self.latency = latency
+        # Errors raised, in order, by the first calls (before the capacity check)
+        self.failures = list(failures or [])
+        self.lock = threading.Lock()
+        self.active = 0
+        self.peak = 0
+        self.throttled = 0
+        self.served = 0
+
+    def invoke_model(self, **kwargs):
+        with self.lock:
+            if self.failures:
+                raise self.failures.pop(0)
+            self.active += 1
+            over = self.active > self.capacity
+            if over:
+                self.throttled += 1
+            else:
+                self.peak = max(self.peak, self.active)
+        try:
+            if over:
+                raise ClientError({'Error': {'Code': 'ThrottlingException'}}, 'InvokeModel')
+            time.sleep(self.latency)
+            with self.lock:
+                self.served += 1
+            return kwargs['modelId']
+        finally:
+            with self.lock:
+                self.active -= 1
+
+
+def make_limiter(**kwargs):
+    settings = dict(requests_per_second=1000, burst=50, max_concurrency=16, max_retries=10,
+                    sleep=lambda seconds: time.sleep(seconds / 20))
+    settings.update(kwargs)
+    return lambda_function.BedrockRateLimiter(**settings)
+
+
+class BedrockLimiterTest(unittest.TestCase):
+
+    def test_throttles_are_retried_and_limit_settles_near_capacity(self):
+        fake = FakeBedrock(capacity=3)
+        limiter = make_limiter()
+        client = lambda_function.RateLimitedBedrockClient(fake, limiter)
+
+        with ThreadPoolExecutor(40) as pool:
+            results = list(pool.map(lambda i: client.invoke_model(modelId='m'), range(80)))
+
+        stats = limiter.snapshot()['m']
+        self.assertEqual(results, ['m'] * 80)
+        self.assertEqual(fake.served, 80)
+        self.assertGreater(stats['throttles'], 0)
+        # AIMD oscillates around the real capacity instead of drifting up to the cap
+        self.assertLessEqual(stats['concurrencyLimit'], fake.capacity + 2)
+
+    def test_limit_does_not_grow_below_saturation(self):
+        fake = FakeBedrock(capacity=3)
+        limiter = make_limiter(max_concurrency=16)
+        client = lambda_function.RateLimitedBedrockClient(fake, limiter)
+        start = limiter.for_model('m').limit
+
+        for _ in range(50):
+            client.invoke_model(modelId='m')
+
+        self.assertEqual(limiter.snapshot()['m']['concurrencyLimit'], start)
+
+    def test_transient_errors_are_retried_without_halving(self):
+        fake = FakeBedrock(capacity=3, failures=[
+            ClientError({'Error': {'Code': 'InternalServerException'}}, 'InvokeModel'),
+            ReadTimeoutError(endpoint_url='https://bedrock-runtime'),
+        ])
+        limiter = make_limiter()
+        client = lambda_function.RateLimitedBedrockClient(fake, limiter)
+        start = limiter.for_model('m').limit
+
+        self.assertEqual(client.invoke_model(modelId='m'), 'm')
+
+        stats = limiter.snapshot()['m']
+        self.assertEqual(stats['transientErrors'], 2)
+        self.assertEqual(stats['throttles'], 0)
+        self.assertEqual(stats['concurrencyLimit'], start)
+
+    def test_other_client_errors_are_not_retried(self):
+        fake = FakeBedrock(capacity=3, failures=[
+            ClientError({'Error': {'Code': 'ValidationException'}}, 'InvokeModel'),
+        ])
+        limiter = make_limiter()
+        client = lambda_function.RateLimitedBedrockClient(fake, limiter)
+
+        with self.assertRaises(ClientError):
+            client.invoke_model(modelId='m')
+        self.assertEqual(limiter.snapshot()['m']['calls'], 1)
+
+    def test_interactive_lane_finishes_ahead_of_background(self):
+        fake = FakeBedrock(capacity=3)
+        limiter = make_limiter()
+        finished = []
+
+        def job(lane):
+            with limiter.lane(lane):
+                limiter.call('m', fake.invoke_model, modelId='m')
+            finished.append(lane)
+
+        with ThreadPoolExecutor(40) as pool:
+            futures = [pool.submit(job, 'background') for _ in range(60)]
+            futures += [pool.submit(job, 'interactive') for _ in range(20)]
+            for future in futures:
+                future.result()
+
+        last_interactive = max(i for i, lane in enumerate(finished) if lane == 'interactive')
+        self.assertLess(last_interactive, len(finished) - 10)
+
+    def test_bound_lane_follows_work_onto_pool_threads(self):
+        limiter = make_limiter()
+        with ThreadPoolExecutor(1) as pool:
+            with limiter.lane('background'):
+                lane = pool.submit(limiter.bind_lane(limiter.current_lane)).result()
+        self.assertEqual(lane, 'background')
+
+
+if __name__ == '__main__':
+    unittest.main()
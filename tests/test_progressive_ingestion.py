@@ -0,0 +1,103 @@
+"""Chunk ordering and snapshot recovery for progressive ingestion.
+
+Needs the packages from requirements.txt; no AWS access is used.
+
+    python -m unittest discover tests
+"""
+import os
+import sys
+import unittest
+from types import SimpleNamespace
+from unittest import mock
+
+import faiss
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import lambda_function  # noqa: E402
+
+
+def chunks_about(n, topics=None):
+    """n filler chunks; topics maps a position to extra words for that chunk."""
+    return [f"filler text for chunk number {i} {(topics or {}).get(i, '')}" for i in range(n)]
+
+
+class PrioritizeChunksTest(unittest.TestCase):
+
+    def setUp(self):
+        patches = [
+            mock.patch.object(lambda_function, 'PROGRESSIVE_TOP_CHUNKS', 4),
+            mock.patch.object(lambda_function, 'PROGRESSIVE_VISIBLE_CHUNKS', 4),
+            mock.patch.object(lambda_function, 'PROGRESSIVE_FIRST_BATCH', 8),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def test_every_chunk_once_in_document_order_without_hints(self):
+        self.assertEqual(lambda_function.prioritize_chunks(chunks_about(20)), list(range(20)))
+
+    def test_visible_section_follows_the_top_of_the_page(self):
+        order = lambda_function.prioritize_chunks(chunks_about(100), scroll_ratio=0.5)
+        self.assertEqual(order[:4], [0, 1, 2, 3])
+        # Centered on chunk 50, PROGRESSIVE_VISIBLE_CHUNKS // 2 either side
+        self.assertEqual(order[4:9], [48, 49, 50, 51, 52])
+        self.assertEqual(sorted(order), list(range(100)))
+
+    def test_scroll_ratio_is_clamped_and_bad_values_ignored(self):
+        self.assertEqual(lambda_function.prioritize_chunks(chunks_about(50), scroll_ratio=7)[4:6], [48, 49])
+        self.assertEqual(lambda_function.prioritize_chunks(chunks_about(50), scroll_ratio='top'), list(range(50)))
+
+    def test_chunks_matching_rare_question_words_come_next(self):
+        chunks = chunks_about(60, {40: 'refund policy', 55: 'refund'})
+        order = lambda_function.prioritize_chunks(chunks, question='What is the refund policy?')
+        # Chunk 40 shares both rare words, chunk 55 one; common words score nothing
+        self.assertEqual(order[4:6], [40, 55])
+        self.assertEqual(len(order), 60)
+
+    def test_question_matches_are_capped_at_the_first_batch(self):
+        chunks = chunks_about(40, {i: 'pricing' for i in range(10, 40)})
+        order = lambda_function.prioritize_chunks(chunks, question='pricing')
+        self.assertEqual(order[4:12], list(range(10, 18)))
+        self.assertEqual(order[12:18], list(range(4, 10)))
+
+
+class IndexCoverageTest(unittest.TestCase):
+
+    def test_unknown_or_complete_indexes_count_as_full(self):
+        self.assertEqual(lambda_function.index_coverage({'type': 'flat'}), 1.0)
+        self.assertEqual(lambda_function.index_coverage({'numChunks': 0}), 1.0)
+        self.assertEqual(lambda_function.index_coverage({'numChunks': 80}), 1.0)
+
+    def test_partial_snapshot_coverage(self):
+        self.assertEqual(lambda_function.index_coverage({'numChunks': 200, 'embeddedChunks': 50}), 0.25)
+
+
+class SnapshotVectorsTest(unittest.TestCase):
+
+    def test_recovers_embeddings_by_chunk_position(self):
+        vectors = np.random.default_rng(0).normal(size=(3, 8)).astype('float32')
+        index = faiss.IndexFlatL2(8)
+        index.add(vectors)
+        # Snapshots store chunks out of page order; the docstore id maps back
+        docs = {
+            'a': SimpleNamespace(metadata={'chunk': 7}),
+            'b': SimpleNamespace(metadata={'chunk': 2}),
+            'c': SimpleNamespace(metadata={}),
+        }
+        store = SimpleNamespace(
+            index=index,
+            index_to_docstore_id={0: 'a', 1: 'b', 2: 'c'},
+            docstore=SimpleNamespace(search=docs.get),
+        )
+
+        recovered = lambda_function.snapshot_vectors(store)
+
+        self.assertEqual(sorted(recovered), [2, 7])
+        np.testing.assert_allclose(recovered[7], vectors[0])
+        np.testing.assert_allclose(recovered[2], vectors[1])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,90 @@
+"""Accept-Encoding negotiation and compressed API Gateway responses.
+
+Needs the packages from requirements.txt; no AWS access is used.
+
+    python -m unittest discover tests
+"""
+import base64
+import gzip
+import json
+import os
+import sys
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import lambda_function  # noqa: E402
+
+
+def request(accept_encoding, header='Accept-Encoding'):
+    return {'headers': {header: accept_encoding}}
+
+
+class NegotiateEncodingTest(unittest.TestCase):
+
+    def setUp(self):
+        patch = mock.patch.object(lambda_function, 'COMPRESS_RESPONSES', True)
+        patch.start()
+        self.addCleanup(patch.stop)
+
+    def negotiate(self, event, brotli=None):
+        with mock.patch.object(lambda_function, 'brotli', brotli):
+            return lambda_function.negotiate_encoding(event)
+
+    def test_brotli_preferred_when_installed(self):
+        self.assertEqual(self.negotiate(request('gzip, deflate, br'), brotli=object()), 'br')
+        self.assertEqual(self.negotiate(request('gzip, deflate, br')), 'gzip')
+
+    def test_header_name_is_case_insensitive(self):
+        self.assertEqual(self.negotiate(request('gzip', header='accept-encoding')), 'gzip')
+
+    def test_zero_quality_refuses_an_encoding(self):
+        self.assertIsNone(self.negotiate(request('gzip;q=0, identity')))
+        self.assertEqual(self.negotiate(request('br; q=0.0, gzip;q=0.5'), brotli=object()), 'gzip')
+
+    def test_wildcard_and_missing_header(self):
+        self.assertEqual(self.negotiate(request('*')), 'gzip')
+        self.assertIsNone(self.negotiate({'headers': None}))
+        self.assertIsNone(self.negotiate({}))
+
+    def test_disabled_by_configuration(self):
+        with mock.patch.object(lambda_function, 'COMPRESS_RESPONSES', False):
+            self.assertIsNone(self.negotiate(request('gzip')))
+
+
+class BuildResponseTest(unittest.TestCase):
+
+    def setUp(self):
+        patches = [
+            mock.patch.object(lambda_function, 'COMPRESS_RESPONSES', True),
+            mock.patch.object(lambda_function, 'COMPRESSION_MIN_BYTES', 1024),
+            mock.patch.object(lambda_function, 'brotli', None),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def test_large_body_is_gzipped_and_base64_encoded(self):
+        payload = {'sessions': [{'sessionTitle': f'Question {i} about the page'} for i in range(200)]}
+        response = lambda_function.build_response(request('gzip'), 200, payload)
+        self.assertTrue(response['isBase64Encoded'])
+        self.assertEqual(response['headers']['Content-Encoding'], 'gzip')
+        self.assertEqual(response['headers']['Vary'], 'Accept-Encoding')
+        self.assertEqual(json.loads(gzip.decompress(base64.b64decode(response['body']))), payload)
+
+    def test_small_body_is_sent_as_is(self):
+        response = lambda_function.build_response(request('gzip'), 200, {'message': 'ok'})
+        self.assertNotIn('isBase64Encoded', response)
+        self.assertNotIn('Content-Encoding', response['headers'])
+        self.assertEqual(json.loads(response['body']), {'message': 'ok'})
+
+    def test_size_threshold_counts_escaped_non_ascii(self):
+        # 200 'é' serialize as 1,200 bytes of \u00e9 escapes: over the threshold
+        response = lambda_function.build_response(request('gzip'), 200, {'t': 'é' * 200})
+        self.assertTrue(response.get('isBase64Encoded'))
+        self.assertEqual(json.loads(gzip.decompress(base64.b64decode(response['body']))), {'t': 'é' * 200})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,98 @@
+"""Picking earlier session pages for an ask and trimming the session manifest.
+
+Needs the packages from requirements.txt; no AWS access is used.
+
+    python -m unittest discover tests
+"""
+import os
+import sys
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import lambda_function  # noqa: E402
+
+
+def page(content_hash, last_visit, keywords=()):
+    return {'contentHash': content_hash, 'firstVisit': last_visit, 'lastVisit': last_visit,
+            'keywords': list(keywords)}
+
+
+def session(*pages):
+    """Session pages in visit order, keyed by URL."""
+    return {f"https://example.com/{i}": p for i, p in enumerate(pages)}
+
+
+class RankPreviousPagesTest(unittest.TestCase):
+
+    def test_most_recent_pages_returned_in_visit_order(self):
+        pages = session(page('a', 1), page('b', 2), page('c', 3), page('d', 4))
+        chosen = lambda_function.rank_previous_pages(pages, 'https://example.com/3', limit=2)
+        # b and c are the latest before the current page; order follows the visits
+        self.assertEqual([url for url, _ in chosen], ['https://example.com/1', 'https://example.com/2'])
+
+    def test_question_keywords_outrank_recency(self):
+        pages = session(page('a', 1, ['pricing', 'plans']), page('b', 2), page('c', 3), page('d', 4))
+        chosen = lambda_function.rank_previous_pages(
+            pages, 'https://example.com/3', question='pricing plans?', limit=1
+        )
+        self.assertEqual([url for url, _ in chosen], ['https://example.com/0'])
+
+    def test_pages_sharing_an_index_count_once(self):
+        pages = session(page('a', 1), page('a', 2), page('cur', 3), page('cur', 4), page('cur', 5))
+        chosen = lambda_function.rank_previous_pages(pages, 'https://example.com/4', limit=5)
+        # One page per index, and none sharing the current page's index
+        self.assertEqual([data['contentHash'] for _, data in chosen], ['a'])
+        self.assertEqual(chosen[0][0], 'https://example.com/1')
+
+    def test_limit_and_pages_without_an_index(self):
+        pages = session(*[page(f'h{i}', i) for i in range(10)], page('', 11), page('cur', 12))
+        chosen = lambda_function.rank_previous_pages(pages, 'https://example.com/11', limit=3)
+        self.assertEqual([data['contentHash'] for _, data in chosen], ['h7', 'h8', 'h9'])
+        self.assertEqual(lambda_function.rank_previous_pages(pages, 'https://example.com/11', limit=0), [])
+
+
+class RecordPageVisitTest(unittest.TestCase):
+
+    def setUp(self):
+        self.cache_table = mock.Mock()
+        patches = [
+            mock.patch.object(lambda_function, 'cache_table', self.cache_table),
+            mock.patch.object(lambda_function, 'SESSION_MANIFEST_MAX_PAGES', 3),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def record(self, page_url, session_pages):
+        entry = {'contentHash': 'new', 'firstVisit': 100, 'lastVisit': 100, 'keywords': ['fresh']}
+        lambda_function.record_page_visit('s', 'u', page_url, entry, session_pages=session_pages)
+        return self.cache_table.update_item.call_args.kwargs
+
+    def removed_urls(self, kwargs):
+        names = kwargs['ExpressionAttributeNames']
+        return sorted(url for name, url in names.items() if name.startswith('#d'))
+
+    def test_least_recently_visited_pages_are_dropped(self):
+        pages = session(page('a', 4), page('b', 1), page('c', 3), page('d', 2))
+        kwargs = self.record('https://example.com/new', pages)
+        # The new page plus the two latest of the rest fill the 3 slots
+        self.assertEqual(self.removed_urls(kwargs), ['https://example.com/1', 'https://example.com/3'])
+        self.assertIn(' REMOVE pages.#d0, pages.#d1', kwargs['UpdateExpression'])
+        self.assertEqual(kwargs['ExpressionAttributeValues'][':page']['keywords'], ['fresh'])
+
+    def test_revisited_page_is_never_dropped(self):
+        pages = session(page('a', 1), page('b', 2), page('c', 3), page('d', 4))
+        kwargs = self.record('https://example.com/0', pages)
+        self.assertNotIn('https://example.com/0', self.removed_urls(kwargs))
+        self.assertEqual(self.removed_urls(kwargs), ['https://example.com/1'])
+
+    def test_nothing_removed_under_the_cap(self):
+        kwargs = self.record('https://example.com/new', session(page('a', 1), page('b', 2)))
+        self.assertEqual(self.removed_urls(kwargs), [])
+        self.assertNotIn('REMOVE', kwargs['UpdateExpression'])
+
+
+if __name__ == '__main__':
+    unittest.main()